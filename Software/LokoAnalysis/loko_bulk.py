@@ -0,0 +1,634 @@
+# Bulk decoder for Loko captures and logs on a PC. Reads LoRa-E5 UART
+# captures and trace files ('+TEST: RX' lines, see loko_trace.py in the
+# ground firmware host folder), the ground unit's binary log (lora_log.bin)
+# and text logs (lora_log.txt, 'log' and 'export' console output) into one
+# table of numpy columns and writes it as .npz, .parquet (needs pyarrow)
+# or .csv.
+#
+# Packets are decoded in batches: payloads are grouped by length, each
+# group becomes one uint8 array and is decoded column by column with the
+# layouts in loko_packet, the module the firmware itself decodes with.
+# The AES blocks of one key are decrypted together with numpy table
+# lookups. Rows the fast path cannot vouch for, e.g. text packets with odd
+# characters from radio bit errors, go through loko_packet one at a time,
+# so the result matches what the ground unit logs.
+#
+#   python3 loko_bulk.py decode capture.txt lora_log.bin -o season.parquet
+#   python3 loko_bulk.py decode --settings settings.json captures/*.txt -o season.npz
+#   python3 loko_bulk.py bench n=1000000    compare with loko_packet and time it
+#
+# As a library: table, failures = decode_files(paths, keyring), a numpy
+# structured array with the TABLE columns; columns(table) splits it.
+import sys
+import os
+import re
+import json
+import time
+import struct
+import binascii
+import argparse
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FIRMWARE = os.path.join(os.path.dirname(HERE), 'LokoGround Firmware')
+sys.path.insert(0, os.path.join(FIRMWARE, 'host'))  # CPython stand-ins of the MicroPython modules
+sys.path.insert(0, FIRMWARE)
+import loko_packet
+import loko_trace
+import ucryptolib
+
+FORMATS = loko_trace.FORMATS + ('log',)  # fmt column values, 'log' for log records
+FMT = {name: i for i, name in enumerate(FORMATS)}
+# ts: s since 2000-01-01 by the ground unit clock, -1 for captures; t_ms:
+# capture time prefix, -1 without; lat/lon 1e-6 deg; flags and fence as in
+# the log records; source: index of the input file
+TABLE = np.dtype([('ts', '<i8'), ('t_ms', '<i8'), ('id1', '<u4'), ('id2', '<u4'),
+                  ('lat', '<i4'), ('lon', '<i4'), ('alt', '<i4'), ('vbat', '<u2'),
+                  ('mps', '<u2'), ('rssi', '<i2'), ('snr', '<i2'), ('flags', 'u1'),
+                  ('fence', '<u2'), ('fmt', 'u1'), ('source', '<u2')])
+EPOCH = np.datetime64('2000-01-01T00:00:00', 's')  # MicroPython's time.time() epoch
+
+_STRUCT_CODES = {'b': 'i1', 'B': 'u1', '?': 'u1', 'h': 'i2', 'H': 'u2', 'i': 'i4', 'I': 'u4',
+                 'l': 'i4', 'L': 'u4', 'q': 'i8', 'Q': 'u8', 'e': 'f2', 'f': 'f4', 'd': 'f8'}
+
+
+def struct_dtype(fmt, names=None):
+    # numpy dtype with the fields and offsets of a struct format, so
+    # records can be viewed instead of unpacked one at a time
+    order = '>' if fmt[0] in '>!' else '<'
+    fields = {'names': [], 'formats': [], 'offsets': [], 'itemsize': struct.calcsize(fmt)}
+    offset = 0
+    for count, code in re.findall(r'(\d*)([a-zA-Z?])', fmt.lstrip('<>!=@')):
+        count = int(count or 1)
+        if code == 'x':
+            offset += count
+            continue
+        if code == 's':
+            kinds = [(('S%d' % count), count)]
+        else:
+            size = struct.calcsize(order + code)
+            kinds = [(order + _STRUCT_CODES[code], size)] * count
+        for kind, size in kinds:
+            fields['names'].append(names[len(fields['names'])] if names else 'f%d' % len(fields['names']))
+            fields['formats'].append(kind)
+            fields['offsets'].append(offset)
+            offset += size
+    return np.dtype(fields)
+
+
+LOG_RECORD = struct_dtype(loko_packet.LOG_RECORD_FORMAT, (
+    'ts', 'id1', 'id2', 'lat', 'lon', 'alt', 'vbat', 'mps', 'rssi', 'snr', 'flags', 'fence'))
+STR_AES_BLOCK = struct_dtype(loko_packet.STR_AES_FORMAT, (
+    'lat', 'lon', 'vbat', 'alt', 'mps', 'reserved', 'checksum'))
+
+
+class SETTINGS():
+    # The ground unit's settings.json, enough of it for loko_packet.KEYRING
+
+    def __init__(self, path=None, key=None):
+        self.data = {'p2p_key': '00' * 32, 'keys': {}}
+        if path:
+            with open(path) as f:
+                self.data.update(json.load(f))
+        if key:
+            self.data['p2p_key'] = key
+
+
+# Inverse cipher of ucryptolib's AES over an (n, 16) uint8 array, one
+# table lookup per byte and round for all blocks at once
+_INV_SBOX = np.array(ucryptolib._INV_SBOX, np.uint8)
+_MUL = [np.array(table, np.uint8) for table in
+        (ucryptolib._MUL14, ucryptolib._MUL11, ucryptolib._MUL13, ucryptolib._MUL9)]
+_INV_SHIFT = [(i - 4 * (i % 4)) % 16 for i in range(16)]
+
+
+def aes_ecb_decrypt(key, blocks):
+    rk = np.array(ucryptolib._expand_key(bytes(key)), np.uint8)
+    rounds = len(rk) - 1
+    s = blocks ^ rk[rounds]
+    for r in range(rounds - 1, -1, -1):
+        s = _INV_SBOX[s[:, _INV_SHIFT]] ^ rk[r]
+        if r:
+            c = s.reshape(-1, 4, 4)
+            m = np.empty_like(c)
+            for row in range(4):
+                # Row of the inverse MixColumns matrix, rotated per output byte
+                m[:, :, row] = _MUL[(0 - row) % 4][c[:, :, 0]] ^ _MUL[(1 - row) % 4][c[:, :, 1]] ^ \
+                    _MUL[(2 - row) % 4][c[:, :, 2]] ^ _MUL[(3 - row) % 4][c[:, :, 3]]
+            s = m.reshape(-1, 16)
+    return s
+
+
+def decrypt_by_key(keyring, id1, id2, blocks):
+    # Blocks of all trackers, each batch of trackers sharing a key decrypted together
+    out = np.empty_like(blocks)
+    pairs, inverse = np.unique((id1.astype(np.uint64) << 32) | id2, return_inverse=True)
+    keys = {}
+    for i, pair in enumerate(pairs):
+        key = keyring.keys.get((int(pair) >> 32, int(pair) & 0xFFFFFFFF), keyring.default)
+        keys.setdefault(key, []).append(i)
+    for key, members in keys.items():
+        rows = np.isin(inverse, members)
+        out[rows] = aes_ecb_decrypt(key, blocks[rows])
+    return out
+
+
+def _be24(rows, pos):
+    value = (rows[:, pos].astype(np.int32) << 16) | (rows[:, pos + 1].astype(np.int32) << 8) | \
+        rows[:, pos + 2]
+    return value - ((value & 0x800000) << 1)
+
+
+def _view(rows, pos, dtype):
+    return np.ascontiguousarray(rows[:, pos:pos + dtype.itemsize]).view(dtype)[:, 0]
+
+
+def decode_binary(rows, keyring, out, failures):
+    # rows: (n, length) payloads of one length that are not printable text.
+    # Fills out (TABLE rows of the same n), returns the mask of decoded ones.
+    n, length = rows.shape
+    ok = np.zeros(n, bool)
+    if length == loko_packet.BIN_AES_LENGTH:
+        header = _view(rows, 0, struct_dtype(loko_packet.BIN_AES_HEADER_FORMAT, ('id1', 'id2', 'version')))
+        layouts = [(loko_packet.BIN_FORMATS.get((length, int(version))), header['version'] == version)
+                   for version in np.unique(header['version'])]
+        known = np.zeros(n, bool)
+        for layout, rows_v in layouts:
+            if layout is not None:
+                known |= rows_v
+        body = np.zeros((n, 16), np.uint8)
+        body[known] = decrypt_by_key(keyring, header['id1'][known], header['id2'][known], rows[known, 9:])
+        checked = known & ((body[:, :15].sum(1, dtype=np.uint32) & 0xFF) == body[:, 15])
+        failures['unknown'] += int((~known).sum())
+        failures['key'] += int((known & ~checked).sum())
+        vb_version = body[:, 0]
+    else:
+        layout = loko_packet.BIN_FORMATS.get((length, None))
+        if layout is None:
+            failures['unknown'] += n
+            return ok
+        header = _view(rows, 0, struct_dtype(loko_packet.BIN_HEADER_FORMAT, ('id1', 'id2', 'version')))
+        layouts = [(layout, np.ones(n, bool))]
+        checked = np.ones(n, bool)
+        body = rows
+        vb_version = header['version']
+    for layout, rows_v in layouts:
+        if layout is None:
+            continue
+        sel = rows_v & checked
+        lat_pos, lat_size, speed_alt, name = layout
+        part = body[sel]
+        if lat_size == 3:
+            # 1e-4 degrees on the wire
+            out['lat'][sel] = _be24(part, lat_pos) * 100
+            out['lon'][sel] = _be24(part, lat_pos + 3) * 100
+        else:
+            out['lat'][sel] = _view(part, lat_pos, np.dtype('>i4'))
+            out['lon'][sel] = _view(part, lat_pos + 4, np.dtype('>i4'))
+        if speed_alt is not None:
+            fields = _view(part, lat_pos + 2 * lat_size, struct_dtype(speed_alt, ('mps', 'alt')))
+            out['mps'][sel] = fields['mps']
+            out['alt'][sel] = fields['alt']
+        out['fmt'][sel] = FMT[name]
+        ok |= sel
+    out['id1'] = header['id1']
+    out['id2'] = header['id2']
+    out['vbat'] = ((vb_version & 0x0F).astype(np.uint16) + 27) * 100
+    out['flags'] = loko_packet.LOG_FLAG_ALT  # alt and mps are 0 in bin15/bin17, not missing
+    return ok
+
+
+# Characters the fast path accepts in text packets, anything else is
+# left to loko_packet
+_NUMBER_CHARS = np.zeros(256, bool)
+_NUMBER_CHARS[[ord(c) for c in '0123456789,.-']] = True
+_BASE64 = np.full(256, 255, np.uint8)
+_BASE64[[ord(c) for c in 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/']] = np.arange(64)
+_HEX = np.full(256, 255, np.uint8)
+_HEX[[ord(c) for c in '0123456789']] = np.arange(10)
+_HEX[[ord(c) for c in 'abcdef']] = np.arange(10, 16)
+_HEX[[ord(c) for c in 'ABCDEF']] = np.arange(10, 16)
+
+
+def _degrees_e6(values):
+    # coord_to_e6() of decimal text with up to 6 decimals, exact as the
+    # fraction is at most 1e-7 away from a whole number of micro degrees
+    return (np.sign(values) * np.floor(np.abs(values) * 1000000 + 0.0001)).astype(np.int32)
+
+
+def _long_fractions(rows):
+    # Rows with a number of more than 6 decimals, which coord_to_e6() cuts
+    # where the float path would round up
+    position = np.arange(rows.shape[1])
+    dot = np.maximum.accumulate(np.where(rows == ord('.'), position, -1), axis=1)
+    stop = np.maximum.accumulate(np.where((rows == ord('.')) | (rows == ord(',')), position, -1), axis=1)
+    return ((dot == stop) & (dot >= 0) & (position - dot > 6)).any(1)
+
+
+def _lines(rows):
+    return np.hstack([rows, np.full((len(rows), 1), 10, np.uint8)]).tobytes().decode('ascii').splitlines()
+
+
+def decode_text(rows, keyring, out, failures):
+    # rows: (n, length) printable payloads, 'id1,id2,...' text packets.
+    # Returns the masks of decoded rows and of those left to loko_packet.
+    n, length = rows.shape
+    ok = np.zeros(n, bool)
+    done = np.zeros(n, bool)
+    fields = (rows == ord(',')).sum(1) + 1
+    plain = _NUMBER_CHARS[rows].all(1) & ~_long_fractions(rows)
+    for count, name in ((5, 'str5'), (7, 'str7')):
+        sel = (fields == count) & plain
+        if not sel.any():
+            continue
+        names = ['id1', 'id2', 'lat', 'lon'] + (['alt', 'mps'] if count == 7 else []) + ['vbat']
+        try:
+            values = np.loadtxt(_lines(rows[sel]), delimiter=',', ndmin=1,
+                                dtype=[(column, 'f8' if column in ('lat', 'lon') else 'i8') for column in names])
+        except ValueError:
+            continue  # a malformed number somewhere, loko_packet sorts them out
+        # coord_to_e6() rejects what does not fit an int32, leave those to it too
+        fits = (np.abs(values['lat']) < 2147) & (np.abs(values['lon']) < 2147)
+        sel[sel] = fits
+        values = values[fits]
+        out['id1'][sel] = values['id1']
+        out['id2'][sel] = values['id2']
+        out['lat'][sel] = _degrees_e6(values['lat'])
+        out['lon'][sel] = _degrees_e6(values['lon'])
+        out['vbat'][sel] = values['vbat']
+        if count == 7:
+            out['alt'][sel] = values['alt']
+            out['mps'][sel] = values['mps']
+            out['flags'][sel] = loko_packet.LOG_FLAG_ALT
+        out['fmt'][sel] = FMT[name]
+        ok |= sel
+    # 'id1,id2,' and the 24 base64 characters of one AES block
+    cut = length - 25
+    if cut > 2:
+        sel = (fields == 3) & _NUMBER_CHARS[rows[:, :cut]].all(1) & (rows[:, cut] == ord(',')) & \
+            (_BASE64[rows[:, cut + 1:length - 2]] != 255).all(1) & (rows[:, length - 2:] == ord('=')).all(1)
+        where = np.flatnonzero(sel)
+        if len(where):
+            try:
+                ids = np.loadtxt(_lines(rows[where, :cut]), delimiter=',', dtype='i8', ndmin=2)
+            except ValueError:
+                where = where[:0]
+        if len(where):
+            sixes = np.zeros((len(where), 24), np.uint32)
+            sixes[:, :22] = _BASE64[rows[where, cut + 1:length - 2]]
+            sixes = sixes.reshape(-1, 6, 4)
+            bits = (sixes[:, :, 0] << 18) | (sixes[:, :, 1] << 12) | (sixes[:, :, 2] << 6) | sixes[:, :, 3]
+            blocks = np.stack([bits >> 16, bits >> 8, bits], axis=2).astype(np.uint8).reshape(-1, 18)[:, :16]
+            id1, id2 = ids[:, 0].astype(np.uint32), ids[:, 1].astype(np.uint32)
+            plain_blocks = decrypt_by_key(keyring, id1, id2, np.ascontiguousarray(blocks))
+            block = plain_blocks.view(STR_AES_BLOCK)[:, 0]
+            good = (plain_blocks[:, :15].sum(1, dtype=np.uint32) & 0xFF) == block['checksum']
+            failures['key'] += int((~good).sum())
+            # float32 widened exactly, then rounded and range checked like
+            # coord_to_e6(), which turns NaN or huge values from a key that
+            # passed the checksum by chance into malformed packets. Those NaNs
+            # are expected, so numpy must not warn about them.
+            fits = good.copy()
+            with np.errstate(invalid='ignore', over='ignore'):
+                lat = block['lat'].astype(np.float64)
+                lon = block['lon'].astype(np.float64)
+                for degrees in (lat, lon):
+                    e6 = np.round(degrees * 1000000)
+                    fits &= (np.abs(degrees) < 2147.48) & (e6 >= -0x80000000) & (e6 <= 0x7FFFFFFF)
+            failures['malformed'] += int((good & ~fits).sum())
+            good = fits
+            rows_ok = where[good]
+            block = block[good]
+            out['id1'][rows_ok] = id1[good]
+            out['id2'][rows_ok] = id2[good]
+            out['lat'][rows_ok] = np.round(lat[good] * 1000000)
+            out['lon'][rows_ok] = np.round(lon[good] * 1000000)
+            out['vbat'][rows_ok] = block['vbat']
+            out['alt'][rows_ok] = block['alt']
+            out['mps'][rows_ok] = block['mps']
+            out['flags'][rows_ok] = loko_packet.LOG_FLAG_ALT
+            out['fmt'][rows_ok] = FMT['str_aes']
+            ok[rows_ok] = True
+            done[where] = True
+    return ok, ~(ok | done)
+
+
+def decode_one(payload, keyring, row, failures):
+    # The firmware's own decoder and conversions, for the rows the fast
+    # path left out. Returns False when the packet does not decode.
+    before = dict(loko_packet.failures)
+    packet = loko_packet.decode_loko_payload(binascii.hexlify(payload), keyring)
+    for name in failures:
+        failures[name] += loko_packet.failures[name] - before[name]
+    if packet is None:
+        return False
+    try:
+        row['lat'] = loko_packet.coord_to_e6(packet.lat)
+        row['lon'] = loko_packet.coord_to_e6(packet.lon)
+        row['vbat'] = loko_packet.vbat_to_mv(packet.vbat)
+        row['id1'], row['id2'] = packet.id1, packet.id2
+        if packet.alt is not None and packet.mps is not None:
+            row['alt'], row['mps'] = packet.alt, packet.mps
+            row['flags'] = loko_packet.LOG_FLAG_ALT
+    except OverflowError:
+        failures['malformed'] += 1  # ids or values wider than their column
+        return False
+    row['fmt'] = FMT[packet.fmt]
+    return True
+
+
+def decode_payloads(payloads, keyring, failures):
+    # Hex payloads (bytes) -> (TABLE rows, mask of the decoded ones), in order
+    table = np.zeros(len(payloads), TABLE)
+    ok = np.zeros(len(payloads), bool)
+    lengths = np.fromiter(map(len, payloads), np.int64, len(payloads))
+    for length in np.unique(lengths):
+        index = np.flatnonzero(lengths == length)
+        if length % 2:
+            failures['hex'] += len(index)
+            continue
+        if not length:
+            failures['unknown'] += len(index)
+            continue
+        nibbles = _HEX[np.frombuffer(b''.join([payloads[i] for i in index]), np.uint8).reshape(len(index), length)]
+        valid = (nibbles != 255).all(1)
+        failures['hex'] += int((~valid).sum())
+        index = index[valid]
+        rows = (nibbles[valid, 0::2] << 4) | nibbles[valid, 1::2]
+        text = ((rows >= 32) & (rows <= 126)).all(1)
+        part = np.zeros(len(index), TABLE)
+        done = np.zeros(len(index), bool)
+        slow = np.zeros(len(index), bool)
+        if (~text).any():
+            binary = np.zeros((~text).sum(), TABLE)
+            done[~text] = decode_binary(rows[~text], keyring, binary, failures)
+            part[~text] = binary
+        if text.any():
+            strings = np.zeros(text.sum(), TABLE)
+            done[text], slow[text] = decode_text(rows[text], keyring, strings, failures)
+            part[text] = strings
+        for i in np.flatnonzero(slow):
+            done[i] = decode_one(rows[i].tobytes(), keyring, part[i:i + 1][0], failures)
+        table[index] = part
+        ok[index] = done
+    return table, ok
+
+
+CAPTURE_LINE = re.compile(
+    rb'(?m)(?:^(?:\d+ )?\+TEST: LEN:\d+, RSSI:(-?\d+), SNR:(-?\d+)\r?\n)?^(?:(\d+) )?\+TEST: RX "([^"]*)"')
+
+
+def _numbers(values, dtype, empty=b'0'):
+    column = np.array(values, dtype=bytes)
+    if not len(column):
+        return np.zeros(0, dtype)
+    return np.where(column == b'', empty, column).astype(dtype)
+
+
+def decode_capture(data, keyring, failures):
+    # LoRa-E5 output with '+TEST: RX "HEX"' lines, each with the signal of
+    # the LEN line in front when there is one and an optional ms prefix
+    found = CAPTURE_LINE.findall(data)
+    rssi, snr, t_ms, payloads = zip(*found) if found else ((), (), (), ())
+    table, ok = decode_payloads(list(payloads), keyring, failures)
+    table['rssi'] = _numbers(rssi, np.int16)
+    table['snr'] = _numbers(snr, np.int16)
+    table['t_ms'] = _numbers(t_ms, np.int64, b'-1')
+    table['ts'] = -1
+    return table[ok]
+
+
+def decode_log_bin(data):
+    # lora_log.bin as LOG_MANAGER leaves it, oldest record first
+    magic, version, record_size, _, capacity, head, count, seq = struct.unpack_from(
+        loko_packet.LOG_HEADER_FORMAT, data)
+    if magic != loko_packet.LOG_MAGIC or version != loko_packet.LOG_VERSION or \
+            record_size != loko_packet.LOG_RECORD_SIZE:
+        raise ValueError('not a Loko log file of this version')
+    records = np.frombuffer(data, LOG_RECORD, capacity, loko_packet.LOG_HEADER_SIZE)
+    records = records[(head - count + np.arange(count)) % capacity]
+    table = np.zeros(count, TABLE)
+    for name in LOG_RECORD.names:
+        table[name] = records[name]
+    table['t_ms'] = -1
+    table['fmt'] = FMT['log']
+    return table
+
+
+LOG_LINE = re.compile(
+    rb'\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d|LOG-\d+)\] ID1=(\d+), ID2=(\d+), LAT=(-?[\d.]+), LON=(-?[\d.]+), '
+    rb'VBAT=([\d.]+)(?:, ALT=(-?\d+), MPS=(\d+))?(?:, RSSI=(-?\d+), SNR=(-?\d+))?(?:, (ENTER|EXIT)=(\d+))?')
+
+
+def decode_log_text(data):
+    # '[YYYY-MM-DD hh:mm:ss] ID1=.., ID2=.., LAT=.., LON=.., VBAT=..' lines of
+    # the old lora_log.txt and of the 'log' and 'export' commands. VBAT with
+    # a decimal point is in volts, 'LOG-N' times (clock not set) become -1.
+    found = LOG_LINE.findall(data)
+    columns = list(zip(*found)) if found else [()] * 12
+    table = np.zeros(len(found), TABLE)
+    when = np.array(columns[0], dtype=bytes)
+    dated = np.char.startswith(when, b'LOG-') == False
+    table['ts'] = -1
+    if dated.any():
+        stamps = np.char.replace(when[dated], b' ', b'T').astype('U19').astype('datetime64[s]')
+        table['ts'][dated] = (stamps - EPOCH).astype(np.int64)
+    table['t_ms'] = -1
+    table['id1'] = _numbers(columns[1], np.uint32)
+    table['id2'] = _numbers(columns[2], np.uint32)
+    table['lat'] = _degrees_e6(_numbers(columns[3], np.float64))
+    table['lon'] = _degrees_e6(_numbers(columns[4], np.float64))
+    vbat = _numbers(columns[5], np.float64)
+    volts = np.char.find(np.array(columns[5], dtype=bytes), b'.') >= 0
+    table['vbat'] = np.where(volts, np.floor(vbat * 1000 + 0.5), vbat) if len(vbat) else vbat
+    table['alt'] = _numbers(columns[6], np.int32)
+    table['mps'] = _numbers(columns[7], np.uint16)
+    table['rssi'] = _numbers(columns[8], np.int16)
+    table['snr'] = _numbers(columns[9], np.int16)
+    event = np.array(columns[10], dtype=bytes)
+    flags = np.where(np.array(columns[6], dtype=bytes) != b'', loko_packet.LOG_FLAG_ALT, 0)
+    flags |= np.where(event == b'ENTER', loko_packet.LOG_FLAG_ENTER, 0)
+    flags |= np.where(event == b'EXIT', loko_packet.LOG_FLAG_EXIT, 0)
+    table['flags'] = flags
+    table['fence'] = _numbers(columns[11], np.uint16)
+    table['fmt'] = FMT['log']
+    return table
+
+
+def decode_file(path, keyring, failures):
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data.startswith(loko_packet.LOG_MAGIC):
+        return decode_log_bin(data)
+    if b'+TEST: RX' in data:
+        return decode_capture(data, keyring, failures)
+    return decode_log_text(data)
+
+
+def decode_files(paths, keyring):
+    # All files in one table, in file order; failures counts the packets of
+    # captures that did not decode, by reason as in loko_packet.failures
+    failures = {'hex': 0, 'unknown': 0, 'key': 0, 'malformed': 0}
+    tables = []
+    for i, path in enumerate(paths):
+        try:
+            table = decode_file(path, keyring, failures)
+        except (OSError, ValueError, struct.error) as e:
+            print('Skipped {}: {}'.format(path, e))
+            continue
+        table['source'] = i
+        tables.append(table)
+    return (np.concatenate(tables) if tables else np.zeros(0, TABLE)), failures
+
+
+def columns(table):
+    return {name: np.ascontiguousarray(table[name]) for name in TABLE.names}
+
+
+OUTPUTS = ('.npz', '.parquet', '.csv')
+
+
+def write_table(path, table, files):
+    # .npz also holds the names behind fmt and source as 'formats' and
+    # 'sources', .parquet stores both as dictionary columns
+    if path.endswith('.npz'):
+        np.savez_compressed(path, formats=np.array(FORMATS), sources=np.array(files), **columns(table))
+    elif path.endswith('.parquet'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Writing .parquet needs pyarrow, use .npz or .csv instead')
+        arrays = columns(table)
+        arrays['fmt'] = pyarrow.DictionaryArray.from_arrays(arrays['fmt'], list(FORMATS))
+        arrays['source'] = pyarrow.DictionaryArray.from_arrays(arrays['source'], files)
+        pyarrow.parquet.write_table(pyarrow.table(arrays), path)
+    elif path.endswith('.csv'):
+        with open(path, 'w') as f:
+            f.write(','.join(TABLE.names) + '\n')
+            np.savetxt(f, np.array([table[name] for name in TABLE.names]).T, fmt='%d', delimiter=',')
+
+
+def summary(table, failures, seconds):
+    counts = np.bincount(table['fmt'], minlength=len(FORMATS))
+    print('{} rows in {:.2f} s, {:.0f} rows/s'.format(len(table), seconds, len(table) / max(seconds, 1e-9)))
+    print('Formats: ' + ', '.join('{}={}'.format(name, counts[i]) for i, name in enumerate(FORMATS) if counts[i]))
+    print('Not decoded: ' + ', '.join('{}={}'.format(k, v) for k, v in failures.items()))
+
+
+def bench_corpus(n, rnd):
+    # Module lines for every format plus wrong-key, corrupted, unknown and
+    # non-hex packets, as bench_decode.py builds them
+    key = bytes(range(0x10, 0x30))
+    wrong = bytes(range(0x30, 0x50))
+    lines = []
+    for i in range(n):
+        fmt = loko_trace.FORMATS[i % len(loko_trace.FORMATS)]
+        payload = loko_trace.make_payload(
+            fmt, rnd.randrange(100), rnd.choice((7, 9)), rnd.uniform(-80, 80), rnd.uniform(-179, 179),
+            alt=rnd.randrange(3000), mps=rnd.randrange(40), vbat_mv=3300 + rnd.randrange(900),
+            key=wrong if i % 23 == 0 else key)
+        if i % 17 == 0:
+            payload = loko_trace.corrupt(payload, rnd.randrange(len(payload)))
+        if i % 29 == 0:
+            payload = bytes(rnd.randrange(256) for _ in range(11))
+        text = loko_trace.module_lines(payload, rnd.randint(-120, -30), rnd.randint(-15, 12))
+        if i % 31 == 0:
+            text = text.replace(b'RX "', b'RX "Z')
+        lines.append(b'%d ' % (i * 100) + text.replace(b'\r\n+TEST: RX', b'\r\n%d +TEST: RX' % (i * 100)))
+    return key, lines
+
+
+def bench(n, unique):
+    # Decodes a capture of n packets, made of 'unique' distinct ones
+    # repeated, in bulk and the distinct ones with loko_packet per line,
+    # checks both agree and compares their speed
+    import random
+    key, lines = bench_corpus(unique, random.Random(1))
+    keyring = loko_packet.KEYRING(SETTINGS(key=key.hex()))
+    loko_packet.verbose = False
+    data = b''.join(lines)
+
+    start = time.perf_counter()
+    expected = []
+    rssi = snr = 0
+    for line in data.split(b'\r\n'):
+        head, _, rest = line.partition(b' ')
+        signal = loko_packet.parse_lora_signal(rest)
+        if signal is not None:
+            rssi, snr = signal
+            continue
+        payload = loko_packet.parse_lora_module_message(rest)
+        if payload is None:
+            continue
+        packet = loko_packet.decode_loko_payload(payload, keyring)
+        if packet is not None:
+            alt = packet.alt is not None and packet.mps is not None
+            expected.append((int(head), packet.id1, packet.id2, loko_packet.coord_to_e6(packet.lat),
+                             loko_packet.coord_to_e6(packet.lon), packet.alt if alt else 0,
+                             loko_packet.vbat_to_mv(packet.vbat), packet.mps if alt else 0,
+                             rssi, snr, int(alt), FMT[packet.fmt]))
+        rssi = snr = 0
+    per_line = (time.perf_counter() - start) / unique
+
+    failures = {'hex': 0, 'unknown': 0, 'key': 0, 'malformed': 0}
+    table = decode_capture(data, keyring, failures)
+    got = list(zip(*(table[name].tolist() for name in (
+        't_ms', 'id1', 'id2', 'lat', 'lon', 'alt', 'vbat', 'mps', 'rssi', 'snr', 'flags', 'fmt'))))
+    if got != expected:
+        wrong = [(a, b) for a, b in zip(expected, got) if a != b][:5]
+        print('Bulk decode differs from loko_packet: {} rows against {}, first: {}'.format(
+            len(got), len(expected), wrong))
+        return 1
+    print('{} distinct packets, {} decoded, same as loko_packet'.format(unique, len(expected)))
+
+    data = data * (n // unique)
+    start = time.perf_counter()
+    failures = {'hex': 0, 'unknown': 0, 'key': 0, 'malformed': 0}
+    table = decode_capture(data, keyring, failures)
+    seconds = time.perf_counter() - start
+    summary(table, failures, seconds)
+    packets = unique * (n // unique)
+    print('bulk {:.2f} us/packet, loko_packet per line {:.2f} us/packet, {:.0f}x'.format(
+        seconds * 1e6 / packets, per_line * 1e6, per_line * packets / seconds))
+    return 0
+
+
+def main(argv):
+    if argv and argv[0] == 'bench':
+        n = 1000000
+        unique = 20000
+        for arg in argv[1:]:
+            if arg.startswith('n='):
+                n = int(arg[2:])
+            elif arg.startswith('unique='):
+                unique = int(arg[7:])
+            else:
+                print('usage: loko_bulk.py bench [n=1000000] [unique=20000]')
+                return 2
+        return bench(n, min(unique, n))
+    parser = argparse.ArgumentParser(description='Decode Loko captures and logs into columns')
+    parser.add_argument('command', choices=['decode'])
+    parser.add_argument('files', nargs='+', help='captures, trace files, lora_log.bin or text logs')
+    parser.add_argument('-o', '--output', help='.npz, .parquet or .csv, only a summary without')
+    parser.add_argument('--settings', help='the ground unit settings.json, for p2p_key and per tracker keys')
+    parser.add_argument('--key', help='64 hex digit p2p key, overrides the one in --settings')
+    args = parser.parse_args(argv)
+    if args.key and not loko_packet.is_valid_key(args.key):
+        parser.error('expected a 64 character hexadecimal key')
+    if args.output and not args.output.endswith(OUTPUTS):
+        parser.error('the output must end in ' + ', '.join(OUTPUTS))
+    loko_packet.verbose = False
+    keyring = loko_packet.KEYRING(SETTINGS(args.settings, args.key))
+    start = time.perf_counter()
+    table, failures = decode_files(args.files, keyring)
+    summary(table, failures, time.perf_counter() - start)
+    if args.output:
+        write_table(args.output, table, args.files)
+        print('Written to', args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,213 @@
+# Packet decode benchmark. Builds a corpus of LoRa-E5 module lines for every
+# Loko wire format plus wrong-key, corrupted and unknown packets, runs each
+# case through parse_lora_module_message + decode_loko_payload like
+# packet_task does and reports packets/s, us/packet and bytes allocated per
+# packet. Runs on CPython and on the unix MicroPython port:
+#
+#   python3 bench_decode.py
+#   micropython bench_decode.py
+#   python3 bench_decode.py save baseline.json       record a baseline
+#   python3 bench_decode.py compare baseline.json    show the change against it
+#
+# Options after the command: n=<packets per case> repeat=<passes>
+import sys
+import gc
+import json
+
+MICROPYTHON = sys.implementation.name == 'micropython'
+HERE = __file__.rsplit('/', 1)[0] if '/' in __file__ else '.'
+
+if MICROPYTHON:
+    # Load the built-in modules first, the CPython stand-ins next to this
+    # file would shadow them
+    _path = sys.path[:]
+    sys.path[:] = [p for p in sys.path if p not in ('', '.', HERE)]
+    import ucryptolib
+    import ubinascii
+    import ustruct
+    sys.path[:] = _path
+    from time import ticks_us, ticks_diff
+else:
+    from time import perf_counter_ns
+
+    def ticks_us():
+        return perf_counter_ns() // 1000
+
+    def ticks_diff(a, b):
+        return a - b
+
+sys.path.append(HERE + '/..')  # firmware folder
+import ubinascii
+import loko_packet
+import loko_trace
+
+STATION_ID2 = 7
+KEY = bytes(range(0x10, 0x30))
+WRONG_KEY = bytes(range(0x30, 0x50))
+ENCRYPTED = ('str_aes', 'bin25v2', 'bin25v5')
+REGRESSION = 10  # percent slower than the baseline that gets flagged
+
+
+class _Settings():
+    data = {'p2p_key': ubinascii.hexlify(KEY).decode(), 'keys': {}}
+
+
+class _Random():
+    # Small LCG, the unix port's random module may lack uniform()
+
+    def __init__(self, seed):
+        self.state = seed
+
+    def next(self, n):
+        self.state = (self.state * 1103515245 + 12345) & 0x7FFFFFFF
+        return self.state % n
+
+    def uniform(self, low, high):
+        return low + (high - low) * self.next(1000000) / 1000000
+
+
+def build_corpus(n):
+    # [(case name, [module line], expected to decode)]
+    rnd = _Random(1)
+    cases = []
+
+    def payload(fmt, id1, key=KEY):
+        return loko_trace.make_payload(
+            fmt, id1, STATION_ID2, rnd.uniform(-80, 80), rnd.uniform(-179, 179),
+            alt=rnd.next(3000), mps=rnd.next(40), vbat_mv=3300 + rnd.next(900), key=key)
+
+    def rx_line(data):
+        return loko_trace.module_lines(data).split(b'\r\n')[1]
+
+    for fmt in loko_trace.FORMATS:
+        cases.append((fmt, [rx_line(payload(fmt, i)) for i in range(n)], True))
+    for fmt in ENCRYPTED:
+        # None: the 8-bit checksum lets about 1 in 256 wrong-key packets through
+        cases.append((fmt + '/key', [rx_line(payload(fmt, i, WRONG_KEY)) for i in range(n)], None))
+    lines = []
+    for i in range(n):
+        data = payload(loko_trace.FORMATS[i % len(loko_trace.FORMATS)], i)
+        lines.append(rx_line(loko_trace.corrupt(data, rnd.next(len(data)))))
+    cases.append(('corrupt', lines, None))  # some still decode, e.g. a flipped lat byte
+    cases.append(('unknown', [rx_line(bytes(rnd.next(256) for _ in range(11))) for i in range(n)], False))
+    cases.append(('len_line', [b'+TEST: LEN:15, RSSI:-40, SNR:10'] * n, False))
+    return cases
+
+
+def decode(line, keyring):
+    payload = loko_packet.parse_lora_module_message(line)
+    if payload is None:
+        return None
+    return loko_packet.decode_loko_payload(payload, keyring)
+
+
+def time_case(lines, keyring, repeat):
+    # Fastest of the passes, the others were disturbed by GC or the host OS
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = ticks_us()
+        for line in lines:
+            decode(line, keyring)
+        elapsed = ticks_diff(ticks_us(), start)
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / len(lines)
+
+
+def alloc_case(lines, keyring):
+    # Bytes allocated per packet, with the collector off on MicroPython so
+    # the heap only grows; tracemalloc's peak per packet on CPython
+    total = 0
+    if MICROPYTHON:
+        for line in lines:
+            gc.collect()
+            gc.disable()
+            before = gc.mem_alloc()
+            decode(line, keyring)
+            total += gc.mem_alloc() - before
+            gc.enable()
+        return total / len(lines)
+    import tracemalloc
+    tracemalloc.start()
+    for line in lines:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        decode(line, keyring)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / len(lines)
+
+
+def run(n, repeat):
+    loko_packet.verbose = False
+    keyring = loko_packet.KEYRING(_Settings())
+    results = {}
+    print('{:<12} {:>7} {:>10} {:>9} {:>9}'.format('case', 'decoded', 'pkt/s', 'us/pkt', 'B/pkt'))
+    for name, lines, expected in build_corpus(n):
+        decoded = 0
+        for line in lines:
+            if decode(line, keyring) is not None:
+                decoded += 1
+        if expected is not None and decoded != (len(lines) if expected else 0):
+            print('{}: {} of {} decoded, expected {}'.format(name, decoded, len(lines), 'all' if expected else 'none'))
+        us = time_case(lines, keyring, repeat)
+        alloc = alloc_case(lines, keyring)
+        results[name] = {'us': us, 'bytes': alloc}
+        print('{:<12} {:>3}/{:<3} {:>10.0f} {:>9.1f} {:>9.0f}'.format(
+            name, decoded, len(lines), 1000000 / us if us else 0, us, alloc))
+    return results
+
+
+def compare(results, baseline):
+    print()
+    print('{:<12} {:>9} {:>9} {:>8} {:>9} {:>9}'.format('case', 'base us', 'now us', 'change', 'base B', 'now B'))
+    slower = 0
+    for name in results:
+        if name not in baseline:
+            continue
+        old, new = baseline[name], results[name]
+        change = (new['us'] - old['us']) * 100 / old['us'] if old['us'] else 0
+        flag = ''
+        if change > REGRESSION:
+            flag = '  slower'
+            slower += 1
+        print('{:<12} {:>9.1f} {:>9.1f} {:>7.0f}% {:>9.0f} {:>9.0f}{}'.format(
+            name, old['us'], new['us'], change, old['bytes'], new['bytes'], flag))
+    return slower
+
+
+def main(argv):
+    n = 50
+    repeat = 20
+    command = path = None
+    for arg in argv:
+        if arg.startswith('n='):
+            n = int(arg[2:])
+        elif arg.startswith('repeat='):
+            repeat = int(arg[7:])
+        elif command is None and arg in ('save', 'compare'):
+            command = arg
+        elif command is not None and path is None:
+            path = arg
+        else:
+            print('usage: bench_decode.py [save|compare FILE] [n=50] [repeat=20]')
+            return 2
+    print('Loko decode benchmark on', sys.implementation.name, sys.platform)
+    results = run(n, repeat)
+    if command == 'save':
+        with open(path, 'w') as f:
+            json.dump({'implementation': sys.implementation.name, 'results': results}, f)
+        print('Baseline saved to', path)
+    elif command == 'compare':
+        with open(path) as f:
+            baseline = json.load(f)
+        if baseline['implementation'] != sys.implementation.name:
+            print('Baseline was recorded on', baseline['implementation'])
+        if compare(results, baseline['results']):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,151 @@
+# Builds Loko tracker payloads in every wire format the ground firmware
+# decodes, wrapped in LoRa-E5 '+TEST' module lines, and reads and writes
+# trace files. Runs on CPython (with the stand-ins in this directory) and
+# on the MicroPython unix port.
+#
+# Trace file: one module line per text line, optionally prefixed with the
+# arrival time in ms, e.g.
+#   1500 +TEST: LEN:15, RSSI:-40, SNR:10
+#   1500 +TEST: RX "0100000002000000F4123456789ABC"
+import ubinascii
+import ustruct as struct
+from ucryptolib import aes
+
+FORMATS = ('str5', 'str7', 'str_aes', 'bin15', 'bin17', 'bin18', 'bin20',
+           'bin25v2', 'bin25v5')
+
+
+def _be(value, size):
+    value &= (1 << (size * 8)) - 1
+    return bytes((value >> (8 * (size - 1 - i))) & 0xFF for i in range(size))
+
+
+def _lat_lon(value, size):
+    # Inverse of bin_unpack_lat_lon_24 / _32
+    scale = 10000 if size == 3 else 1000000
+    return _be(int(round(value * scale)), size)
+
+
+def _vb_version(vbat_mv, version=0):
+    nibble = min(15, max(0, int(round(vbat_mv / 100)) - 27))
+    return (version << 4) | nibble
+
+
+def _seal(plain):
+    # Last byte of every encrypted block is the sum of the others
+    plain = bytearray(plain)
+    plain[-1] = sum(plain[:-1]) & 0xFF
+    return bytes(plain)
+
+
+def make_payload(fmt, id1, id2, lat, lon, alt=0, mps=0, vbat_mv=3900, key=None):
+    # Raw tracker payload (not hex) for one of FORMATS
+    if fmt == 'str5':
+        return '{:02d},{:03d},{:.6f},{:.6f},{}'.format(id1, id2, lat, lon, vbat_mv).encode()
+    if fmt == 'str7':
+        return '{:02d},{:03d},{:.6f},{:.6f},{},{},{}'.format(
+            id1, id2, lat, lon, alt, mps, vbat_mv).encode()
+    if fmt == 'str_aes':
+        block = _seal(struct.pack('<ffHHHBB', lat, lon, vbat_mv, alt & 0xFFFF, mps, 0, 0))
+        text = ubinascii.b2a_base64(aes(key, 1).encrypt(block)).strip()
+        return '{:02d},{:03d},'.format(id1, id2).encode() + text
+    if fmt.startswith('bin25'):
+        size = 3 if fmt == 'bin25v2' else 4
+        version = 2 if size == 3 else 5
+        block = bytes([_vb_version(vbat_mv)]) + _lat_lon(lat, size) + _lat_lon(lon, size) + \
+            struct.pack('<BH', mps, alt & 0xFFFF)
+        block = _seal(block + bytes(16 - len(block)))
+        return struct.pack('>IIB', id1, id2, version) + aes(key, 1).encrypt(block)
+    size = 3 if fmt in ('bin15', 'bin18') else 4
+    data = struct.pack('<IIB', id1, id2, _vb_version(vbat_mv)) + \
+        _lat_lon(lat, size) + _lat_lon(lon, size)
+    if fmt in ('bin18', 'bin20'):
+        data += struct.pack('<Bh', mps, alt)
+    return data
+
+
+def corrupt(payload, position):
+    # Flip one byte, e.g. to simulate a wrong key or a radio bit error
+    data = bytearray(payload)
+    data[position % len(data)] ^= 0x5A
+    return bytes(data)
+
+
+def module_lines(payload, rssi=-40, snr=10):
+    # What the LoRa-E5 prints for one received packet in TEST mode
+    hex_payload = ubinascii.hexlify(payload).decode().upper()
+    return ('+TEST: LEN:{}, RSSI:{}, SNR:{}\r\n+TEST: RX "{}"\r\n'.format(
+        len(payload), rssi, snr, hex_payload)).encode()
+
+
+def write_trace(path, events):
+    # events: (time_ms, module lines as bytes)
+    with open(path, 'w') as f:
+        for t_ms, lines in events:
+            for line in lines.decode().split('\r\n'):
+                if line:
+                    f.write('{} {}\n'.format(t_ms, line))
+
+
+def airtime_us(length, sf=12, bw_hz=125000, preamble=12):
+    # LoRa time on air, explicit header, CRC on, coding rate 4/5
+    symbol_us = (1 << sf) * 1000000 // bw_hz
+    de = 1 if symbol_us > 16000 else 0
+    payload = 8 + max(0, -(-(8 * length - 4 * sf + 44) // (4 * (sf - 2 * de)))) * 5
+    return int((preamble + 4.25) * symbol_us) + payload * symbol_us
+
+
+def read_trace(path, interval_ms=1000):
+    # Lines without a time prefix arrive interval_ms after the previous packet
+    events = []
+    t_ms = 0
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if not line:
+                continue
+            head, _, rest = line.partition(' ')
+            if head.isdigit():
+                t_ms = int(head)
+                line = rest
+            elif line.startswith('+TEST: LEN') and events:
+                t_ms += interval_ms
+            events.append((t_ms, (line + '\r\n').encode()))
+    return events
+
+
+def classify(payload):
+    # Format name of a raw payload, mirroring how the firmware tells them apart
+    for byte in payload:
+        if byte < 32 or byte > 126:
+            break
+    else:
+        fields = payload.count(b',') + 1
+        return {5: 'str5', 7: 'str7', 3: 'str_aes'}.get(fields, 'str?')
+    if len(payload) == 25:
+        return 'bin25v{}'.format(payload[8])
+    return 'bin{}'.format(len(payload))
+
+
+def payload_ids(payload):
+    # (id1, id2) as sent in clear, None if the payload is not a Loko packet
+    try:
+        if classify(payload).startswith('str'):
+            fields = payload.split(b',')
+            return int(fields[0]), int(fields[1])
+        if len(payload) == 25:
+            return struct.unpack_from('>II', payload)
+        return struct.unpack_from('<II', payload)
+    except (ValueError, IndexError):
+        return None
+
+
+def rx_payload(line):
+    # Payload bytes of a '+TEST: RX "..."' line, None for other lines
+    line = line.strip()
+    if not line.startswith(b'+TEST: RX "'):
+        return None
+    try:
+        return ubinascii.unhexlify(line[11:line.index(b'"', 11)])
+    except ValueError:
+        return None
@@ -0,0 +1,295 @@
+# Stand-ins for the machine classes the ground firmware touches. Everything
+# runs on the utime virtual clock; the harness scripts inputs through the
+# helper methods prefixed with _sim.
+import utime
+
+pins = {}
+uarts = {}
+adcs = {}
+sleeps = []
+
+
+def _sim_reset():
+    pins.clear()
+    uarts.clear()
+    adcs.clear()
+    del sleeps[:]
+
+
+class Pin():
+    IN = 1
+    OUT = 3
+    OPEN_DRAIN = 7
+    PULL_UP = 2
+    PULL_DOWN = 1
+    IRQ_RISING = 1
+    IRQ_FALLING = 2
+
+    def __init__(self, id, mode=-1, pull=-1, value=None):
+        self.id = id
+        self.mode = mode
+        self.level = 1 if value is None else value
+        self.handler = None
+        self.trigger = 0
+        self.history = []
+        pins[id] = self
+
+    def value(self, v=None):
+        if v is None:
+            return self.level
+        v = 1 if v else 0
+        if v != self.level:
+            self.history.append((utime.ticks_ms(), v))
+        self.level = v
+
+    def on(self):
+        self.value(1)
+
+    def off(self):
+        self.value(0)
+
+    def __call__(self, v=None):
+        return self.value(v)
+
+    def irq(self, handler=None, trigger=3):
+        self.handler = handler
+        self.trigger = trigger
+
+    def _sim_set(self, level):
+        # Drive an input pin from outside and fire its IRQ on a matching edge
+        old, self.level = self.level, level
+        if self.handler is None or old == level:
+            return
+        if (level == 0 and self.trigger & Pin.IRQ_FALLING) or \
+                (level == 1 and self.trigger & Pin.IRQ_RISING):
+            self.handler(self)
+
+
+class ADC():
+    ATTN_0DB = 0
+    ATTN_2_5DB = 1
+    ATTN_6DB = 2
+    ATTN_11DB = 3
+    WIDTH_9BIT = 0
+    WIDTH_10BIT = 1
+    WIDTH_11BIT = 2
+    WIDTH_12BIT = 3
+
+    def __init__(self, pin, atten=None):
+        self.pin = pin
+        self.raw = 2000
+        self.noise = None  # optional callable returning an offset per read
+        self.reads = 0
+        self.configs = 0
+        adcs[getattr(pin, 'id', pin)] = self
+
+    def atten(self, value):
+        self.configs += 1
+
+    def width(self, value):
+        self.configs += 1
+
+    def read(self):
+        self.reads += 1
+        raw = self.raw + (self.noise() if self.noise else 0)
+        return max(0, min(4095, int(raw)))
+
+    def read_u16(self):
+        return self.read() << 4
+
+    def read_uv(self):
+        return self.read() * 3300000 // 4095
+
+
+class UART():
+    # RX bytes are scripted as (time_us, data) events and become readable
+    # when the virtual clock reaches them. Written AT commands are answered
+    # by a responder callback, the default one mimics the LoRa-E5. Lines
+    # of a packet fed with its time on air are only delivered when the
+    # module's receiver was on for all of it, see _sim_listen().
+
+    def __init__(self, id, baudrate=9600, **kwargs):
+        self.id = id
+        self.baudrate = baudrate
+        self.rx = bytearray()
+        self.events = []  # sorted (time_us, data)
+        self.tx = []
+        self.responder = lora_e5_responder
+        self.response_delay_us = 20000
+        self.listening = [(-1 << 62, True)]  # (time_us, receiver on)
+        self.unheard = 0  # packets sent while the receiver was off
+        uarts[id] = self
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def _sim_feed(self, data, at_us=None, air=None):
+        # air: (start_us, end_us) the packet behind these lines was on air
+        if at_us is None:
+            at_us = utime.ticks_us()
+        self.events.append((at_us, bytes(data), air))
+        self.events.sort(key=lambda e: e[0])
+
+    def _sim_listen(self, on):
+        self.listening.append((utime.ticks_us(), on))
+
+    def _sim_heard(self, start_us, end_us):
+        on = False
+        for t_us, state in self.listening:
+            if t_us <= start_us:
+                on = state
+            elif t_us <= end_us and not state:
+                return False
+        return on
+
+    def listening_us(self, end_us):
+        # Total receiver on time up to end_us
+        total = 0
+        since = None
+        for t_us, state in self.listening + [(end_us, False)]:
+            if state and since is None:
+                since = t_us
+            elif not state and since is not None:
+                total += min(t_us, end_us) - max(since, 0)
+                since = None
+        return total
+
+    def _sim_pump(self):
+        now = utime.ticks_us()
+        while self.events and self.events[0][0] <= now:
+            _, data, air = self.events.pop(0)
+            if air is None or self._sim_heard(*air):
+                self.rx += data
+            else:
+                self.unheard += 1
+
+    def _sim_ready(self):
+        self._sim_pump()
+        return len(self.rx) > 0
+
+    def _sim_next_us(self):
+        return self.events[0][0] if self.events else None
+
+    def any(self):
+        self._sim_pump()
+        return len(self.rx)
+
+    def read(self, n=-1):
+        self._sim_pump()
+        if not self.rx:
+            return None
+        if n is None or n < 0:
+            n = len(self.rx)
+        data = bytes(self.rx[:n])
+        del self.rx[:n]
+        return data
+
+    def readinto(self, buf, n=None):
+        self._sim_pump()
+        if not self.rx:
+            return None
+        n = min(len(buf), len(self.rx) if n is None else n)
+        buf[:n] = self.rx[:n]
+        del self.rx[:n]
+        return n
+
+    def readline(self):
+        self._sim_pump()
+        pos = self.rx.find(b'\n')
+        return self.read(len(self.rx) if pos < 0 else pos + 1)
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.tx.append((utime.ticks_us(), bytes(data)))
+        if self.responder is not None:
+            reply = self.responder(self, bytes(data))
+            if reply:
+                self._sim_feed(reply, utime.ticks_us() + self.response_delay_us)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def txdone(self):
+        return True
+
+
+def lora_e5_responder(uart, data):
+    cmd = data.strip()
+    if cmd.startswith(b'AT+MODE='):
+        return b'+MODE: ' + cmd[8:] + b'\r\n'
+    if cmd.startswith(b'AT+TEST=RFCFG,'):
+        f = cmd[14:].split(b',')
+        return (b'+TEST: RFCFG F:' + f[0] + b'000000, ' + f[1] + b', BW' + f[2] +
+                b'K, TXPR:' + f[3] + b', RXPR:' + f[4] + b', POW:' + f[5] +
+                b'dBm, CRC:' + f[6] + b', IQ:' + f[7] + b', NET:' + f[8] + b'\r\n')
+    if cmd == b'AT+TEST=RXLRPKT':
+        uart._sim_listen(True)
+        return b'+TEST: RXLRPKT\r\n'
+    if cmd == b'AT+LOWPOWER':
+        uart._sim_listen(False)
+        return b'+LOWPOWER: SLEEP\r\n'
+    if cmd == b'AT':
+        return b'+AT: OK\r\n'
+    if cmd.startswith(b'AT'):
+        return b'+AT: ERROR(-1)\r\n'
+    return None
+
+
+class Timer():
+    PERIODIC = 1
+    ONE_SHOT = 0
+
+    def __init__(self, id=-1):
+        self.id = id
+        self.callback = None
+
+    def init(self, period=-1, mode=PERIODIC, callback=None, freq=-1):
+        self.callback = callback
+
+    def deinit(self):
+        self.callback = None
+
+
+class RTC():
+
+    def datetime(self, dt=None):
+        if dt is not None:
+            utime._set_wall_clock(utime.mktime((dt[0], dt[1], dt[2], dt[4], dt[5], dt[6])))
+            return None
+        t = utime.localtime()
+        return (t[0], t[1], t[2], t[6], t[3], t[4], t[5], 0)
+
+
+def lightsleep(ms=None):
+    sleeps.append((utime.ticks_ms(), ms))
+    utime.sleep_ms(ms or 0)
+
+
+def deepsleep(ms=None):
+    raise SystemExit('deepsleep')
+
+
+def reset():
+    raise SystemExit('reset')
+
+
+def freq(hz=None):
+    return 240000000
+
+
+def unique_id():
+    return b'\x24\x6f\x28\x00\x00\x01'
+
+
+def idle():
+    pass
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
@@ -0,0 +1,18 @@
+# Stand-in for the MicroPython helper module
+
+
+def const(value):
+    return value
+
+
+def schedule(func, arg):
+    func(arg)
+    return True
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def mem_info(*args):
+    pass
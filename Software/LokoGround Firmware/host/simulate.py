@@ -0,0 +1,507 @@
+# Runs the ground firmware unchanged on CPython against the stand-ins in
+# this directory. A trace of LoRa-E5 module lines is replayed through the
+# simulated UART at 9600 baud, a fake central connects over BLE and every
+# notify is matched back to the packet it carries, giving end-to-end
+# latency, loss and throughput per wire format.
+#
+#   python3 simulate.py                        synthetic trace, every format
+#   python3 simulate.py --burst 4 --interval 50
+#   python3 simulate.py --trace capture.txt    replay a recorded capture
+#   python3 simulate.py --cpu-scale 0          timing from sleeps only, repeatable
+#   python3 simulate.py --console "log 5"      run console commands at the end
+#   python3 simulate.py --write "sub 9 2000"   central writes a command first
+#   python3 simulate.py --drop 10000,30000     central away from 10 s to 30 s
+#   python3 simulate.py --press 5000,2500      hold the button 2.5 s at 5 s
+#   python3 simulate.py --write-end export     download the log over BLE at the end
+#   python3 simulate.py --trackers 3 --interval 5000 --jitter 200 --rx-sleep --drop 0,600000
+#                                              3 trackers every 15 s, radio duty cycled
+#   python3 simulate.py --trackers 4 --count 200 --fences 300 --console stats
+#                                              300 geofences around 4 walking trackers
+import argparse
+import gc
+import importlib.util
+import io
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import machine
+import uasyncio
+import ubluetooth
+import utime
+import loko_trace
+
+FIRMWARE = os.path.join(os.path.dirname(HERE), 'main_1.1.py')
+STATION_ID2 = 7
+KEY = bytes(range(0x10, 0x30))
+UART_ID = 2
+BAUD = 9600
+SETTLE_MS = 3000  # how long to keep running after the last packet
+
+
+class Console():
+    # Scripted stdin for the firmware console task
+
+    def __init__(self):
+        self.events = []
+        self.buf = ''
+
+    def feed(self, text, at_us):
+        self.events.append((at_us, text))
+        self.events.sort(key=lambda e: e[0])
+
+    def _pump(self):
+        while self.events and self.events[0][0] <= utime.ticks_us():
+            self.buf += self.events.pop(0)[1]
+
+    def _sim_ready(self):
+        self._pump()
+        return len(self.buf) > 0
+
+    def _sim_next_us(self):
+        return self.events[0][0] if self.events else None
+
+    def read(self, n=-1):
+        self._pump()
+        if n < 0:
+            n = len(self.buf)
+        data, self.buf = self.buf[:n], self.buf[n:]
+        return data
+
+
+def install_gc_shim(heap_size=110000):
+    # CPython's gc has no heap counters, tracemalloc stands in when running
+    if hasattr(gc, 'mem_alloc'):
+        return
+    import tracemalloc
+
+    def mem_alloc():
+        return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+
+    gc.mem_alloc = mem_alloc
+    gc.mem_free = lambda: max(0, heap_size - mem_alloc())
+
+
+def load_firmware(path, workdir, settings):
+    # Fresh stand-ins, then import the firmware as a module without running main()
+    utime._reset()
+    machine._sim_reset()
+    ubluetooth._sim_reset()
+    uasyncio.new_event_loop()
+    uasyncio.stop_at_us = None
+    firmware_dir = os.path.dirname(os.path.abspath(path))
+    if firmware_dir not in sys.path:
+        sys.path.insert(1, firmware_dir)  # loko_packet.py and friends
+    os.chdir(workdir)
+    with open('settings.json', 'w') as f:
+        json.dump(settings, f)
+    spec = importlib.util.spec_from_file_location('loko_ground', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_trace(formats, count, interval_ms, burst, seed, trackers=0, jitter_ms=0):
+    # Every packet gets its own id1 so its notify can be found again. With
+    # trackers, that many trackers send in turn, each one format and count
+    # packets every trackers * interval_ms, give or take jitter_ms, walking
+    # a few meters between packets.
+    rnd = random.Random(seed)
+    events = []
+    if trackers:
+        walk = [[lat, lon, rnd.randint(0, 2000), 4200] for lat, lon in tracker_starts(trackers, seed)]
+        for n in range(count):
+            for i in range(trackers):
+                t_ms = (n * trackers + i) * interval_ms + rnd.uniform(-jitter_ms, jitter_ms)
+                state = walk[i]
+                state[0] += rnd.uniform(-0.0002, 0.0002)
+                state[1] += rnd.uniform(-0.0002, 0.0002)
+                state[2] = max(0, state[2] + rnd.randint(-3, 3))
+                if rnd.random() < 0.05:
+                    state[3] -= 100
+                payload = loko_trace.make_payload(
+                    formats[i % len(formats)], i + 1, STATION_ID2, state[0], state[1],
+                    alt=state[2], mps=rnd.randint(0, 3), vbat_mv=state[3], key=KEY)
+                events.append((max(0, int(t_ms)), loko_trace.module_lines(payload, -60, 5)))
+        events.sort(key=lambda e: e[0])
+        return events
+    id1 = 1
+    t_ms = 0
+    for _ in range(count):
+        for fmt in formats:
+            lines = b''
+            for _ in range(burst):
+                payload = loko_trace.make_payload(
+                    fmt, id1, STATION_ID2, rnd.uniform(-80, 80), rnd.uniform(-179, 179),
+                    alt=rnd.randint(0, 3000), mps=rnd.randint(0, 40),
+                    vbat_mv=rnd.randint(3300, 4200), key=KEY)
+                lines += loko_trace.module_lines(payload, rnd.randint(-120, -30), rnd.randint(-15, 12))
+                id1 += 1
+            events.append((t_ms, lines))
+            t_ms += interval_ms
+    return events
+
+
+def tracker_starts(trackers, seed):
+    rnd = random.Random(seed + 1)
+    return [(rnd.uniform(-60, 60), rnd.uniform(-170, 170)) for _ in range(trackers)]
+
+
+def synthetic_fences(count, trackers, seed):
+    # 'fences' setting with count circles and polygons of 20 to 400 m
+    # scattered within 3 km of where the trackers start, every third one
+    # for a single tracker
+    rnd = random.Random(seed + 2)
+    starts = tracker_starts(max(1, trackers), seed)
+    fences = {}
+    for num in range(1, count + 1):
+        i = rnd.randrange(len(starts))
+        lat = starts[i][0] + rnd.uniform(-0.03, 0.03)
+        lon = starts[i][1] + rnd.uniform(-0.03, 0.03)
+        radius = rnd.randint(20, 400)
+        if num % 2:
+            fence = {'c': [round(lat * 1e6), round(lon * 1e6), radius]}
+        else:
+            corners = rnd.randint(3, 8)
+            fence = {'p': []}
+            for k in range(corners):
+                angle = 2 * math.pi * k / corners
+                r = radius * rnd.uniform(0.5, 1.0) / 111195
+                fence['p'].append([round((lat + r * math.sin(angle)) * 1e6),
+                                   round((lon + r * math.cos(angle) / math.cos(math.radians(lat))) * 1e6)])
+        if num % 3 == 0:
+            fence['ids'] = ['{}:{}'.format(i + 1, STATION_ID2)]
+        fences[str(num)] = fence
+    return fences
+
+
+def fence_events(notifies, binary):
+    # (enter, exit) events that reached the central
+    counts = [0, 0, 0]
+    buf = b''
+    for _, _, data in notifies:
+        buf += data
+        while buf:
+            if binary:
+                if len(buf) < 8 or len(buf) < frame_size(buf):
+                    break
+                if buf[0] == 6:
+                    counts[buf[3]] += 1
+                buf = buf[frame_size(buf):]
+                continue
+            if b'\n' not in buf:
+                break
+            line, buf = buf.split(b'\n', 1)
+            if line.startswith(b'F,'):
+                counts[1 if line.split(b',')[1] == b'enter' else 2] += 1
+    return counts[1], counts[2]
+
+
+def schedule(events):
+    # (arrival_us after start, lines, [(fmt, id1)], (air start, air end));
+    # the packets were on air just before t_ms, a packet is complete once
+    # its last byte has crossed the UART
+    out = []
+    line_us = 0
+    for t_ms, lines in events:
+        start_us = max(t_ms * 1000, line_us)
+        line_us = start_us + len(lines) * 10 * 1000000 // BAUD
+        packets = []
+        air_us = 0
+        for line in lines.split(b'\n'):
+            payload = loko_trace.rx_payload(line)
+            if payload:
+                air_us += loko_trace.airtime_us(len(payload))
+            ids = payload and loko_trace.payload_ids(payload)
+            if ids:
+                packets.append((loko_trace.classify(payload), ids[0]))
+        out.append((line_us, lines, packets, (t_ms * 1000 - air_us, t_ms * 1000)))
+    return out
+
+
+def frame_size(buf):
+    return {0: 4, 1: 31, 2: 7, 3: 4 + buf[3], 4: 8 + 32 * buf[7] if len(buf) > 7 else 8,
+            5: 7, 6: 24}.get(buf[0], len(buf))
+
+
+def exported(notifies, binary):
+    # (records, first log seq, next log seq, bytes, first_us, last_us) of a BLE log export
+    records = nbytes = 0
+    first_q = next_q = None
+    first_us = last_us = 0
+    buf = b''
+    for t_us, _, data in notifies:
+        buf += data
+        while buf:
+            if binary:
+                if len(buf) < 8 or len(buf) < frame_size(buf):
+                    break
+                size = frame_size(buf)
+                if buf[0] == 4:
+                    q, num = int.from_bytes(buf[3:7], 'little'), buf[7]
+                elif buf[0] == 5:
+                    q, num = None, 0
+                    next_q = int.from_bytes(buf[3:7], 'little')
+                else:
+                    buf = buf[size:]
+                    continue
+                frame, buf = buf[:size], buf[size:]
+            else:
+                if b'\n' not in buf:
+                    break
+                frame, buf = buf.split(b'\n', 1)
+                if not frame.startswith(b'L,'):
+                    continue
+                fields = frame.split(b',')
+                if fields[1] == b'end':
+                    q, num, next_q = None, 0, int(fields[2])
+                else:
+                    q, num = int(fields[1]), 1
+            if first_q is None and q is not None:
+                first_q, first_us = q, t_us
+            records += num
+            nbytes += len(frame)
+            last_us = t_us
+    return records, first_q, next_q, nbytes, first_us, last_us
+
+
+def received_ids(notifies, binary):
+    # (time_us, id1) for every position that reached the central
+    found = []
+    buf = b''
+    for t_us, _, data in notifies:
+        buf += data
+        if binary:
+            while len(buf) >= 4:
+                if buf[0] == 4 and len(buf) < 8:
+                    break
+                size = frame_size(buf)
+                if len(buf) < size:
+                    break
+                if buf[0] == 1:
+                    found.append((t_us, int.from_bytes(buf[3:7], 'little')))
+                buf = buf[size:]
+            continue
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            fields = line.split(b',')
+            if len(fields) >= 3:
+                try:
+                    found.append((t_us, int(fields[0])))
+                except ValueError:
+                    pass
+    return found
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(args):
+    install_gc_shim()
+    if args.trace:
+        events = loko_trace.read_trace(args.trace, args.interval)
+    else:
+        events = synthetic_trace(args.formats, args.count, args.interval, args.burst, args.seed,
+                                 args.trackers, args.jitter)
+    timeline = schedule(events)
+    settings = {'id2': STATION_ID2, 'p2p_key': KEY.hex(), 'rx_sleep': args.rx_sleep}
+    if args.fences:
+        settings['fences'] = synthetic_fences(args.fences, args.trackers, args.seed)
+
+    args.firmware = os.path.abspath(args.firmware)
+    workdir = tempfile.mkdtemp(prefix='loko_sim_')
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    captured = io.StringIO()
+    console = Console()
+    sys.stdin = console
+    fw = load_firmware(args.firmware, workdir, settings)
+    utime.cpu_scale = args.cpu_scale
+    start = {}
+
+    async def connect(ble):
+        # Central connects, exchanges the MTU and optionally asks for binary frames
+        ble._sim_connect()
+        await uasyncio.sleep_ms(50)
+        ble._sim_mtu(args.mtu)
+        # A CSV central asks for geofence events, a binary one gets them anyway
+        extra = ['fmt bin'] if args.binary else ['events on'] if args.fences else []
+        for text in args.write + extra:
+            ble._sim_write(ble._sim_handle(ubluetooth.FLAG_WRITE), text.encode())
+            await uasyncio.sleep_ms(50)
+
+    async def sleep_until(at_us):
+        await uasyncio.sleep_ms(max(0, (at_us - utime.ticks_us()) // 1000))
+
+    async def press(at_ms, hold_ms):
+        # Contacts bounce for a few ms on press and release
+        await sleep_until(start['us'] + at_ms * 1000)
+        for level in (0, 1, 0, 1, 0):
+            fw.BUTTON._sim_set(level)
+            await uasyncio.sleep_ms(2)
+        await uasyncio.sleep_ms(hold_ms)
+        for level in (1, 0, 1):
+            fw.BUTTON._sim_set(level)
+            await uasyncio.sleep_ms(2)
+
+    async def scenario():
+        # The central is connected before the first packet; the trace starts after boot
+        while not ubluetooth.instances:
+            await uasyncio.sleep_ms(1)
+        start['us'] = utime.ticks_us() + 500000
+        ble = ubluetooth.instances[0]
+        await connect(ble)
+        uart = machine.uarts[UART_ID]
+        for at_us, lines, _, air in timeline:
+            uart._sim_feed(lines, start['us'] + at_us, (start['us'] + air[0], start['us'] + air[1]))
+        end_us = start['us'] + (timeline[-1][0] if timeline else 0) + SETTLE_MS * 1000
+        for at_ms, hold_ms in args.press:
+            uasyncio.create_task(press(at_ms, hold_ms))
+        if args.drop:
+            await sleep_until(start['us'] + args.drop[0] * 1000)
+            ble._sim_disconnect()
+            await sleep_until(start['us'] + args.drop[1] * 1000)
+            await connect(ble)
+            end_us = max(end_us, utime.ticks_us() + SETTLE_MS * 1000)
+        for i, command in enumerate(args.console):
+            console.feed(command + '\r', end_us + i * 200000)
+        uasyncio.stop_at_us = end_us + len(args.console) * 200000 + 500000
+        if args.write_end:
+            uasyncio.stop_at_us += args.settle * 1000
+            await sleep_until(end_us)
+            for text in args.write_end:
+                ble._sim_write(ble._sim_handle(ubluetooth.FLAG_WRITE), text.encode())
+                await uasyncio.sleep_ms(200)
+        if args.console:
+            await uasyncio.sleep_ms((end_us - utime.ticks_us()) // 1000 - 1)
+            start['console'] = len(captured.getvalue())
+
+    uasyncio.on_run.append(scenario)
+    # Safety net in case the scenario never gets to set the real end
+    uasyncio.stop_at_us = (timeline[-1][0] if timeline else 0) + 120000000
+    if not args.verbose:
+        sys.stdout = captured
+    try:
+        fw.main()
+    except uasyncio.SimulationEnd:
+        pass
+    finally:
+        sys.stdout = stdout
+        utime.cpu_scale = 0.0
+        os.chdir(cwd)
+
+    if args.console:
+        print(captured.getvalue()[start.get('console', 0):])
+    notifies = ubluetooth.instances[0].notifies
+    report(timeline, start.get('us', 0), notifies, args.binary)
+    records, first_q, next_q, nbytes, first_us, last_us = exported(notifies, args.binary)
+    if records:
+        span_s = max(1e-6, (last_us - first_us) / 1000000)
+        print('export    {} records from seq {}, resume at {}, {} bytes in {:.2f} s, {:.1f} kB/s'.format(
+            records, first_q, next_q, nbytes, span_s, nbytes / span_s / 1000))
+    if args.fences:
+        print('geofence events received: {} enter, {} exit'.format(*fence_events(notifies, args.binary)))
+    if args.rx_sleep:
+        uart = machine.uarts[UART_ID]
+        span_us = max(1, utime.ticks_us() - start.get('us', 0))
+        print('radio listening {:.0f}% of {:.0f} s, {} packets on air while it slept, '
+              'ESP32 light sleep {:.0f} s'.format(
+                  uart.listening_us(utime.ticks_us()) * 100 / utime.ticks_us(), span_us / 1000000,
+                  uart.unheard, sum(ms for _, ms in machine.sleeps) / 1000))
+
+
+def report(timeline, start_us, notifies, binary):
+    pending = {}  # id1 -> [(arrival_us, fmt)] in arrival order
+    order = []
+    for at_us, _, packets, _ in timeline:
+        for fmt, id1 in packets:
+            pending.setdefault(id1, []).append((start_us + at_us, fmt))
+            if fmt not in order:
+                order.append(fmt)
+    latency = {fmt: [] for fmt in order}
+    sent = {fmt: 0 for fmt in order}
+    for waiting in pending.values():
+        for _, fmt in waiting:
+            sent[fmt] += 1
+    last_us = start_us
+    for t_us, id1 in received_ids(notifies, binary):
+        waiting = pending.get(id1)
+        if not waiting or waiting[0][0] > t_us:
+            continue
+        # Latest copy heard before the notify; older unmatched copies of the
+        # same tracker were dropped, e.g. as duplicates
+        match = 0
+        while match + 1 < len(waiting) and waiting[match + 1][0] <= t_us:
+            match += 1
+        arrival_us, fmt = waiting[match]
+        del waiting[:match + 1]
+        latency[fmt].append((t_us - arrival_us) / 1000)
+        last_us = max(last_us, t_us)
+
+    print('{:<9} {:>6} {:>6} {:>6} {:>9} {:>9} {:>9}'.format(
+        'format', 'sent', 'fwd', 'lost', 'mean ms', 'p95 ms', 'max ms'))
+    total_sent = total_fwd = 0
+    for fmt in order:
+        values = latency[fmt]
+        total_sent += sent[fmt]
+        total_fwd += len(values)
+        if values:
+            stats = (sum(values) / len(values), percentile(values, 95), max(values))
+        else:
+            stats = (0, 0, 0)
+        print('{:<9} {:>6} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            fmt, sent[fmt], len(values), sent[fmt] - len(values), *stats))
+    span_s = max(1e-6, (last_us - start_us) / 1000000)
+    print('total     {:>6} {:>6} {:>6}   {:.1f} pkt/s forwarded over {:.1f} s'.format(
+        total_sent, total_fwd, total_sent - total_fwd, total_fwd / span_s, span_s))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay LoRa traffic through the ground firmware')
+    parser.add_argument('--firmware', default=FIRMWARE)
+    parser.add_argument('--trace', help='trace file, see loko_trace.py for the format')
+    parser.add_argument('--formats', default=','.join(loko_trace.FORMATS))
+    parser.add_argument('--count', type=int, default=20, help='packets per format')
+    parser.add_argument('--interval', type=int, default=1000, help='ms between packets')
+    parser.add_argument('--burst', type=int, default=1, help='packets arriving back to back')
+    parser.add_argument('--cpu-scale', type=float, default=20.0,
+                        help='count host CPU time this many times in the virtual clock, '
+                             'about 20 for an ESP32 against a desktop, 0 for a fully virtual clock')
+    parser.add_argument('--trackers', type=int, default=0,
+                        help='this many trackers with a fixed period instead of one packet per id1')
+    parser.add_argument('--jitter', type=int, default=0, help='ms, random offset of every --trackers packet')
+    parser.add_argument('--rx-sleep', action='store_true', help='turn on the rx_sleep setting')
+    parser.add_argument('--fences', type=int, default=0, help='this many geofences near the --trackers')
+    parser.add_argument('--mtu', type=int, default=247)
+    parser.add_argument('--binary', action='store_true', help='central asks for binary frames')
+    parser.add_argument('--write', action='append', default=[], help='text the central writes to RX after connecting')
+    parser.add_argument('--drop', help='START_MS,END_MS the central is disconnected, from the first packet')
+    parser.add_argument('--press', action='append', default=[],
+                        help='AT_MS,HOLD_MS press the button, from the first packet')
+    parser.add_argument('--write-end', action='append', default=[],
+                        help='text the central writes to RX after the trace, e.g. export')
+    parser.add_argument('--settle', type=int, default=SETTLE_MS, help='ms to keep running after --write-end')
+    parser.add_argument('--console', action='append', default=[], help='console command to run at the end')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='show firmware output')
+    args = parser.parse_args()
+    args.formats = [fmt for fmt in args.formats.split(',') if fmt]
+    if args.drop:
+        args.drop = [int(ms) for ms in args.drop.split(',')]
+    args.press = [[int(ms) for ms in press.split(',')] for press in args.press]
+    for fmt in args.formats:
+        if fmt not in loko_trace.FORMATS:
+            parser.error('unknown format ' + fmt)
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,363 @@
+# Cooperative scheduler with the subset of the MicroPython uasyncio API that
+# the ground firmware uses. It runs on the virtual clock from utime: when no
+# task is ready the clock jumps straight to the next timer or scripted I/O
+# event, so hours of simulated traffic replay in a fraction of a second.
+import heapq
+import traceback
+import utime
+
+
+class CancelledError(BaseException):
+    pass
+
+
+class TimeoutError(Exception):
+    pass
+
+
+class SimulationEnd(Exception):
+    # Raised out of run() once the virtual clock reaches stop_at_us
+    pass
+
+
+stop_at_us = None
+on_run = []  # coroutine functions started next to the main task by run()
+_ready = []
+_sleepers = []
+_io_waiters = []
+_seq = 0
+_current = None
+
+
+class _Request():
+    __slots__ = ('kind', 'arg', 'wake_us')
+
+    def __init__(self, kind, arg=None, wake_us=None):
+        self.kind = kind
+        self.arg = arg
+        self.wake_us = wake_us
+
+    def __await__(self):
+        return (yield self)
+
+
+class Task():
+
+    def __init__(self, coro):
+        self.coro = coro
+        self.done_flag = False
+        self.result = None
+        self.exception = None
+        self.joiners = []
+        self.parked_on = None  # list the task is waiting in, if any
+        self.token = 0  # bumped on every wakeup to invalidate stale timers
+
+    def done(self):
+        return self.done_flag
+
+    def cancel(self):
+        if self.done_flag:
+            return False
+        _wake(self, exc=CancelledError())
+        return True
+
+    def __await__(self):
+        if not self.done_flag:
+            yield _Request('join', self)
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+def _wake(task, value=None, exc=None):
+    if task.parked_on is not None:
+        try:
+            task.parked_on.remove(task)
+        except ValueError:
+            pass
+        task.parked_on = None
+    task.token += 1
+    _ready.append((task, value, exc))
+
+
+def _park(task, waiters):
+    task.parked_on = waiters
+    waiters.append(task)
+
+
+def _sleep_until(task, wake_us):
+    global _seq
+    _seq += 1
+    heapq.heappush(_sleepers, (wake_us, _seq, task, task.token))
+
+
+def _finish(task, result=None, exc=None):
+    task.done_flag = True
+    task.result = result
+    task.exception = exc
+    for joiner in task.joiners:
+        _wake(joiner)
+    if exc is not None and not task.joiners and not isinstance(exc, CancelledError):
+        print('Task exception wasn\'t retrieved:')
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+    task.joiners = []
+
+
+def _step(task, value, exc):
+    global _current
+    if task.done_flag:
+        return
+    _current = task
+    utime._cpu_begin()
+    try:
+        if exc is not None:
+            req = task.coro.throw(exc)
+        else:
+            req = task.coro.send(value)
+    except StopIteration as e:
+        _finish(task, e.value)
+        return
+    except CancelledError as e:
+        _finish(task, exc=e)
+        return
+    except (SystemExit, KeyboardInterrupt, SimulationEnd):
+        raise
+    except Exception as e:
+        _finish(task, exc=e)
+        return
+    finally:
+        _current = None
+        utime._cpu_end()
+
+    if req is None or req.kind == 'yield':
+        _ready.append((task, None, None))
+    elif req.kind == 'sleep':
+        _sleep_until(task, req.wake_us)
+    elif req.kind == 'park':
+        _park(task, req.arg)
+    elif req.kind == 'read':
+        _park(task, _io_waiters)
+        task.io_stream = req.arg
+    elif req.kind == 'join':
+        target = req.arg
+        if target.done_flag:
+            _ready.append((task, None, None))
+        else:
+            _park(task, target.joiners)
+            if req.wake_us is not None:
+                _sleep_until(task, req.wake_us)
+    else:
+        raise RuntimeError('bad request ' + repr(req.kind))
+
+
+def _poll_io():
+    for task in list(_io_waiters):
+        if task.io_stream._sim_ready():
+            _wake(task)
+
+
+def _next_event_us():
+    times = []
+    if _sleepers:
+        times.append(_sleepers[0][0])
+    for task in _io_waiters:
+        t = task.io_stream._sim_next_us()
+        if t is not None:
+            times.append(t)
+    return min(times) if times else None
+
+
+def _run_until_complete(main_task):
+    while not main_task.done_flag:
+        while _ready:
+            task, value, exc = _ready.pop(0)
+            _step(task, value, exc)
+            if main_task.done_flag:
+                break
+        if main_task.done_flag:
+            break
+        _poll_io()
+        if _ready:
+            continue
+        now = utime.ticks_us()
+        wake_us = _next_event_us()
+        if wake_us is None:
+            raise SimulationEnd('no more events')
+        if stop_at_us is not None and wake_us > stop_at_us:
+            utime._advance_us(stop_at_us - now)
+            raise SimulationEnd('stop time reached')
+        utime._advance_us(wake_us - now)
+        now = utime.ticks_us()
+        while _sleepers and _sleepers[0][0] <= now:
+            _, _, task, token = heapq.heappop(_sleepers)
+            if token == task.token and not task.done_flag:
+                _wake(task)
+    if main_task.exception is not None:
+        raise main_task.exception
+    return main_task.result
+
+
+def new_event_loop():
+    global _ready, _sleepers, _io_waiters
+    _ready = []
+    _sleepers = []
+    _io_waiters = []
+    on_run.clear()
+
+
+def create_task(coro):
+    task = Task(coro)
+    _ready.append((task, None, None))
+    return task
+
+
+def current_task():
+    return _current
+
+
+def run(coro):
+    main_task = create_task(coro)
+    for func in on_run:
+        create_task(func())
+    return _run_until_complete(main_task)
+
+
+async def sleep_ms(ms):
+    await _Request('sleep', wake_us=utime.ticks_us() + max(0, int(ms)) * 1000)
+
+
+async def sleep(s):
+    await _Request('sleep', wake_us=utime.ticks_us() + max(0, int(s * 1000000)))
+
+
+async def wait_for_ms(aw, timeout_ms):
+    task = aw if isinstance(aw, Task) else create_task(aw)
+    if not task.done_flag:
+        await _Request('join', task, utime.ticks_us() + int(timeout_ms) * 1000)
+    if not task.done_flag:
+        task.cancel()
+        raise TimeoutError()
+    if task.exception is not None:
+        raise task.exception
+    return task.result
+
+
+async def wait_for(aw, timeout):
+    return await wait_for_ms(aw, timeout * 1000)
+
+
+async def gather(*aws, return_exceptions=False):
+    tasks = [aw if isinstance(aw, Task) else create_task(aw) for aw in aws]
+    results = []
+    for task in tasks:
+        try:
+            results.append(await task)
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+class Event():
+
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def is_set(self):
+        return self.state
+
+    def set(self):
+        self.state = True
+        for task in list(self.waiting):
+            _wake(task)
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if not self.state:
+            await _Request('park', self.waiting)
+        return True
+
+
+class ThreadSafeFlag():
+
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def set(self):
+        self.state = True
+        for task in list(self.waiting):
+            _wake(task)
+
+    def clear(self):
+        self.state = False
+
+    async def wait(self):
+        if not self.state:
+            await _Request('park', self.waiting)
+        self.state = False
+
+
+class Lock():
+
+    def __init__(self):
+        self.state = False
+        self.waiting = []
+
+    def locked(self):
+        return self.state
+
+    async def acquire(self):
+        while self.state:
+            await _Request('park', self.waiting)
+        self.state = True
+        return True
+
+    def release(self):
+        self.state = False
+        if self.waiting:
+            _wake(self.waiting[0])
+
+    async def __aenter__(self):
+        return await self.acquire()
+
+    async def __aexit__(self, *args):
+        self.release()
+
+
+class StreamReader():
+    # Wraps any object with read/readinto/readline plus the _sim_ready and
+    # _sim_next_us hooks that the stand-in UART and console provide
+
+    def __init__(self, s):
+        self.s = s
+
+    async def _wait(self):
+        if not self.s._sim_ready():
+            await _Request('read', self.s)
+
+    async def read(self, n=-1):
+        await self._wait()
+        return self.s.read(n)
+
+    async def readinto(self, buf):
+        await self._wait()
+        return self.s.readinto(buf)
+
+    async def readline(self):
+        await self._wait()
+        return self.s.readline()
+
+    def write(self, data):
+        self.s.write(data)
+
+    async def drain(self):
+        pass
+
+
+Stream = StreamReader
+StreamWriter = StreamReader
@@ -0,0 +1,116 @@
+# Stand-in BLE peripheral. Notifies are recorded with their virtual
+# timestamp; connects, writes and MTU exchanges are injected by the harness.
+import utime
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+instances = []
+
+
+def _sim_reset():
+    del instances[:]
+
+
+class UUID():
+
+    def __init__(self, value):
+        self.value = value
+
+    def __repr__(self):
+        return 'UUID({!r})'.format(self.value)
+
+
+class BLE():
+
+    def __init__(self):
+        self.handler = None
+        self.values = {}
+        self.flags = {}  # characteristic handle -> flags
+        self.notifies = []  # (time_us, conn_handle, data)
+        self.adverts = 0
+        self.mtu = 23
+        self.fail_notifies = 0  # the next N notifies raise OSError
+        self.max_notify = None  # raise OSError above this payload size
+        self.is_active = False
+        instances.append(self)
+
+    def active(self, state=None):
+        if state is not None:
+            self.is_active = bool(state)
+        return self.is_active
+
+    def config(self, *args, **kwargs):
+        if args:
+            if args[0] == 'mtu':
+                return self.mtu
+            if args[0] == 'mac':
+                return (0, b'\x24\x6f\x28\x00\x00\x02')
+            return None
+        if 'mtu' in kwargs:
+            self.mtu = kwargs['mtu']
+
+    def irq(self, handler):
+        self.handler = handler
+
+    def gatts_register_services(self, services):
+        handles = []
+        next_handle = 1
+        for _, chars in services:
+            service_handles = []
+            for _, flags in chars:
+                service_handles.append(next_handle)
+                self.values[next_handle] = b''
+                self.flags[next_handle] = flags
+                next_handle += 1
+            handles.append(tuple(service_handles))
+        return tuple(handles)
+
+    def gatts_read(self, handle):
+        return self.values.get(handle, b'')
+
+    def gatts_write(self, handle, data, send_update=False):
+        self.values[handle] = bytes(data)
+
+    def gatts_notify(self, conn_handle, handle, data=None):
+        if data is None:
+            data = self.values.get(handle, b'')
+        if isinstance(data, str):
+            data = data.encode()
+        if self.fail_notifies > 0:
+            self.fail_notifies -= 1
+            raise OSError(-12)
+        if self.max_notify is not None and len(data) > self.max_notify:
+            raise OSError(-22)
+        self.notifies.append((utime.ticks_us(), conn_handle, bytes(data)))
+
+    def gap_advertise(self, interval_us, adv_data=None, **kwargs):
+        self.adverts += 1
+
+    def gap_disconnect(self, conn_handle):
+        self._sim_disconnect(conn_handle)
+        return True
+
+    def _sim_handle(self, flag):
+        # First characteristic with the given flag, e.g. the NUS RX one
+        for handle in sorted(self.flags):
+            if self.flags[handle] & flag:
+                return handle
+        return None
+
+    def _sim_connect(self, conn_handle=0):
+        self.handler(1, (conn_handle, 0, b'\x00' * 6))
+
+    def _sim_disconnect(self, conn_handle=0):
+        self.handler(2, (conn_handle, 0, b'\x00' * 6))
+
+    def _sim_mtu(self, mtu, conn_handle=0):
+        self.mtu = mtu
+        self.handler(21, (conn_handle, mtu))
+
+    def _sim_write(self, handle, data, conn_handle=0):
+        self.values[handle] = bytes(data)
+        self.handler(3, (conn_handle, handle))
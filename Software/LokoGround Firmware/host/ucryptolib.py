@@ -0,0 +1,131 @@
+# Pure Python AES for the stand-in 'aes' class. Only ECB mode (1) is used
+# by the firmware. Slow, but exact and free of third party packages.
+
+_SBOX = []
+_INV_SBOX = [0] * 256
+
+
+def _xtime(a):
+    a <<= 1
+    return (a ^ 0x11B) & 0xFF if a & 0x100 else a
+
+
+def _mul(a, b):
+    r = 0
+    while b:
+        if b & 1:
+            r ^= a
+        a = _xtime(a)
+        b >>= 1
+    return r
+
+
+def _init_tables():
+    # Multiplicative inverse followed by the AES affine transform
+    inv = [0] * 256
+    for a in range(1, 256):
+        for b in range(1, 256):
+            if _mul(a, b) == 1:
+                inv[a] = b
+                break
+    for a in range(256):
+        x = inv[a]
+        s = x
+        for _ in range(4):
+            x = ((x << 1) | (x >> 7)) & 0xFF
+            s ^= x
+        _SBOX.append(s ^ 0x63)
+    for i, v in enumerate(_SBOX):
+        _INV_SBOX[v] = i
+
+
+_init_tables()
+_MUL9 = [_mul(i, 9) for i in range(256)]
+_MUL11 = [_mul(i, 11) for i in range(256)]
+_MUL13 = [_mul(i, 13) for i in range(256)]
+_MUL14 = [_mul(i, 14) for i in range(256)]
+_MUL2 = [_mul(i, 2) for i in range(256)]
+_MUL3 = [_mul(i, 3) for i in range(256)]
+
+
+def _expand_key(key):
+    nk = len(key) // 4
+    if nk not in (4, 6, 8):
+        raise ValueError('key')
+    rounds = nk + 6
+    words = [list(key[i * 4:i * 4 + 4]) for i in range(nk)]
+    rcon = 1
+    for i in range(nk, 4 * (rounds + 1)):
+        t = list(words[i - 1])
+        if i % nk == 0:
+            t = t[1:] + t[:1]
+            t = [_SBOX[b] for b in t]
+            t[0] ^= rcon
+            rcon = _xtime(rcon)
+        elif nk > 6 and i % nk == 4:
+            t = [_SBOX[b] for b in t]
+        words.append([a ^ b for a, b in zip(words[i - nk], t)])
+    return [sum(words[r * 4:r * 4 + 4], []) for r in range(rounds + 1)]
+
+
+def _encrypt_block(rk, block):
+    s = [b ^ k for b, k in zip(block, rk[0])]
+    rounds = len(rk) - 1
+    for r in range(1, rounds + 1):
+        s = [_SBOX[b] for b in s]
+        s = [s[(i + 4 * (i % 4)) % 16] for i in range(16)]
+        if r != rounds:
+            m = []
+            for c in range(4):
+                a0, a1, a2, a3 = s[c * 4:c * 4 + 4]
+                m += [_MUL2[a0] ^ _MUL3[a1] ^ a2 ^ a3,
+                      a0 ^ _MUL2[a1] ^ _MUL3[a2] ^ a3,
+                      a0 ^ a1 ^ _MUL2[a2] ^ _MUL3[a3],
+                      _MUL3[a0] ^ a1 ^ a2 ^ _MUL2[a3]]
+            s = m
+        s = [b ^ k for b, k in zip(s, rk[r])]
+    return bytes(s)
+
+
+def _decrypt_block(rk, block):
+    rounds = len(rk) - 1
+    s = [b ^ k for b, k in zip(block, rk[rounds])]
+    for r in range(rounds - 1, -1, -1):
+        s = [s[(i - 4 * (i % 4)) % 16] for i in range(16)]
+        s = [_INV_SBOX[b] for b in s]
+        s = [b ^ k for b, k in zip(s, rk[r])]
+        if r != 0:
+            m = []
+            for c in range(4):
+                a0, a1, a2, a3 = s[c * 4:c * 4 + 4]
+                m += [_MUL14[a0] ^ _MUL11[a1] ^ _MUL13[a2] ^ _MUL9[a3],
+                      _MUL9[a0] ^ _MUL14[a1] ^ _MUL11[a2] ^ _MUL13[a3],
+                      _MUL13[a0] ^ _MUL9[a1] ^ _MUL14[a2] ^ _MUL11[a3],
+                      _MUL11[a0] ^ _MUL13[a1] ^ _MUL9[a2] ^ _MUL14[a3]]
+            s = m
+    return bytes(s)
+
+
+class aes():
+
+    def __init__(self, key, mode, iv=None):
+        if mode != 1:
+            raise ValueError('only ECB mode is simulated')
+        self.rk = _expand_key(bytes(key))
+
+    def _run(self, func, data, out):
+        data = bytes(data)
+        if len(data) % 16:
+            raise ValueError('blksize')
+        result = b''.join(func(self.rk, data[i:i + 16])
+                          for i in range(0, len(data), 16))
+        if out is not None:
+            out[:len(result)] = result
+            return None
+        return result
+
+    def encrypt(self, data, out=None):
+        return self._run(_encrypt_block, data, out)
+
+    def decrypt(self, data, out=None):
+        return self._run(_decrypt_block, data, out)
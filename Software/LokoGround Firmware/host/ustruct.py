@@ -0,0 +1,59 @@
+# MicroPython's ustruct. pack() does not range check integers there, it
+# keeps the low bytes of the field, so values are truncated the same way
+# here instead of raising like CPython. What MicroPython does raise, e.g.
+# for a buffer too small for the format, is ValueError where CPython
+# raises struct.error.
+import struct as _struct
+
+calcsize = _struct.calcsize
+
+_INT_SIZES = {'b': 1, 'B': 1, 'h': 2, 'H': 2, 'i': 4, 'I': 4, 'l': 4, 'L': 4, 'q': 8, 'Q': 8}
+
+
+def _truncate(fmt, values):
+    values = list(values)
+    i = 0
+    count = ''
+    for code in fmt.lstrip('<>!=@'):
+        if code.isdigit():
+            count += code
+            continue
+        n = 1 if code == 's' else 0 if code == 'x' else int(count or 1)
+        count = ''
+        for _ in range(n):
+            if code in _INT_SIZES and i < len(values) and isinstance(values[i], int):
+                bits = _INT_SIZES[code] * 8
+                value = values[i] & ((1 << bits) - 1)
+                if code.islower() and value >> (bits - 1):
+                    value -= 1 << bits
+                values[i] = value
+            i += 1
+    return values
+
+
+def pack(fmt, *values):
+    try:
+        return _struct.pack(fmt, *_truncate(fmt, values))
+    except _struct.error as e:
+        raise ValueError(str(e))
+
+
+def pack_into(fmt, buffer, offset, *values):
+    try:
+        _struct.pack_into(fmt, buffer, offset, *_truncate(fmt, values))
+    except _struct.error as e:
+        raise ValueError(str(e))
+
+
+def unpack(fmt, data):
+    try:
+        return _struct.unpack(fmt, data)
+    except _struct.error as e:
+        raise ValueError(str(e))
+
+
+def unpack_from(fmt, data, offset=0):
+    try:
+        return _struct.unpack_from(fmt, data, offset)
+    except _struct.error as e:
+        raise ValueError(str(e))
@@ -0,0 +1,104 @@
+# Virtual clock stand-in for MicroPython's utime. Time only moves when the
+# simulated scheduler or a blocking sleep advances it, so runs are repeatable.
+# Optionally, CPU time spent inside uasyncio task steps is added to the
+# clock, scaled by cpu_scale, so latencies include the cost of the code.
+import time as _time
+
+_EPOCH_OFFSET = 946684800  # MicroPython counts seconds from 2000-01-01
+_now_us = 0
+_start_s = 0
+_cpu_start_ns = None
+cpu_scale = 0.0  # 0 = fully virtual, 1 = host speed, 20 = 20x slower than host
+
+
+def _reset():
+    global _now_us, _start_s, _cpu_start_ns
+    _now_us = 0
+    _start_s = 0
+    _cpu_start_ns = None
+
+
+def _advance_us(us):
+    global _now_us
+    if us > 0:
+        _now_us += us
+
+
+def _cpu_begin():
+    global _cpu_start_ns
+    if cpu_scale:
+        _cpu_start_ns = _time.perf_counter_ns()
+
+
+def _cpu_end():
+    global _cpu_start_ns
+    if _cpu_start_ns is not None:
+        _advance_us(_cpu_us())
+        _cpu_start_ns = None
+
+
+def _cpu_us():
+    if _cpu_start_ns is None:
+        return 0
+    return int((_time.perf_counter_ns() - _cpu_start_ns) * cpu_scale / 1000)
+
+
+def _set_wall_clock(seconds_since_2000):
+    global _start_s
+    _start_s = seconds_since_2000 - _now_us // 1000000
+
+
+def ticks_us():
+    return _now_us + _cpu_us()
+
+
+def ticks_ms():
+    return ticks_us() // 1000
+
+
+def ticks_cpu():
+    return ticks_us()
+
+
+def ticks_diff(a, b):
+    return a - b
+
+
+def ticks_add(a, b):
+    return a + b
+
+
+def sleep_ms(ms):
+    _advance_us(int(ms * 1000))
+
+
+def sleep_us(us):
+    _advance_us(int(us))
+
+
+def sleep(s):
+    _advance_us(int(s * 1000000))
+
+
+def time():
+    return _start_s + ticks_us() // 1000000
+
+
+def time_ns():
+    return (_start_s * 1000000 + ticks_us()) * 1000
+
+
+def localtime(secs=None):
+    if secs is None:
+        secs = time()
+    t = _time.gmtime(secs + _EPOCH_OFFSET)
+    return (t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec,
+            t.tm_wday, t.tm_yday)
+
+
+gmtime = localtime
+
+
+def mktime(t):
+    import calendar
+    return calendar.timegm(tuple(t[:6]) + (0, 0, 0)) - _EPOCH_OFFSET
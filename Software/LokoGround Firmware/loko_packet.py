@@ -0,0 +1,329 @@
+# Loko tracker wire formats: the LoRa-E5 module line, string and binary
+# packets, and the per-tracker AES keys. Kept apart from main so the
+# decoders can be benchmarked on a PC or the unix MicroPython port,
+# see host/bench_decode.py.
+from ucryptolib import aes
+import ustruct as struct
+import ubinascii
+
+verbose = True  # print decoded fields and decrypt failures
+# Packets that did not decode, by reason, for the 'stats' command
+failures = {'hex': 0, 'unknown': 0, 'key': 0, 'malformed': 0}
+ENCRYPTED = ('str_aes', 'bin25v2', 'bin25v5')  # formats that cost an AES decrypt
+
+
+def is_valid_key(key_hex):
+    return len(key_hex) == 64 and all(c in '0123456789abcdefABCDEF' for c in key_hex)
+
+
+class KEYRING():
+    # AES keys per tracker, (id1, id2) -> key, falling back to the global
+    # p2p_key. A ready ECB cipher is cached per distinct key so encrypted
+    # packets skip the key schedule. reload() picks up changes made by 'set'
+    # without a reboot.
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.reload()
+
+    def reload(self):
+        self.default = ubinascii.unhexlify(self.settings.data['p2p_key'])
+        self.keys = {}
+        for name, key_hex in self.settings.data['keys'].items():
+            id1, id2 = name.split(':')
+            self.keys[(int(id1), int(id2))] = ubinascii.unhexlify(key_hex)
+        self.ciphers = {}
+
+    def cipher(self, id1, id2):
+        key = self.keys.get((id1, id2), self.default)
+        cipher = self.ciphers.get(key)
+        if cipher is None:
+            # ECB keeps no state between blocks, one context serves every packet
+            cipher = aes(key, 1)  # 1 for ECB mode
+            self.ciphers[key] = cipher
+        return cipher
+
+
+class LOKO_PACKET():
+    # Decoded tracker fix. The decoders refill one shared instance instead of
+    # building a dict per packet, so copy the fields out if they have to
+    # outlive the next packet.
+    __slots__ = ('id1', 'id2', 'lat', 'lon', 'vbat', 'alt', 'mps', 'text', 'rssi', 'snr', 'fmt')
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.id1 = 0
+        self.id2 = 0
+        self.lat = 0  # int 1e-6 degrees, see e6_to_str() in main for text
+        self.lon = 0
+        self.vbat = 0
+        self.alt = None  # None when the format does not carry alt/speed
+        self.mps = None
+        self.text = None  # original text of string packets
+        self.fmt = None  # wire format name, e.g. 'str7' or 'bin25v5'
+        self.rssi = 0  # from the module line in front, set by the receiver
+        self.snr = 0
+
+
+LOKO_PACKET_RX = LOKO_PACKET()
+
+
+def vbat_to_mv(vbat):
+    # Binary packets and the battery ADC report volts, text packets mV
+    if isinstance(vbat, float):
+        return int(vbat * 1000 + 0.5)
+    return vbat
+
+
+def coord_to_e6(value):
+    # Degrees to integer micro degrees. Exact for the decimal strings of the
+    # text packets, which must not go through float; ints, what the
+    # decoders give, already are micro degrees. Raises ValueError for text that is not a plain decimal number
+    # and for values that do not fit the int32 of log records, e.g. NaN from
+    # a wrong key that passed the checksum.
+    if isinstance(value, int):
+        e6 = value
+    elif isinstance(value, str):
+        negative = value.startswith('-')
+        whole, _, frac = value[1:].partition('.') if negative else value.partition('.')
+        if not (whole or frac) or (whole and not whole.isdigit()) or (frac and not frac.isdigit()):
+            raise ValueError('bad coordinate ' + value)
+        e6 = int(whole or '0') * 1000000 + int((frac + '000000')[:6])
+        if negative:
+            e6 = -e6
+    else:
+        if not -2147.48 < value < 2147.48:  # False for NaN too
+            raise ValueError('bad coordinate {}'.format(value))
+        e6 = int(round(value * 1000000))
+    if not -0x80000000 <= e6 <= 0x7FFFFFFF:
+        raise ValueError('bad coordinate {}'.format(value))
+    return e6
+
+
+def is_ascii_printable(data):
+    for byte in data:
+        if byte < 32 or byte > 126:
+            return False
+    return True
+
+
+def decode_loko_payload(hex_payload, keyring, packet=LOKO_PACKET_RX):
+    # One hex decode, then the bytes themselves tell string and binary
+    # packets apart
+    try:
+        data = ubinascii.unhexlify(hex_payload)
+    except ValueError:
+        failures['hex'] += 1
+        return None
+    try:
+        if is_ascii_printable(data):
+            return parse_loko_string_packet(data.decode(), keyring, packet)
+        return parse_loko_bin_packet(data, keyring, packet)
+    except ValueError as e:
+        # Radio bit errors that survive the module CRC, e.g. letters in a number
+        failures['malformed'] += 1
+        if verbose:
+            print('Malformed packet:', e)
+        return None
+
+
+def parse_lora_module_message(message):
+    # expected one module line like: b'+TEST: RX \"30302C3030302C35302E3531313732352C33302E3739313934352C33393936\"'
+    # the '+TEST: LEN:31, RSSI:-35, SNR:12' line in front of it is ignored
+    try:
+        message = message.decode()
+    except AttributeError:
+        pass  # already str
+    except UnicodeError:
+        return None  # UART noise, not a line the module printed
+    line = message.split(" ")
+    if len(line) > 2 and line[-2] == 'RX':
+        received_data = line[-1][1:]
+        end_hex_data_pos = received_data.find('\"')
+        if end_hex_data_pos != -1:
+            received_data = received_data[0:end_hex_data_pos]
+            return received_data
+    return None
+
+
+def parse_lora_signal(message):
+    # b'+TEST: LEN:15, RSSI:-40, SNR:10' -> (-40, 10), None for other lines
+    if not message.startswith(b'+TEST: LEN:'):
+        return None
+    rssi = message.find(b'RSSI:')
+    snr = message.find(b'SNR:')
+    if rssi < 0 or snr < 0:
+        return None
+    try:
+        return (int(message[rssi + 5:message.find(b',', rssi)].decode()),
+                int(message[snr + 4:].decode()))
+    except ValueError:
+        return None
+
+
+def parse_loko_string_packet(string, keyring, packet=LOKO_PACKET_RX):
+    values = string.split(',')
+    if verbose:
+        print(values)
+    packet.clear()
+    packet.text = string
+    if len(values) == 5:
+        packet.fmt = 'str5'
+        # message : '123,321,40.376123,49.850848,3420'
+        packet.id1 = int(values[0])
+        packet.id2 = int(values[1])
+
+        # do not use float() result will round to five digit, ex: 50.511725 >>>> 50.51172 and 30.791945 >>>> 30.79195
+        # micro degrees straight from the text, a bit error raises ValueError here
+        packet.lat = coord_to_e6(values[2])
+        packet.lon = coord_to_e6(values[3])
+
+        packet.vbat = int(values[4])
+        return packet
+    if len(values) == 7:
+        packet.fmt = 'str7'
+        # message : '00,000,54.685349,25.282091,117,0,6432'
+        packet.id1 = int(values[0])
+        packet.id2 = int(values[1])
+
+        # do not use float() result will round to five digit, ex: 50.511725 >>>> 50.51172 and 30.791945 >>>> 30.79195
+        # micro degrees straight from the text, a bit error raises ValueError here
+        packet.lat = coord_to_e6(values[2])
+        packet.lon = coord_to_e6(values[3])
+        packet.alt = int(values[4])
+        packet.mps = int(values[5])
+
+        packet.vbat = int(values[6])
+        return packet
+    if len(values) == 3:
+        # message :'00,000,KsC72EMf5cAYJU8eATDTMg=='
+        id1 = int(values[0])
+        id2 = int(values[1])
+        base64 = values[2]
+        encrypted_bytes = ubinascii.a2b_base64(base64)
+
+        decrypted_bytes = keyring.cipher(id1, id2).decrypt(encrypted_bytes)
+        checksum = sum(decrypted_bytes[:-1]) % 256
+        lat, lon, vbat_mv, alt_meters, speed_mps, reserved1, integrity= struct.unpack(STR_AES_FORMAT, decrypted_bytes)
+        if checksum == integrity:
+            packet.id1 = id1
+            packet.id2 = id2
+            packet.lat = coord_to_e6(lat)
+            packet.lon = coord_to_e6(lon)
+            packet.vbat = vbat_mv
+            packet.alt = alt_meters
+            packet.mps = speed_mps
+            packet.fmt = 'str_aes'
+            return packet
+        else:
+            failures['key'] += 1
+            if verbose:
+                print('Can\'t decrypt, possible wrong key')
+        return None
+
+    failures['unknown'] += 1
+    return None
+
+# Decrypted block of 'id1,id2,base64' string packets: lat, lon, vbat (mV),
+# alt, speed, -, checksum (sum of the other bytes)
+STR_AES_FORMAT = '<ffHHHBB'
+
+def bin_unpack_vbat(vbat):
+    return (vbat + 27) * 0.1
+
+def bin_unpack_lat_lon_24(packed_data, offset=0):
+    # Extract and convert 3 bytes for latitude to a signed 24-bit integer
+    lat_lon_scaled = (packed_data[offset] << 16) | (packed_data[offset + 1] << 8) | packed_data[offset + 2]
+    if lat_lon_scaled & 0x800000:  # Check if the sign bit is set for a negative value
+        lat_lon_scaled -= 0x1000000  # Convert to signed 24-bit integer
+
+    # 1e-4 degrees on the wire, kept as integer micro degrees: a float round
+    # trip is off the 1e-4 grid on the single precision ESP32 port
+    return lat_lon_scaled * 100
+
+def bin_unpack_lat_lon_32(packed_data, offset=0):
+    # Extract and convert 4 bytes for latitude to a signed 32-bit integer
+    lat_lon_scaled = (packed_data[offset] << 24) | (packed_data[offset + 1] << 16) | (packed_data[offset + 2] << 8) | packed_data[offset + 3]
+    if lat_lon_scaled & 0x80000000:  # Check if the sign bit is set for a negative value
+        lat_lon_scaled -= 0x100000000  # Convert to signed 32-bit integer
+
+    # Already micro degrees
+    return lat_lon_scaled
+
+# Binary wire formats, keyed by (payload length, version). Plain packets
+# carry BIN_HEADER_FORMAT id1, id2, vbat/version followed by lat, lon and
+# optionally speed/alt; their version nibble does not change the layout
+# (None). The 25-byte packets carry BIN_AES_HEADER_FORMAT in clear and one
+# AES block, whose layout is picked by the version byte.
+# Value: (lat offset, lat/lon size in bytes, speed/alt struct format, name)
+BIN_FORMATS = {
+    (15, None): (9, 3, None, 'bin15'),
+    (17, None): (9, 4, None, 'bin17'),
+    (18, None): (9, 3, '<Bh', 'bin18'),
+    (20, None): (9, 4, '<Bh', 'bin20'),
+    (25, 2): (1, 3, '<BH', 'bin25v2'),  # decrypted '<B3s3sBH5sB'
+    (25, 5): (1, 4, '<BH', 'bin25v5'),  # decrypted '<B4s4sBH3sB'
+}
+BIN_HEADER_FORMAT = '<IIB'
+BIN_AES_HEADER_FORMAT = '>IIB'
+BIN_AES_LENGTH = 25
+BIN_AES_BLOCK = bytearray(16)
+
+def parse_loko_bin_packet(data, keyring, packet=LOKO_PACKET_RX):
+    packet.clear()
+    if len(data) == BIN_AES_LENGTH:
+        id1, id2, vb_version = struct.unpack_from(BIN_AES_HEADER_FORMAT, data)
+        layout = BIN_FORMATS.get((BIN_AES_LENGTH, vb_version))
+        if layout is None:
+            failures['unknown'] += 1
+            return None
+
+        body = BIN_AES_BLOCK
+        keyring.cipher(id1, id2).decrypt(data[9:], body)
+        if (sum(body) - body[15]) & 0xFF != body[15]:
+            failures['key'] += 1
+            if verbose:
+                print('Can\'t decrypt, possible wrong key')
+            return None
+        vb_version = body[0]
+    else:
+        layout = BIN_FORMATS.get((len(data), None))
+        if layout is None:
+            failures['unknown'] += 1
+            return None
+        id1, id2, vb_version = struct.unpack_from(BIN_HEADER_FORMAT, data)
+        body = data
+
+    lat_pos, lat_size, speed_alt, packet.fmt = layout
+    packet.id1 = id1
+    packet.id2 = id2
+    packet.vbat = bin_unpack_vbat(vb_version & 0x0F)
+    if lat_size == 3:
+        packet.lat = bin_unpack_lat_lon_24(body, lat_pos)
+        packet.lon = bin_unpack_lat_lon_24(body, lat_pos + 3)
+    else:
+        packet.lat = bin_unpack_lat_lon_32(body, lat_pos)
+        packet.lon = bin_unpack_lat_lon_32(body, lat_pos + 4)
+    if speed_alt is None:
+        packet.mps = 0
+        packet.alt = 0
+    else:
+        packet.mps, packet.alt = struct.unpack_from(speed_alt, body, lat_pos + 2 * lat_size)
+    return packet
+
+
+# Log of the ground unit, LOG_MANAGER in main: a header, then a ring of
+# fixed size records oldest at slot head - count. The records also go out
+# unchanged in BLE log export frames.
+LOG_MAGIC = b'LOKL'
+LOG_VERSION = 1
+LOG_HEADER_FORMAT = '<4sBBHIIII8x'  # magic, version, record size, -, capacity, head, count, seq
+LOG_HEADER_SIZE = 32
+# ts (s since 2000), id1, id2, lat, lon (1e-6 deg), alt, vbat (mV), mps, rssi, snr, flags, fence
+LOG_RECORD_FORMAT = '<IIIiihHBhbBxH'
+LOG_RECORD_SIZE = 32
+LOG_FLAG_ALT = 0x01  # alt and mps are valid
+LOG_FLAG_ENTER = 0x02  # entered geofence 'fence', not a new fix
+LOG_FLAG_EXIT = 0x04  # left it
@@ -1,15 +1,19 @@
 import machine
 from machine import ADC
-from machine import Pin, UART, Timer
-from time import sleep_ms
-from ucryptolib import aes
+from machine import Pin, UART
+import utime
+from utime import sleep_ms
 import ustruct as struct
-import ubinascii
 import ubluetooth
 import json
-import _thread
+import math
 import sys
 import gc
+import uos as os
+import uasyncio as asyncio
+import loko_packet
+from loko_packet import KEYRING, decode_loko_payload, is_valid_key, parse_lora_module_message, \
+    parse_lora_signal, coord_to_e6, vbat_to_mv
 
 if 1:  # Must be 1 for real hardware
     VBAT_IN = ADC(Pin(39))
@@ -31,145 +35,1579 @@ else:
 
 use_command_line_parser = True  # Set to True to enable command line interface
 
+# Log levels, set with the 'loglevel' command. Messages above log_level are
+# neither formatted nor printed. The packet path only logs at debug and
+# trace, so the default info level keeps the console quiet while packets
+# flow; hot spots also check log_level first to skip the call entirely.
+LOG_ERROR = 0
+LOG_INFO = 1
+LOG_DEBUG = 2
+LOG_TRACE = 3
+LOG_LEVELS = ('error', 'info', 'debug', 'trace')
+log_level = LOG_INFO
+
+
+def log(level, text, *args):
+    if level <= log_level:
+        print(text.format(*args) if args else text)
+
+
+def set_log_level(level):
+    global log_level
+    log_level = level
+    loko_packet.verbose = level >= LOG_DEBUG  # decoder field dumps and key errors
+
+
+class QUEUE():
+    # Bounded FIFO between uasyncio tasks. When a producer outruns the
+    # consumer the oldest item is dropped and counted. An item put with a
+    # key replaces a pending item with the same key, so superseded updates
+    # are merged instead of queued. Urgent items go ahead of the others, in
+    # the order they came, and are dropped last.
+
+    def __init__(self, size):
+        self.size = size
+        self.items = []  # [key, item], the urgent ones first
+        self.urgent = 0  # urgent items at the front of items
+        self.event = asyncio.Event()
+        self.dropped = 0
+        self.merged = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, key=None, urgent=False):
+        if key is not None:
+            for entry in self.items:
+                if entry[0] == key:
+                    entry[1] = item
+                    self.merged += 1
+                    return
+        if len(self.items) >= self.size:
+            if self.urgent < len(self.items):
+                self.items.pop(self.urgent)
+            else:
+                self.items.pop(0)
+                self.urgent -= 1
+            self.dropped += 1
+        if urgent:
+            self.items.insert(self.urgent, [key, item])
+            self.urgent += 1
+        else:
+            self.items.append([key, item])
+        self.event.set()
+
+    def clear(self):
+        self.items = []
+        self.urgent = 0
+
+    async def get(self):
+        while not self.items:
+            self.event.clear()
+            await self.event.wait()
+        if self.urgent:
+            self.urgent -= 1
+        return self.items.pop(0)[1]
+
+class HISTOGRAM():
+    # Durations in power of two us buckets: bucket i counts 2^i..2^(i+1)-1 us,
+    # the last one everything longer. Adding costs no allocation.
+    BUCKETS = 21  # up to about 1 s
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = [0] * self.BUCKETS
+
+    def add(self, us):
+        self.count += 1
+        self.total += us
+        if us > self.max:
+            self.max = us
+        bucket = 0
+        while us > 1 and bucket < self.BUCKETS - 1:
+            us >>= 1
+            bucket += 1
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile, in us
+        wanted = self.count * p // 100
+        seen = 0
+        for bucket in range(self.BUCKETS):
+            seen += self.buckets[bucket]
+            if seen > wanted:
+                return min(1 << (bucket + 1), self.max)
+        return self.max
+
+
+class STATS():
+    # Counters and per stage timing of the receive path, cheap enough to stay
+    # on: time() is one ticks_us() call and a few integer operations.
+    # Stages: uart (framing one UART read), parse (module line), decode and
+    # decode_aes (plain and encrypted formats), log (add_entry, including
+    # the flash write when the batch fills), fence (GEOFENCES.check()),
+    # event (logging and sending the geofence events of a packet), flush,
+    # ble_send (queueing), notify (one gatts_notify), packet (whole
+    # packet_task iteration), gc (periodic collect) and lag (how late a 1 s
+    # sleep wakes up, which includes automatic GC pauses and anything else
+    # blocking the loop).
+
+    STAGES = ('uart', 'parse', 'decode', 'decode_aes', 'log', 'fence', 'event', 'flush',
+              'ble_send', 'notify', 'packet', 'gc', 'lag')
+
+    def __init__(self):
+        self.watched = {}  # name -> [object, attribute, value at reset]
+        self.reset()
+
+    def watch(self, name, obj, attr):
+        # Report a counter some other object keeps anyway, e.g. QUEUE.dropped
+        self.watched[name] = [obj, attr, getattr(obj, attr)]
+
+    def reset(self):
+        self.since = utime.time()
+        for item in self.watched.values():
+            item[2] = getattr(item[0], item[1])
+        self.stages = {}
+        for stage in self.STAGES:
+            self.stages[stage] = HISTOGRAM()
+        self.counters = {'lines': 0, 'packets': 0, 'duplicates': 0, 'decode_failed': 0,
+                         'unsubscribed': 0, 'rate_limited': 0, 'ble_not_connected': 0,
+                         'fence_events': 0, 'packet_errors': 0}
+        self.formats = {}
+        for name in loko_packet.failures:
+            loko_packet.failures[name] = 0
+
+    def time(self, stage, start_us):
+        # Adds the time since start_us to the stage and returns now, so
+        # consecutive stages can be chained
+        now = utime.ticks_us()
+        self.stages[stage].add(utime.ticks_diff(now, start_us))
+        return now
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def count_format(self, fmt):
+        self.formats[fmt] = self.formats.get(fmt, 0) + 1
+
+    def report(self):
+        yield '--- Stats for {} s ---'.format(utime.time() - self.since)
+        yield '{:<11}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+            'stage', 'count', 'mean us', 'p50 us', 'p95 us', 'max us')
+        for stage in self.STAGES:
+            h = self.stages[stage]
+            if h.count:
+                yield '{:<11}{:>8}{:>10}{:>10}{:>10}{:>10}'.format(
+                    stage, h.count, h.total // h.count, h.percentile(50), h.percentile(95), h.max)
+        yield 'Formats: ' + ', '.join('{}={}'.format(k, v) for k, v in sorted(self.formats.items()))
+        yield 'Counters: ' + ', '.join('{}={}'.format(k, v) for k, v in self.counters.items())
+        yield 'Decode failures: ' + ', '.join(
+            '{}={}'.format(k, v) for k, v in loko_packet.failures.items())
+        yield 'Queues: ' + ', '.join('{}={}'.format(name, getattr(item[0], item[1]) - item[2])
+                                    for name, item in self.watched.items())
+
+
+class BOOT():
+    # When each startup phase finished, in ms since power-on. ticks_ms()
+    # starts at reset, so 'start' includes booting MicroPython and importing
+    # this file. Shown by the 'boot' command.
+
+    def __init__(self):
+        self.phases = []
+        self.first_packet = None
+        self.mark('start')
+
+    def mark(self, name):
+        self.phases.append((name, utime.ticks_ms()))
+
+    def report(self):
+        yield '--- Boot, ms since power-on ---'
+        last = 0
+        for name, ms in self.phases:
+            yield '{:<14}{:>8}{:>8}'.format(name, ms, '+{}'.format(ms - last))
+            last = ms
+        if self.first_packet is None:
+            yield 'No packet received yet'
+
+
 class SETTINGS():
+    # Settings in a JSON file. A change is made by editing data and calling
+    # changed(name): subscribers of that name apply it right away and
+    # save_task() writes the file once the changes stop coming for
+    # SAVE_DELAY_MS, so a burst of 'set' commands costs one flash write.
+    # save() writes a temporary file and renames it over the old one, so a
+    # reset in the middle leaves either the old or the new settings.
+
+    SAVE_DELAY_MS = 2000
 
     data = {
         'id2': 0,
         'freq': 868000000,  # Changed to Hz instead of MHz
         'p2p_key': "00" * 32,
+        'keys': {},  # per tracker p2p keys, "ID1:ID2" -> hex key
+        'dup_ms': 5000,  # repeats of a payload within this window are dropped, 0 keeps all
+        'subs': {},  # forwarded id2 values besides 'id2', "ID2" -> min ms between fixes of a tracker
+        'fast_boot': True,  # skip the 2 s LED self-test and configure the radio in the background
+        'log_level': 'info',  # one of LOG_LEVELS
+        'replay': 'oldest',  # order of the positions stored while the phone was away
+        'rx_sleep': False,  # sleep between the learned tracker beacons, see RX_SCHEDULE
+        'fences': {},  # geofences, "N" -> circle or polygon, see GEOFENCES
     }
 
     def __init__(self, file_name='settings.json'):
         self.file_name = file_name
+        self.subscribers = {}  # setting name -> [callback(name)]
+        self.dirty = False
+        self.event = asyncio.Event()
         self.load()
 
-    def save(self):
-        print('Save settings to {}:{}'.format(self.file_name, self.data))
-        with open(self.file_name, "w") as fp:
-            json.dump(self.data, fp)
+    def subscribe(self, names, callback):
+        for name in names:
+            self.subscribers.setdefault(name, []).append(callback)
 
-    def load(self):
-        try:
-            with open(self.file_name, "r") as fp:
-                self.data = json.load(fp)
-                # Check if freq is stored in MHz and convert to Hz if needed
-                if self.data['freq'] < 1000:
-                    self.data['freq'] = self.data['freq'] * 1000000
-                    self.save()
-        except Exception as inst:
-            print(inst)
-            print("Settings file not found create new and use default settings")
+    def changed(self, name):
+        self.dirty = True
+        self.event.set()
+        for callback in self.subscribers.get(name, ()):
+            try:
+                callback(name)
+            except Exception as e:
+                log(LOG_ERROR, 'Applying {} failed: {}', name, e)
+
+    async def save_task(self):
+        while True:
+            await self.event.wait()
+            # Every change restarts the delay
+            while self.event.is_set():
+                self.event.clear()
+                await asyncio.sleep_ms(self.SAVE_DELAY_MS)
+            self.flush()
+
+    def flush(self):
+        if self.dirty:
             self.save()
-        print('Load settings from {}:{}'.format(self.file_name, self.data))
 
+    def save(self):
+        log(LOG_INFO, 'Save settings to {}:{}', self.file_name, self.data)
+        temp_name = self.file_name + '.tmp'
+        try:
+            with open(temp_name, "w") as fp:
+                json.dump(self.data, fp)
+            try:
+                os.rename(temp_name, self.file_name)
+            except OSError:
+                # FAT does not rename over an existing file, load() falls
+                # back to the temporary file if the reset comes in between
+                os.remove(self.file_name)
+                os.rename(temp_name, self.file_name)
+            self.dirty = False
+        except OSError as e:
+            log(LOG_ERROR, 'Failed to save settings: {}', e)
 
-class LOG_MANAGER():
-    def __init__(self, max_entries=50, filename="lora_log.txt"):
-        self.log = []
-        self.max_entries = max_entries
+    def load(self):
+        stored = None
+        for name in (self.file_name, self.file_name + '.tmp'):
+            try:
+                with open(name, "r") as fp:
+                    stored = json.load(fp)
+                break
+            except Exception as inst:
+                log(LOG_INFO, '{}: {}', name, inst)
+        if stored is None:
+            log(LOG_INFO, "Settings file not found create new and use default settings")
+        # Start from the defaults so settings added in newer
+        # firmware versions get a value
+        self.data = dict(SETTINGS.data)
+        self.data['keys'] = {}
+        self.data['subs'] = {}
+        self.data['fences'] = {}
+        if stored is not None:
+            self.data.update(stored)
+        if stored is None or name != self.file_name:
+            # Write the defaults, or finish a save cut short by a reset
+            self.dirty = True
+        # Check if freq is stored in MHz and convert to Hz if needed
+        if self.data['freq'] < 1000:
+            self.data['freq'] = self.data['freq'] * 1000000
+            self.dirty = True
+        self.flush()
+        if self.data['log_level'] not in LOG_LEVELS:
+            self.data['log_level'] = 'info'
+        log(LOG_INFO, 'Load settings from {}:{}', self.file_name, self.data)
+
+
+class LOG_INDEX():
+    # On-flash index for LOG_MANAGER. Records are addressed by their sequence
+    # number q, stored in slot q % capacity. For every tracker the index keeps
+    # the newest q and for every record the q of the same tracker's previous
+    # one, so one tracker's history is a chain that skips all other records.
+    # Records are also grouped into buckets of BUCKET slots with the min/max
+    # timestamp of each, so time ranges skip whole buckets.
+    # File: header | tracker table | prev per slot | bucket min/max
+
+    MAGIC = b'LOKI'
+    VERSION = 1
+    HEADER_FORMAT = '<4sBBHIII12x'  # magic, version, -, trackers, capacity, bucket size, log seq
+    HEADER_SIZE = 32
+    TRACKER_FORMAT = '<III'  # id1, id2, newest q + 1 (0 = free)
+    TRACKER_SIZE = 12
+    TRACKERS = 64
+    BUCKET = 32
+    EMPTY_BUCKET = (0xFFFFFFFF, 0)
+
+    def __init__(self, filename, capacity):
         self.filename = filename
-        self.file_mode = "a"  # append mode by default
-
-        # Try to load existing logs from file
+        self.capacity = capacity
+        self.buckets_count = (capacity + self.BUCKET - 1) // self.BUCKET
+        self.prev_pos = self.HEADER_SIZE + self.TRACKERS * self.TRACKER_SIZE
+        self.bucket_pos = self.prev_pos + capacity * 4
+        self.file = None
+        self._reset()
+
+    def _reset(self):
+        self.trackers = {}  # (id1, id2) -> [table slot, newest q + 1]
+        self.buckets = [self.EMPTY_BUCKET] * self.buckets_count
+        self.pending_prev = {}  # q -> prev q + 1, not on flash yet
+        self.dirty_trackers = {}
+        self.dirty_buckets = set()
+
+    def open(self, log_seq):
+        # Returns False when the index does not match the log and has to be
+        # rebuilt, e.g. after a power loss between the two flushes
         try:
-            self._load_from_file()
-        except:
-            print("No existing log file found or couldn't read it")
+            self.file = open(self.filename, "r+b")
+            magic, version, _, trackers, capacity, bucket, seq = struct.unpack(
+                self.HEADER_FORMAT, self.file.read(self.HEADER_SIZE))
+            if magic == self.MAGIC and version == self.VERSION and trackers == self.TRACKERS and \
+                    capacity == self.capacity and bucket == self.BUCKET and seq == log_seq:
+                for slot in range(self.TRACKERS):
+                    id1, id2, last = struct.unpack(self.TRACKER_FORMAT, self.file.read(self.TRACKER_SIZE))
+                    if last:
+                        self.trackers[(id1, id2)] = [slot, last]
+                self.file.seek(self.bucket_pos)
+                for bucket in range(self.buckets_count):
+                    self.buckets[bucket] = struct.unpack('<II', self.file.read(8))
+                return True
+            self.file.close()
+        except Exception:
+            pass
+        self.create()
+        return False
 
-    def _load_from_file(self):
+    def create(self):
+        self._reset()
+        self.file = open(self.filename, "w+b")
+        self.file.write(bytearray(self.bucket_pos))
+        for bucket in range(self.buckets_count):
+            self.file.write(struct.pack('<II', *self.EMPTY_BUCKET))
+        self.flush(0)
+
+    def add(self, q, id1, id2, ts, oldest_q):
+        tracker = self.trackers.get((id1, id2))
+        if tracker is None:
+            tracker = [self._free_slot(oldest_q), 0]
+            self.trackers[(id1, id2)] = tracker
+        self.pending_prev[q] = tracker[1]
+        tracker[1] = q + 1
+        self.dirty_trackers[tracker[0]] = (id1, id2, q + 1)
+
+        slot = q % self.capacity
+        bucket = slot // self.BUCKET
+        low, high = self.buckets[bucket]
+        if slot % self.BUCKET == 0:
+            # First slot of the bucket is being reused, start a new range
+            low, high = ts, ts
+        self.buckets[bucket] = (min(low, ts), max(high, ts))
+        self.dirty_buckets.add(bucket)
+
+    def _free_slot(self, oldest_q):
+        # A table slot whose records are all overwritten, else the tracker
+        # heard from least recently gives its slot up
+        used = {}
+        for key, tracker in self.trackers.items():
+            used[tracker[0]] = (tracker[1], key)
+        for slot in range(self.TRACKERS):
+            if slot not in used:
+                return slot
+        slot = min(used, key=lambda s: used[s][0])
+        del self.trackers[used[slot][1]]
+        return slot
+
+    def prev(self, q):
+        # q of the same tracker's previous record plus one, 0 at the start
+        prev = self.pending_prev.get(q)
+        if prev is not None:
+            return prev
+        self.file.seek(self.prev_pos + (q % self.capacity) * 4)
+        return struct.unpack('<I', self.file.read(4))[0]
+
+    def bucket_overlaps(self, bucket, t_from, t_to):
+        low, high = self.buckets[bucket]
+        return low <= t_to and high >= t_from
+
+    def flush(self, log_seq):
+        if self.file is None:
+            return
+        for q in sorted(self.pending_prev):
+            self.file.seek(self.prev_pos + (q % self.capacity) * 4)
+            self.file.write(struct.pack('<I', self.pending_prev[q]))
+        for slot, entry in self.dirty_trackers.items():
+            self.file.seek(self.HEADER_SIZE + slot * self.TRACKER_SIZE)
+            self.file.write(struct.pack(self.TRACKER_FORMAT, *entry))
+        for bucket in self.dirty_buckets:
+            self.file.seek(self.bucket_pos + bucket * 8)
+            self.file.write(struct.pack('<II', *self.buckets[bucket]))
+        self.pending_prev = {}
+        self.dirty_trackers = {}
+        self.dirty_buckets = set()
+        self.file.seek(0)
+        self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, 0,
+                                    self.TRACKERS, self.capacity, self.BUCKET, log_seq))
+        self.file.flush()
+
+
+def put_varint(buf, pos, value):
+    # Unsigned LEB128, returns the position after it
+    while value > 0x7F:
+        buf[pos] = (value & 0x7F) | 0x80
+        value >>= 7
+        pos += 1
+    buf[pos] = value
+    return pos + 1
+
+
+def get_varint(buf, pos):
+    value = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else (-value << 1) - 1
+
+
+def unzigzag(value):
+    return -((value + 1) >> 1) if value & 1 else value >> 1
+
+
+class TRACK_STORE():
+    # Long term track history next to LOG_MANAGER, per tracker and delta
+    # encoded. The file is a ring of BLOCK byte blocks, each holding fixes
+    # of one tracker: a header with the first fix as keyframe, then for
+    # every further fix a flags byte, the seconds since the previous fix
+    # and only the fields that changed, as zigzag varints of the difference:
+    #   flags 0x01 lat and lon, in units of the block's scale
+    #         0x02 alt, 0x04 mps (absolute), 0x08 vbat (mV)
+    # Fixes of the 24-bit binary formats are on a 1e-4 degree grid, their
+    # blocks use scale 100 (micro degrees), everything else scale 1, so a
+    # tracker moving a few meters costs one byte per coordinate. A parked
+    # tracker costs 2 bytes per fix, a moving one about 6 instead of a
+    # 32 byte log record. The OPEN most recently heard trackers have a
+    # block in RAM, appended fixes reach flash with flush(); a tracker heard
+    # again after its block left RAM continues it from flash when it still
+    # has room, also after a reboot. Blocks are found through an index of
+    # their headers, read when the file is opened.
+
+    MAGIC = b'LOKT'
+    VERSION = 1
+    HEADER_FORMAT = '<4sBBHII16x'  # magic, version, -, block size, blocks, next block seq
+    HEADER_SIZE = 32
+    # block seq + 1, id1, id2, keyframe ts, lat, lon (1e-6 deg), alt, vbat (mV), mps,
+    # flags, used bytes, fixes, scale
+    BLOCK_FORMAT = '<IIIIiihHBBHHH'
+    BLOCK_HEADER = 36
+    BLOCK = 256
+    MAX_FIX = 24  # longest encoded fix
+    FLAG_ALT = 0x01  # alt and mps are valid
+    OPEN = 8
+
+    def __init__(self, filename, blocks=256):
+        self.filename = filename
+        self.blocks = blocks
+        self.next_seq = 0
+        self.open_blocks = {}  # (id1, id2) -> open block, see _new_block()
+        self.last_blocks = {}  # (id1, id2) -> seq of the newest block
+        self.index = {}  # (id1, id2) -> [block seq], oldest first
+        self.file = None
         try:
-            with open(self.filename, "r") as f:
-                lines = f.readlines()
-
-            # Only keep the most recent entries if file is too large
-            if len(lines) > self.max_entries:
-                lines = lines[-self.max_entries:]
-
-            # Parse the log entries
-            for line in lines:
-                if line.strip():  # Skip empty lines
-                    try:
-                        # Format: [TIMESTAMP] DATA
-                        timestamp = line[1:line.find("]")]
-                        data = line[line.find("]")+2:].strip()
-                        self.log.append({
-                            'timestamp': timestamp,
-                            'data': data
-                        })
-                    except:
-                        print(f"Couldn't parse log line: {line}")
-        except:
-            # Start with an empty log if file doesn't exist or can't be read
-            self.log = []
+            self._open()
+        except Exception as e:
+            log(LOG_ERROR, "Couldn't open track store: {}", e)
 
-    def add_entry(self, data):
+    def _open(self):
         try:
-            timestamp = machine.RTC().datetime()
-            time_str = "{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}".format(
-                timestamp[0], timestamp[1], timestamp[2],
-                timestamp[4], timestamp[5], timestamp[6]
-            )
-        except:
-            # If RTC is not set, use a simple counter as timestamp
-            time_str = "LOG-" + str(len(self.log) + 1)
+            self.file = open(self.filename, "r+b")
+            magic, version, _, block, blocks, next_seq = struct.unpack(
+                self.HEADER_FORMAT, self.file.read(self.HEADER_SIZE))
+            if magic == self.MAGIC and version == self.VERSION and block == self.BLOCK and \
+                    blocks == self.blocks:
+                self.next_seq = next_seq
+                self._load_index()
+                return
+            self.file.close()
+        except OSError:
+            pass
+        self.create()
+
+    def create(self):
+        self.file = open(self.filename, "w+b")
+        self.file.write(bytearray(self.HEADER_SIZE))
+        empty = bytearray(self.BLOCK)
+        for _ in range(self.blocks):
+            self.file.write(empty)
+        self.next_seq = 0
+        self.open_blocks = {}
+        self.last_blocks = {}
+        self.index = {}
+        self._write_header()
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, 0,
+                                    self.BLOCK, self.blocks, self.next_seq))
+
+    def _load_index(self):
+        # One header read per block; the newest block of every tracker is
+        # where add() continues
+        self.index = {}
+        for seq in range(max(0, self.next_seq - self.blocks), self.next_seq):
+            self.file.seek(self.HEADER_SIZE + seq % self.blocks * self.BLOCK)
+            header = struct.unpack(self.BLOCK_FORMAT, self.file.read(self.BLOCK_HEADER))
+            if header[0] == seq + 1:
+                self.index.setdefault((header[1], header[2]), []).append(seq)
+        self.last_blocks = {key: seqs[-1] for key, seqs in self.index.items()}
+
+    def add(self, ts, id1, id2, lat, lon, alt, vbat, mps):
+        # alt and mps None when the packet format has no altitude and speed
+        key = (id1, id2)
+        block = self.open_blocks.get(key)
+        if block is None and key in self.last_blocks:
+            block = self._reopen(key, self.last_blocks[key])
+        if block is not None and not self._append(block, ts, lat, lon, alt, vbat, mps):
+            self._close(key)
+            block = None
+        if block is None:
+            self._new_block(key, ts, lat, lon, alt, vbat, mps)
+
+    def _make_room(self):
+        if len(self.open_blocks) >= self.OPEN:
+            oldest = None
+            for other, block in self.open_blocks.items():
+                if oldest is None or block[3][0] < self.open_blocks[oldest][3][0]:
+                    oldest = other
+            self._close(oldest)
+
+    def _reopen(self, key, seq):
+        # The tracker's newest block back in RAM, None when it is full or gone
+        if seq < self.next_seq - self.blocks:
+            return None
+        buf = bytearray(self.BLOCK)
+        self.file.seek(self.HEADER_SIZE + seq % self.blocks * self.BLOCK)
+        self.file.readinto(buf)
+        header = struct.unpack_from(self.BLOCK_FORMAT, buf, 0)
+        used, fixes, scale, flags = header[10], header[11], header[12], header[9]
+        if header[0] != seq + 1 or used + self.MAX_FIX > self.BLOCK:
+            return None
+        last = None
+        for last in self._decode(buf):
+            pass
+        self._make_room()
+        block = [seq, buf, used, (last[0], last[1], last[2], last[3] or 0, last[4], last[5] or 0),
+                 fixes, scale, flags, used]
+        self.open_blocks[key] = block
+        return block
+
+    def _new_block(self, key, ts, lat, lon, alt, vbat, mps):
+        self._make_room()
+        seq = self.next_seq
+        self.next_seq += 1
+        for other in [other for other, block in self.open_blocks.items() if block[0] <= seq - self.blocks]:
+            del self.open_blocks[other]  # its slot is reused now
+        self._drop_overwritten(seq)
+        self.index.setdefault(key, []).append(seq)
+        scale = 100 if lat % 100 == 0 and lon % 100 == 0 else 1
+        flags = self.FLAG_ALT if alt is not None else 0
+        buf = bytearray(self.BLOCK)
+        # [seq, buf, used, last (ts, lat, lon, alt, vbat, mps), fixes, scale, flags, flushed]
+        block = [seq, buf, self.BLOCK_HEADER, (ts, lat, lon, alt or 0, vbat, mps or 0), 1,
+                 scale, flags, 0]
+        self.open_blocks[key] = block
+        self.last_blocks[key] = seq
+        self._pack_header(key, block, (ts, lat, lon, alt or 0, vbat, mps or 0))
+
+    def _pack_header(self, key, block, first):
+        ts, lat, lon, alt, vbat, mps = first
+        struct.pack_into(self.BLOCK_FORMAT, block[1], 0, block[0] + 1, key[0], key[1], ts, lat,
+                         lon, alt, vbat, mps, block[6], block[2], block[4], block[5])
+
+    def _append(self, block, ts, lat, lon, alt, vbat, mps):
+        # False when the fix does not fit this block
+        seq, buf, pos, last, fixes, scale, flags, _ = block
+        last_ts, last_lat, last_lon, last_alt, last_vbat, last_mps = last
+        if pos + self.MAX_FIX > self.BLOCK or ts < last_ts or fixes == 0xFFFF or \
+                (alt is not None) != bool(flags & self.FLAG_ALT) or lat % scale or lon % scale:
+            return False
+        alt = alt or 0
+        mps = mps or 0
+        changed = 0
+        start = pos
+        pos += 1
+        pos = put_varint(buf, pos, ts - last_ts)
+        if lat != last_lat or lon != last_lon:
+            changed |= 0x01
+            pos = put_varint(buf, pos, zigzag((lat - last_lat) // scale))
+            pos = put_varint(buf, pos, zigzag((lon - last_lon) // scale))
+        if alt != last_alt:
+            changed |= 0x02
+            pos = put_varint(buf, pos, zigzag(alt - last_alt))
+        if mps != last_mps:
+            changed |= 0x04
+            pos = put_varint(buf, pos, mps)
+        if vbat != last_vbat:
+            changed |= 0x08
+            pos = put_varint(buf, pos, zigzag(vbat - last_vbat))
+        buf[start] = changed
+        block[2] = pos
+        block[3] = (ts, lat, lon, alt, vbat, mps)
+        block[4] = fixes + 1
+        return True
+
+    def _close(self, key):
+        self._write_block(key, self.open_blocks[key])
+        del self.open_blocks[key]
+
+    def _drop_overwritten(self, seq):
+        # The new block seq takes the slot of block seq - blocks
+        old = seq - self.blocks
+        if old < 0:
+            return
+        for key, seqs in self.index.items():
+            if seqs and seqs[0] == old:
+                seqs.pop(0)
+                if not seqs:
+                    del self.index[key]
+                return
 
-        # Create a log entry with timestamp and data
-        log_entry = {
-            'timestamp': time_str,
-            'data': data
-        }
+    def _write_block(self, key, block):
+        seq, buf, used = block[0], block[1], block[2]
+        if block[7] == used:
+            return
+        # Header with the new used/fixes counts, then only the new bytes
+        struct.pack_into('<HH', buf, 30, used, block[4])
+        pos = self.HEADER_SIZE + seq % self.blocks * self.BLOCK
+        self.file.seek(pos)
+        self.file.write(buf[:self.BLOCK_HEADER])
+        start = max(block[7], self.BLOCK_HEADER)
+        self.file.seek(pos + start)
+        self.file.write(buf[start:used])
+        block[7] = used
+
+    def flush(self):
+        if self.file is None:
+            return
+        try:
+            for key, block in self.open_blocks.items():
+                self._write_block(key, block)
+            self._write_header()
+            self.file.flush()
+        except OSError as e:
+            log(LOG_ERROR, "Failed to write track store: {}", e)
+
+    def fixes(self, id1, id2, t_from=0, t_to=0xFFFFFFFF):
+        # (ts, lat, lon, alt, vbat, mps) of one tracker, oldest first; alt
+        # and mps None when the tracker does not send them
+        key = (id1, id2)
+        buf = bytearray(self.BLOCK)
+        for seq in list(self.index.get(key, ())):
+            if seq < self.next_seq - self.blocks:
+                continue
+            block = self.open_blocks.get(key)
+            if block is not None and block[0] == seq:
+                buf[:] = block[1]
+                struct.pack_into('<HH', buf, 30, block[2], block[4])
+            else:
+                self.file.seek(self.HEADER_SIZE + seq % self.blocks * self.BLOCK)
+                self.file.readinto(buf)
+            for fix in self._decode(buf):
+                if fix[0] > t_to:
+                    return
+                if fix[0] >= t_from:
+                    yield fix
+
+    def _decode(self, buf):
+        _, _, _, ts, lat, lon, alt, vbat, mps, flags, used, fixes, scale = \
+            struct.unpack_from(self.BLOCK_FORMAT, buf, 0)
+        valid = flags & self.FLAG_ALT
+        pos = self.BLOCK_HEADER
+        for n in range(fixes):
+            if n:
+                changed = buf[pos]
+                dt, pos = get_varint(buf, pos + 1)
+                ts += dt
+                if changed & 0x01:
+                    value, pos = get_varint(buf, pos)
+                    lat += unzigzag(value) * scale
+                    value, pos = get_varint(buf, pos)
+                    lon += unzigzag(value) * scale
+                if changed & 0x02:
+                    value, pos = get_varint(buf, pos)
+                    alt += unzigzag(value)
+                if changed & 0x04:
+                    mps, pos = get_varint(buf, pos)
+                if changed & 0x08:
+                    value, pos = get_varint(buf, pos)
+                    vbat += unzigzag(value)
+            yield ts, lat, lon, alt if valid else None, vbat, mps if valid else None
+
+    def usage(self):
+        # (id1, id2) -> [fixes, bytes] of the stored blocks
+        result = {}
+        header = bytearray(self.BLOCK_HEADER)
+        for key, seqs in self.index.items():
+            total = result.setdefault(key, [0, 0])
+            for seq in seqs:
+                block = self.open_blocks.get(key)
+                if block is not None and block[0] == seq:
+                    total[0] += block[4]
+                    total[1] += block[2]
+                    continue
+                self.file.seek(self.HEADER_SIZE + seq % self.blocks * self.BLOCK)
+                self.file.readinto(header)
+                used, fixes = struct.unpack_from('<HH', header, 30)
+                total[0] += fixes
+                total[1] += used
+        return result
 
-        # Manage the maximum length manually
-        if len(self.log) >= self.max_entries:
-            self.log.pop(0)  # Remove oldest entry
 
-        self.log.append(log_entry)
+class LOG_MANAGER():
+    # Received fixes are kept as fixed size binary records in a circular log
+    # inside a preallocated file. The header holds the head/count pointers,
+    # so appending and reading the newest records is O(1) and boot time does
+    # not depend on how much is stored. New records are batched in RAM and
+    # written to flash by flush(), when the batch is full or periodically
+    # from log_flush_task(). LOG_INDEX answers queries by tracker and time.
+    # A geofence enter or exit is a record of its own, the fix that caused
+    # it with an event flag and the fence number, and is written to flash
+    # right away together with whatever is batched.
+
+    # File layout shared with host tools, see loko_packet
+    MAGIC = loko_packet.LOG_MAGIC
+    VERSION = loko_packet.LOG_VERSION
+    HEADER_FORMAT = loko_packet.LOG_HEADER_FORMAT
+    HEADER_SIZE = loko_packet.LOG_HEADER_SIZE
+    RECORD_FORMAT = loko_packet.LOG_RECORD_FORMAT
+    RECORD_SIZE = loko_packet.LOG_RECORD_SIZE
+    FLAG_ALT = loko_packet.LOG_FLAG_ALT
+    FLAG_ENTER = loko_packet.LOG_FLAG_ENTER
+    FLAG_EXIT = loko_packet.LOG_FLAG_EXIT
+
+    def __init__(self, capacity=2048, filename="lora_log.bin", batch=8):
+        self.capacity = capacity
+        self.filename = filename
+        self.batch = batch
+        self.pending_buf = bytearray(batch * self.RECORD_SIZE)
+        self.pending = 0  # records in pending_buf, not on flash yet
+        self.head = 0  # slot of the next record
+        self.count = 0  # stored records, including pending ones
+        self.seq = 0  # records ever written, the next record gets this q
+        self.file = None
+        self.index = LOG_INDEX(filename.rsplit('.', 1)[0] + '.idx', capacity)
+        self.tracks = TRACK_STORE(filename.rsplit('.', 1)[0] + '.trk')
 
-        # Save to file
         try:
-            with open(self.filename, self.file_mode) as f:
-                f.write(f"[{time_str}] {data}\n")
-            # Switch to append mode for future entries
-            self.file_mode = "a"
-        except:
-            print("Failed to write log to file")
+            self._open()
+            if not self.index.open(self.seq):
+                self._rebuild_index()
+        except Exception as e:
+            log(LOG_ERROR, "Couldn't open log file: {}", e)
 
-    def get_all_logs(self):
-        return self.log
+    def _open(self):
+        try:
+            self.file = open(self.filename, "r+b")
+            header = self.file.read(self.HEADER_SIZE)
+            magic, version, record_size, _, capacity, head, count, seq = \
+                struct.unpack(self.HEADER_FORMAT, header)
+            if magic == self.MAGIC and version == self.VERSION and \
+                    record_size == self.RECORD_SIZE and capacity == self.capacity:
+                self.head, self.count, self.seq = head, count, seq
+                return
+            log(LOG_INFO, "Log file format changed, creating a new one")
+            self.file.close()
+        except OSError:
+            log(LOG_INFO, "No existing log file found, creating a new one")
+        self._create()
+
+    def _create(self):
+        # Preallocate the whole file once so appends never grow it
+        self.file = open(self.filename, "w+b")
+        self.file.write(bytearray(self.HEADER_SIZE))
+        chunk = bytearray(16 * self.RECORD_SIZE)
+        left = self.capacity * self.RECORD_SIZE
+        while left > 0:
+            self.file.write(chunk if left >= len(chunk) else chunk[:left])
+            left -= len(chunk)
+        self.head = self.count = self.seq = 0
+        self._write_header()
+
+    def _rebuild_index(self):
+        log(LOG_INFO, "Rebuilding log index")
+        for q in range(self.seq - self.count, self.seq):
+            entry = self.read_seq(q)
+            self.index.add(q, entry[1], entry[2], entry[0], self.seq - self.count)
+        self.index.flush(self.seq)
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION,
+                                    self.RECORD_SIZE, 0, self.capacity,
+                                    self.head, self.count, self.seq))
+        self.file.flush()
+
+    def add_entry(self, packet, event=0, fence=0):
+        # event is FLAG_ENTER or FLAG_EXIT for a geofence event record
+        vbat = vbat_to_mv(packet.vbat)
+        flags = event
+        alt = mps = 0
+        if packet.alt is not None and packet.mps is not None:
+            flags |= self.FLAG_ALT
+            alt, mps = packet.alt, packet.mps
+        ts = utime.time()
+        lat = coord_to_e6(packet.lat)
+        lon = coord_to_e6(packet.lon)
+        struct.pack_into(self.RECORD_FORMAT, self.pending_buf,
+                         self.pending * self.RECORD_SIZE, ts,
+                         packet.id1, packet.id2, lat, lon, alt, vbat, mps,
+                         packet.rssi, packet.snr, flags, fence)
+        self.pending += 1
+        self.head = (self.head + 1) % self.capacity
+        self.seq += 1
+        if self.count < self.capacity:
+            self.count += 1
+        self.index.add(self.seq - 1, packet.id1, packet.id2, ts, self.seq - self.count)
+        if not event:
+            valid = flags & self.FLAG_ALT
+            self.tracks.add(ts, packet.id1, packet.id2, lat, lon, packet.alt if valid else None,
+                            vbat, packet.mps if valid else None)
+        if event or self.pending == self.batch:
+            self.flush()
+
+    def flush(self):
+        if not self.pending or self.file is None:
+            return
+        try:
+            # The batch ends at head and may wrap around the end of the file
+            first = (self.head - self.pending) % self.capacity
+            done = 0
+            while done < self.pending:
+                slot = (first + done) % self.capacity
+                run = min(self.pending - done, self.capacity - slot)
+                self.file.seek(self.HEADER_SIZE + slot * self.RECORD_SIZE)
+                self.file.write(self.pending_buf[done * self.RECORD_SIZE:(done + run) * self.RECORD_SIZE])
+                done += run
+            self.pending = 0
+            self._write_header()
+            self.index.flush(self.seq)
+            self.tracks.flush()
+        except OSError as e:
+            log(LOG_ERROR, "Failed to write log to file: {}", e)
+
+    def read_entry(self, index):
+        # index 0 is the oldest stored record, count - 1 the newest
+        slot = (self.head - self.count + index) % self.capacity
+        newer = self.count - 1 - index
+        if newer < self.pending:
+            pos = (self.pending - 1 - newer) * self.RECORD_SIZE
+            return struct.unpack_from(self.RECORD_FORMAT, self.pending_buf, pos)
+        self.file.seek(self.HEADER_SIZE + slot * self.RECORD_SIZE)
+        return struct.unpack(self.RECORD_FORMAT, self.file.read(self.RECORD_SIZE))
+
+    def read_seq(self, q):
+        return self.read_entry(q - (self.seq - self.count))
+
+    def tail(self, num):
+        # Newest num records, oldest first
+        num = min(num, self.count)
+        for index in range(self.count - num, self.count):
+            yield self.read_entry(index)
+
+    def format_entry(self, entry):
+        ts, id1, id2, lat, lon, alt, vbat, mps, rssi, snr, flags, fence = entry
+        t = utime.localtime(ts)
+        text = "[{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}] ID1={}, ID2={}, LAT={}, LON={}, VBAT={}".format(
+            t[0], t[1], t[2], t[3], t[4], t[5], id1, id2, e6_to_str(lat), e6_to_str(lon), vbat)
+        if flags & self.FLAG_ALT:
+            text += ", ALT={}, MPS={}".format(alt, mps)
+        if rssi or snr:
+            text += ", RSSI={}, SNR={}".format(rssi, snr)
+        if flags & self.FLAG_ENTER:
+            text += ", ENTER={}".format(fence)
+        elif flags & self.FLAG_EXIT:
+            text += ", EXIT={}".format(fence)
+        return text
 
     def clear_logs(self):
-        self.log = []
-        # Overwrite the file with empty content
+        # head stays at seq % capacity, the index relies on it
+        self.pending = 0
+        self.count = 0
         try:
-            with open(self.filename, "w") as f:
-                f.write("")
+            self._write_header()
+            self.index.create()
+            self.index.flush(self.seq)
+            self.tracks.create()
             print("Log file cleared")
         except:
             print("Failed to clear log file")
 
-    def export_logs(self):
-        # Create a formatted string of all logs for export
-        output = ""
-        for entry in self.log:
-            output += f"[{entry['timestamp']}] {entry['data']}\n"
-        return output
+    def query(self, id1=None, id2=None, t_from=0, t_to=0xFFFFFFFF, limit=100):
+        # Newest 'limit' records matching the filters, oldest first. With an
+        # ID filter only the matching trackers' chains are walked, otherwise
+        # only buckets overlapping the time range are read.
+        oldest = self.seq - self.count
+        # The bucket being overwritten still holds older records outside its range
+        head_bucket = self.head // self.index.BUCKET
+        found = []
+        if id1 is None and id2 is None:
+            q = self.seq - 1
+            while q >= oldest and len(found) < limit:
+                bucket = q % self.capacity // self.index.BUCKET
+                if bucket != head_bucket and not self.index.bucket_overlaps(bucket, t_from, t_to):
+                    # Jump to the last record of the previous bucket
+                    q -= q % self.capacity % self.index.BUCKET + 1
+                    continue
+                entry = self.read_seq(q)
+                if t_from <= entry[0] <= t_to:
+                    found.append((q, entry))
+                q -= 1
+        else:
+            for key in self.index.trackers:
+                if (id1 is not None and key[0] != id1) or (id2 is not None and key[1] != id2):
+                    continue
+                q = self.index.trackers[key][1] - 1
+                matched = 0
+                while q >= oldest and matched < limit:
+                    bucket = q % self.capacity // self.index.BUCKET
+                    if bucket == head_bucket or self.index.bucket_overlaps(bucket, t_from, t_to):
+                        entry = self.read_seq(q)
+                        if entry[1] != key[0] or entry[2] != key[1]:
+                            break  # stale chain, the slot has been reused
+                        if t_from <= entry[0] <= t_to:
+                            found.append((q, entry))
+                            matched += 1
+                    q = self.index.prev(q) - 1
+        found.sort(key=lambda item: item[0])
+        return [entry for q, entry in found[-limit:]]
+
+    def chunks(self, q=0, size=16):
+        # Stored records from seq q up to the newest one at the start, as
+        # (first q, count, memoryview of count records). Every chunk is read
+        # into the same buffer, so use it before asking for the next one.
+        # Records overwritten meanwhile are skipped.
+        buf = memoryview(bytearray(size * self.RECORD_SIZE))
+        self.flush()
+        end = self.seq
+        while True:
+            q = max(q, self.seq - self.count)
+            if q >= end or self.file is None:
+                return
+            num = min(size, end - q, self.capacity - q % self.capacity)
+            data = buf[:num * self.RECORD_SIZE]
+            self.file.seek(self.HEADER_SIZE + q % self.capacity * self.RECORD_SIZE)
+            self.file.readinto(data)
+            yield q, num, data
+            q += num
+
+    def export_logs(self, q=0):
+        # (q, formatted line) of every stored record from seq q on, one chunk in RAM
+        for first, num, data in self.chunks(q):
+            for i in range(num):
+                yield first + i, self.format_entry(
+                    struct.unpack_from(self.RECORD_FORMAT, data, i * self.RECORD_SIZE))
+
+
+class FORWARD_STORE():
+    # Positions meant for the phone, kept until they are known to have
+    # reached it. Every position that passes the subscriptions gets a store
+    # sequence number and a fixed size record in a circular file laid out
+    # like LOG_MANAGER's. delivered is the first seq the phone may not have:
+    # it follows live sends while connected and stops while disconnected.
+    # On disconnect it is moved back over the last LINK_TIMEOUT_S seconds,
+    # the link may have been dead that long before the stack noticed, and
+    # replay_task() sends everything from there on once the phone is back.
+    # The phone drops copies it already has by seq. The clock starts over
+    # at every boot (no RTC), so the rewind never reaches back before
+    # boot_seq, the first position of this boot.
+    # When more than capacity positions wait, the oldest are overwritten.
+
+    MAGIC = b'LOKF'
+    VERSION = 1
+    HEADER_FORMAT = '<4sBBHIII12x'  # magic, version, record size, -, capacity, seq, delivered
+    HEADER_SIZE = 32
+    # ts, id1, id2, lat, lon (1e-6 deg), alt, vbat (mV), mps, flags
+    RECORD_FORMAT = '<IIIiihHBB6x'
+    RECORD_SIZE = 32
+    FLAG_ALT = 0x01  # alt and mps are valid
+    LINK_TIMEOUT_S = 10
+
+    def __init__(self, capacity=256, filename="forward.bin", batch=8):
+        self.capacity = capacity
+        self.filename = filename
+        self.batch = batch
+        self.pending_buf = bytearray(batch * self.RECORD_SIZE)
+        self.pending = 0  # records in pending_buf, not on flash yet
+        self.seq = 0  # the next position gets this seq
+        self.boot_seq = 0  # seq of the first position since boot
+        self.delivered = 0
+        self.dirty = False  # delivered changed since the last header write
+        self.replayed = 0
+        self.overwritten = 0  # undelivered positions lost to newer ones
+        self.file = None
+        try:
+            self._open()
+        except Exception as e:
+            log(LOG_ERROR, "Couldn't open forward store: {}", e)
+
+    def _open(self):
+        try:
+            self.file = open(self.filename, "r+b")
+            magic, version, record_size, _, capacity, seq, delivered = \
+                struct.unpack(self.HEADER_FORMAT, self.file.read(self.HEADER_SIZE))
+            if magic == self.MAGIC and version == self.VERSION and \
+                    record_size == self.RECORD_SIZE and capacity == self.capacity:
+                self.seq, self.delivered = seq, delivered
+                self.boot_seq = seq
+                if seq > delivered:
+                    log(LOG_INFO, '{} positions wait for the phone', seq - delivered)
+                return
+            self.file.close()
+        except OSError:
+            pass
+        self.file = open(self.filename, "w+b")
+        self.file.write(bytearray(self.HEADER_SIZE + self.capacity * self.RECORD_SIZE))
+        self._write_header()
+
+    def _write_header(self):
+        self.file.seek(0)
+        self.file.write(struct.pack(self.HEADER_FORMAT, self.MAGIC, self.VERSION, self.RECORD_SIZE,
+                                    0, self.capacity, self.seq, self.delivered))
+        self.file.flush()
+        self.dirty = False
+
+    def oldest(self):
+        return max(0, self.seq - self.capacity)
+
+    def waiting(self):
+        return self.seq - self.delivered
+
+    def add(self, packet):
+        # Returns the seq of the new position
+        flags = 0
+        alt = mps = 0
+        if packet.alt is not None and packet.mps is not None:
+            flags |= self.FLAG_ALT
+            alt, mps = packet.alt, packet.mps
+        struct.pack_into(self.RECORD_FORMAT, self.pending_buf, self.pending * self.RECORD_SIZE,
+                         utime.time(), packet.id1, packet.id2, coord_to_e6(packet.lat),
+                         coord_to_e6(packet.lon), alt, vbat_to_mv(packet.vbat), mps, flags)
+        self.pending += 1
+        self.seq += 1
+        if self.delivered < self.oldest():
+            self.delivered = self.oldest()
+            self.overwritten += 1
+        if self.pending == self.batch:
+            self.flush()
+        return self.seq - 1
+
+    def sent(self, seq):
+        # A live send, delivered only moves on when nothing older waits
+        if self.delivered == seq:
+            self.delivered = seq + 1
+            self.dirty = True
+
+    def read(self, seq):
+        # (ts, id1, id2, lat, lon, alt, vbat, mps, flags)
+        newer = self.seq - 1 - seq
+        if newer < self.pending:
+            pos = (self.pending - 1 - newer) * self.RECORD_SIZE
+            return struct.unpack_from(self.RECORD_FORMAT, self.pending_buf, pos)
+        self.file.seek(self.HEADER_SIZE + seq % self.capacity * self.RECORD_SIZE)
+        return struct.unpack(self.RECORD_FORMAT, self.file.read(self.RECORD_SIZE))
+
+    def rewind(self, lost_at):
+        # The link went down at lost_at (utime.time()), positions sent in the
+        # LINK_TIMEOUT_S before may not have arrived. Timestamps of earlier
+        # boots are on another clock and not compared.
+        seq = self.delivered
+        while seq > max(self.oldest(), self.boot_seq) and \
+                self.read(seq - 1)[0] + self.LINK_TIMEOUT_S >= lost_at:
+            seq -= 1
+        if seq != self.delivered:
+            self.delivered = seq
+            self.dirty = True
+
+    def flush(self):
+        if self.file is None or not (self.pending or self.dirty):
+            return
+        try:
+            first = self.seq - self.pending
+            for done in range(self.pending):
+                # One record at a time, the batch may wrap around the end of the file
+                self.file.seek(self.HEADER_SIZE + (first + done) % self.capacity * self.RECORD_SIZE)
+                self.file.write(self.pending_buf[done * self.RECORD_SIZE:(done + 1) * self.RECORD_SIZE])
+            self.pending = 0
+            self._write_header()
+        except OSError as e:
+            log(LOG_ERROR, "Failed to write forward store: {}", e)
+
+
+def parse_time(text):
+    # Seconds since 2000-01-01 or 'YYYY-MM-DD[Thh:mm[:ss]]'
+    if text.isdigit():
+        return int(text)
+    date, _, clock = text.partition('T')
+    year, month, day = [int(part) for part in date.split('-')]
+    hms = [int(part) for part in clock.split(':')] if clock else []
+    hms += [0] * (3 - len(hms))
+    return utime.mktime((year, month, day, hms[0], hms[1], hms[2], 0, 0))
+
+
+def e6_to_str(value):
+    sign = '-' if value < 0 else ''
+    value = abs(value)
+    return '{}{}.{:06d}'.format(sign, value // 1000000, value % 1000000)
+
+
+class TRACKER():
+    # Latest state of one tracker, lat/lon in 1e-6 degrees
+    __slots__ = ('id1', 'id2', 'lat', 'lon', 'vbat', 'alt', 'mps', 'rssi', 'snr',
+                 'seen', 'seen_ms', 'packets', 'duplicates', 'payload', 'payload_ms',
+                 'forwarded_ms', 'period_ms', 'period_hits', 'airtime_ms', 'missed', 'fences')
+
+    def __init__(self, id1, id2):
+        self.id1 = id1
+        self.id2 = id2
+        self.packets = 0
+        self.duplicates = 0
+        self.payload = None  # last payload hex, for duplicate detection
+        self.payload_ms = 0
+        self.forwarded_ms = None  # last fix sent to BLE, for the rate limit
+        self.period_ms = 0  # learned transmit period, see TRACKERS.learn()
+        self.period_hits = 0  # intervals in a row that matched period_ms
+        self.airtime_ms = 0
+        self.missed = False  # RX_SCHEDULE listened and the beacon did not come
+        self.fences = ()  # numbers of the GEOFENCES it is inside
+
+
+class TRACKERS():
+    # Fixed size table of the trackers heard since boot, (id1, id2) ->
+    # TRACKER. The oldest tracker makes room for a new one when full.
+    # Payloads are compared before decoding, so a repeat heard within the
+    # 'dup_ms' window of the first copy costs no decrypt, log record or BLE
+    # notify. The window does not slide, a tracker that stands still and
+    # keeps sending the same fix is forwarded once per window.
+
+    MIN_PERIOD_MS = 2000  # shorter intervals are repeats, not beacons
+    JITTER_MS = 300  # plus 2 % of the period
+
+    def __init__(self, settings, capacity=32):
+        self.settings = settings
+        self.capacity = capacity
+        self.entries = {}
+        self.payloads = {}  # last payload of every tracker -> TRACKER
+
+    def is_duplicate(self, payload, now_ms):
+        entry = self.payloads.get(payload)
+        window = self.settings.data['dup_ms']
+        if entry is None or not window or utime.ticks_diff(now_ms, entry.payload_ms) >= window:
+            return False
+        entry.duplicates += 1
+        entry.seen = utime.time()
+        entry.seen_ms = now_ms
+        return True
+
+    def update(self, packet, payload, now_ms):
+        key = (packet.id1, packet.id2)
+        entry = self.entries.get(key)
+        if entry is None:
+            if len(self.entries) >= self.capacity:
+                self._evict()
+            entry = TRACKER(packet.id1, packet.id2)
+            self.entries[key] = entry
+        if entry.payload is not None:
+            self.payloads.pop(entry.payload, None)
+            self.learn(entry, utime.ticks_diff(now_ms, entry.payload_ms))
+        entry.airtime_ms = lora_airtime_ms(len(payload) // 2)
+        entry.missed = False
+        entry.payload = payload
+        entry.payload_ms = now_ms
+        self.payloads[payload] = entry
+        entry.lat = coord_to_e6(packet.lat)
+        entry.lon = coord_to_e6(packet.lon)
+        entry.vbat = vbat_to_mv(packet.vbat)
+        entry.alt = packet.alt
+        entry.mps = packet.mps
+        entry.rssi = packet.rssi
+        entry.snr = packet.snr
+        entry.seen = utime.time()
+        entry.seen_ms = now_ms
+        entry.packets += 1
+        return entry
+
+    def learn(self, entry, interval):
+        # Intervals are whole multiples of the period when beacons were lost.
+        # A matching one refines period_ms, anything else starts over.
+        period = entry.period_ms
+        if interval < self.MIN_PERIOD_MS:
+            return
+        if period:
+            k = (interval + period // 2) // period
+            if k and abs(interval - k * period) <= self.JITTER_MS + period // 50:
+                entry.period_ms = period + (interval // k - period) // 4
+                entry.period_hits += 1
+                return
+        entry.period_ms = interval
+        entry.period_hits = 0
+
+    def _evict(self):
+        oldest = None
+        for entry in self.entries.values():
+            if oldest is None or utime.ticks_diff(entry.seen_ms, oldest.seen_ms) < 0:
+                oldest = entry
+        self.payloads.pop(oldest.payload, None)
+        del self.entries[(oldest.id1, oldest.id2)]
+
+    def format_entry(self, entry, now_ms):
+        text = "ID1={}, ID2={}, LAT={}, LON={}, VBAT={}".format(
+            entry.id1, entry.id2, e6_to_str(entry.lat), e6_to_str(entry.lon), entry.vbat)
+        if entry.alt is not None:
+            text += ", ALT={}, MPS={}".format(entry.alt, entry.mps)
+        text += ", RSSI={}, SNR={}, AGE={}s, PKTS={}, DUPS={}".format(
+            entry.rssi, entry.snr, utime.ticks_diff(now_ms, entry.seen_ms) // 1000,
+            entry.packets, entry.duplicates)
+        if entry.period_ms:
+            text += ", PERIOD={}ms/{}".format(entry.period_ms, entry.period_hits)
+        return text
+
+
+class SUBSCRIPTIONS():
+    # The id2 values whose fixes are forwarded to BLE, id2 -> minimum ms
+    # between two fixes of the same tracker (0: every fix). The station's
+    # own 'id2' is always subscribed. Managed with 'sub', 'unsub' and 'subs'
+    # from the console or written to the BLE RX characteristic; handle()
+    # returns the reply text for either.
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.reload()
+        settings.subscribe(('id2', 'subs'), self.reload)
+
+    def reload(self, name=None):
+        self.rates = {}
+        for name, rate in self.settings.data['subs'].items():
+            self.rates[int(name)] = rate
+        if self.settings.data['id2'] not in self.rates:
+            self.rates[self.settings.data['id2']] = 0
+
+    def allow(self, entry, now_ms):
+        # entry is the tracker's TRACKERS entry
+        rate = self.rates.get(entry.id2)
+        if rate is None:
+            return False
+        if rate and entry.forwarded_ms is not None and \
+                utime.ticks_diff(now_ms, entry.forwarded_ms) < rate:
+            return False
+        entry.forwarded_ms = now_ms
+        return True
+
+    def handle(self, cmd, *args):
+        try:
+            if cmd == 'subs':
+                lines = []
+                for id2 in sorted(self.rates):
+                    lines.append('ID2={}, RATE={} ms'.format(id2, self.rates[id2]))
+                lines.append('OK')
+                return '\n'.join(lines)
+            id2 = int(args[0])
+            if cmd == 'sub':
+                rate = int(args[1]) if len(args) > 1 else 0
+                if rate < 0:
+                    raise ValueError
+                self.settings.data['subs'][str(id2)] = rate
+            elif id2 == self.settings.data['id2']:
+                return 'Error: {} is the station id2, change it with \'set gid2\''.format(id2)
+            elif self.settings.data['subs'].pop(str(id2), None) is None:
+                return 'Error: Not subscribed to {}'.format(id2)
+        except (ValueError, IndexError):
+            return 'Error: Expected \'sub ID2 [MS]\' or \'unsub ID2\''
+        self.settings.changed('subs')
+        return 'OK'
+
+
+class FENCE():
+    # One geofence, lat/lon in 1e-6 degrees. A circle has its center in
+    # lat/lon and the squared radius in r2, both in 1e-6 degrees of latitude,
+    # with longitudes scaled by kx / 4096 (the cosine at the center). A
+    # polygon has its corners in ys/xs. ids is None for every tracker.
+    __slots__ = ('num', 'lat_min', 'lat_max', 'lon_min', 'lon_max', 'lat', 'lon', 'r2', 'kx',
+                 'ys', 'xs', 'ids')
+
+    def contains(self, lat, lon):
+        if self.ys is None:
+            dy = lat - self.lat
+            dx = (lon - self.lon) * self.kx >> 12
+            return dx * dx + dy * dy <= self.r2
+        # Ray casting, edges crossing the point's latitude east of it
+        ys, xs = self.ys, self.xs
+        inside = False
+        j = len(ys) - 1
+        for i in range(len(ys)):
+            yi, yj = ys[i], ys[j]
+            if (yi > lat) != (yj > lat):
+                left = (lon - xs[i]) * (yj - yi)
+                right = (lat - yi) * (xs[j] - xs[i])
+                if (left < right) if yj > yi else (left > right):
+                    inside = not inside
+            j = i
+        return inside
+
+
+class GEOFENCES():
+    # Circles and polygons in the 'fences' setting, fence number ->
+    # {'c': [lat, lon, radius m]} or {'p': [[lat, lon], ...]} with 1e-6
+    # degree coordinates, plus 'ids': ["ID1:ID2", ...] when only those
+    # trackers are watched. Every fence is entered in the cells of a grid
+    # that its bounding box covers, so a fix is only tested against the few
+    # fences in its own cell. The cell size follows the median fence, fences
+    # covering more than MAX_CELLS are few and tested against every fix.
+    # Cell coordinates wrap at 2^14 to keep keys small ints, a far away cell
+    # sharing a key only adds candidates the bounding box check drops.
+    #
+    # check() compares the fences a tracker is in with those of its previous
+    # fix and returns the enter and exit events. Trackers start outside of
+    # every fence, after a reboot or for a new fence the first fix inside
+    # is an enter. Events for a phone that is not connected, or did not ask
+    # for them, are held, up to HELD, and replay_task() sends them first to
+    # the next one that takes them. Managed with 'fence',
+    # 'unfence' and 'fences' like SUBSCRIPTIONS.
+
+    ENTER = 1
+    EXIT = 2
+    EVENTS = ('', 'enter', 'exit')
+    MIN_CELL = 1000  # 1e-6 degrees, about 110 m of latitude
+    MAX_CELL = 1000000
+    MAX_CELLS = 16
+    MAX_FENCES = 512
+    MAX_POINTS = 16
+    M_PER_E6 = 0.111195  # meters per 1e-6 degree of latitude
+    HELD = 32
+
+    def __init__(self, settings, trackers):
+        self.settings = settings
+        self.trackers = trackers
+        self.held = []  # [(ts, event, fence, id1, id2, lat, lon)] while BLE is down
+        self.dropped = 0
+        self.reload()
+        settings.subscribe(('fences',), self.reload)
+
+    def reload(self, name=None):
+        self.fences = {}
+        self.grid = {}  # cell key -> [FENCE]
+        self.wide = []
+        for num in sorted(int(num) for num in self.settings.data['fences']):
+            try:
+                self.fences[num] = self._build(num, self.settings.data['fences'][str(num)])
+            except (KeyError, ValueError, TypeError, IndexError) as e:
+                log(LOG_ERROR, 'Fence {} ignored: {}', num, e)
+        spans = sorted(max(fence.lat_max - fence.lat_min, fence.lon_max - fence.lon_min)
+                       for fence in self.fences.values())
+        self.cell = min(max(spans[len(spans) // 2] if spans else 0, self.MIN_CELL), self.MAX_CELL)
+        for num in sorted(self.fences):
+            fence = self.fences[num]
+            y0, y1 = fence.lat_min // self.cell, fence.lat_max // self.cell
+            x0, x1 = fence.lon_min // self.cell, fence.lon_max // self.cell
+            if (y1 - y0 + 1) * (x1 - x0 + 1) > self.MAX_CELLS:
+                self.wide.append(fence)
+                continue
+            for y in range(y0, y1 + 1):
+                for x in range(x0, x1 + 1):
+                    self.grid.setdefault((y & 0x3FFF) << 14 | x & 0x3FFF, []).append(fence)
+        # A removed fence is left without an exit event
+        for entry in self.trackers.entries.values():
+            if entry.fences:
+                entry.fences = tuple(num for num in entry.fences if num in self.fences)
+
+    def _build(self, num, definition):
+        fence = FENCE()
+        fence.num = num
+        fence.ids = None
+        if definition.get('ids'):
+            fence.ids = set()
+            for key in definition['ids']:
+                id1, _, id2 = key.partition(':')
+                fence.ids.add((int(id1), int(id2)))
+        if 'c' in definition:
+            lat, lon, radius = definition['c']
+            r = int(radius / self.M_PER_E6) + 1
+            cos = max(math.cos(math.radians(lat / 1000000)), 0.01)
+            fence.lat, fence.lon, fence.r2, fence.kx = lat, lon, r * r, int(cos * 4096)
+            fence.ys = fence.xs = None
+            fence.lat_min, fence.lat_max = lat - r, lat + r
+            fence.lon_min, fence.lon_max = lon - int(r / cos) - 1, lon + int(r / cos) + 1
+        else:
+            points = definition['p']
+            if len(points) < 3:
+                raise ValueError('less than 3 points')
+            fence.ys = [point[0] for point in points]
+            fence.xs = [point[1] for point in points]
+            fence.lat_min, fence.lat_max = min(fence.ys), max(fence.ys)
+            fence.lon_min, fence.lon_max = min(fence.xs), max(fence.xs)
+        return fence
+
+    def _scan(self, fences, entry, lat, lon, inside):
+        for fence in fences:
+            if fence.lat_min <= lat <= fence.lat_max and fence.lon_min <= lon <= fence.lon_max and \
+                    (fence.ids is None or (entry.id1, entry.id2) in fence.ids) and \
+                    fence.contains(lat, lon):
+                if inside is None:
+                    inside = []
+                inside.append(fence.num)
+        return inside
+
+    def check(self, entry):
+        # [(ENTER or EXIT, fence number)] for the tracker's latest fix, None
+        # when it is in the same fences as before
+        lat, lon = entry.lat, entry.lon
+        inside = None
+        cell = self.grid.get((lat // self.cell & 0x3FFF) << 14 | lon // self.cell & 0x3FFF)
+        if cell is not None:
+            inside = self._scan(cell, entry, lat, lon, None)
+        if self.wide:
+            inside = self._scan(self.wide, entry, lat, lon, inside)
+        before = entry.fences
+        if inside is None:
+            if not before:
+                return None
+            inside = ()
+        events = []
+        for num in before:
+            if num not in inside:
+                events.append((self.EXIT, num))
+        for num in inside:
+            if num not in before:
+                events.append((self.ENTER, num))
+        if not events:
+            return None
+        entry.fences = tuple(inside)
+        return events
+
+    def hold(self, record):
+        if len(self.held) >= self.HELD:
+            self.held.pop(0)
+            self.dropped += 1
+        self.held.append(record)
+
+    def take(self):
+        held, self.held = self.held, []
+        return held
+
+    def _format(self, fence):
+        definition = self.settings.data['fences'][str(fence.num)]
+        if fence.ys is None:
+            text = 'FENCE={}, CIRCLE={},{}, R={} m'.format(
+                fence.num, e6_to_str(fence.lat), e6_to_str(fence.lon), definition['c'][2])
+        else:
+            text = 'FENCE={}, POLY={}'.format(fence.num, ' '.join(
+                '{},{}'.format(e6_to_str(y), e6_to_str(x)) for y, x in zip(fence.ys, fence.xs)))
+        text += ', TRACKERS={}'.format(' '.join(definition['ids']) if fence.ids else 'all')
+        inside = ['{}:{}'.format(entry.id1, entry.id2) for entry in self.trackers.entries.values()
+                  if fence.num in entry.fences]
+        if inside:
+            text += ', INSIDE={}'.format(' '.join(inside))
+        return text
+
+    def handle(self, cmd, *args):
+        # 'fence N circle LAT,LON METERS [ID1:ID2 ..]', 'fence N poly LAT,LON
+        # LAT,LON LAT,LON .. [ID1:ID2 ..]', 'unfence N' and 'fences'
+        fences = self.settings.data['fences']
+        try:
+            if cmd == 'fences':
+                lines = [self._format(self.fences[num]) for num in sorted(self.fences)]
+                lines.append('OK')
+                return '\n'.join(lines)
+            num = int(args[0])
+            if not 0 < num <= 0xFFFF:
+                raise ValueError
+            if cmd == 'unfence':
+                if fences.pop(str(num), None) is None:
+                    return 'Error: No fence {}'.format(num)
+                self.settings.changed('fences')
+                return 'OK'
+            shape = args[1]
+            points = []
+            ids = []
+            radius = None
+            for arg in args[2:]:
+                if ':' in arg:
+                    id1, _, id2 = arg.partition(':')
+                    ids.append('{}:{}'.format(int(id1), int(id2)))
+                elif ',' in arg:
+                    lat, _, lon = arg.partition(',')
+                    lat, lon = coord_to_e6(lat), coord_to_e6(lon)
+                    if abs(lat) > 90000000 or abs(lon) > 180000000:
+                        raise ValueError
+                    points.append([lat, lon])
+                elif radius is None:
+                    radius = int(arg)
+                else:
+                    raise ValueError
+            if shape == 'circle' and len(points) == 1 and radius and radius > 0:
+                definition = {'c': [points[0][0], points[0][1], radius]}
+            elif shape == 'poly' and 3 <= len(points) <= self.MAX_POINTS and radius is None:
+                definition = {'p': points}
+            else:
+                raise ValueError
+        except (ValueError, IndexError):
+            return 'Error: Expected \'fence N circle LAT,LON METERS [ID1:ID2 ..]\', ' \
+                   '\'fence N poly LAT,LON LAT,LON LAT,LON .. [ID1:ID2 ..]\' or \'unfence N\''
+        if str(num) not in fences and len(fences) >= self.MAX_FENCES:
+            return 'Error: At most {} fences'.format(self.MAX_FENCES)
+        if ids:
+            definition['ids'] = ids
+        fences[str(num)] = definition
+        self.settings.changed('fences')
+        return 'OK'
 
 
 class COMMAND_RECEIVER():
 
-    def __init__(self, settings_obj, log_manager):
+    def __init__(self, settings_obj, log_manager, keyring=None, trackers=None, subscriptions=None,
+                 stats=None):
         self.exit_request = False
+        self.stats = stats
+        self.lora_at = None
+        self.boot = None
+        self.forward_store = None
+        self.geofences = None
         self.settings = settings_obj
         self.log_manager = log_manager
-        _thread.start_new_thread(self.receiver_thread, ())
+        self.keyring = keyring
+        self.trackers = trackers
+        self.subscriptions = subscriptions
 
-    def set_handler(self, tag, number):
+    def set_handler(self, tag, number=None, *args):
         # Modified to handle setting parameters with prefixed 'g'
         if tag == 'gid2':
             try:
                 param = int(number)
                 self.settings.data['id2'] = param
-                self.settings.save()
+                self.settings.changed('id2')
                 print('OK')
             except (ValueError, TypeError):
                 print('Error: Expected numeric argument for gid2')
@@ -181,18 +1619,73 @@ class COMMAND_RECEIVER():
                     print('Error: Invalid frequency, expected value in Hz between 100MHz and 1000MHz')
                     return
                 self.settings.data['freq'] = param
-                self.settings.save()
+                self.settings.changed('freq')
                 print('OK')
             except (ValueError, TypeError):
                 print('Error: Expected numeric argument for gfreq')
 
         elif tag == 'gp2p_key':
             # Validate that the key is a valid hex string of correct length
-            if len(number) != 64 or not all(c in '0123456789abcdefABCDEF' for c in number):
+            if not is_valid_key(number):
                 print('Error: Expected 64 character hexadecimal string for p2p_key')
                 return
             self.settings.data['p2p_key'] = number
-            self.settings.save()
+            self.settings.changed('p2p_key')
+            print('OK')
+
+        elif tag == 'gkey':
+            # 'set gkey ID1 ID2 KEY' adds a per tracker key, KEY 'none' removes it
+            if len(args) != 2:
+                print('Error: Expected \'set gkey ID1 ID2 KEY\'')
+                return
+            try:
+                name = '{}:{}'.format(int(number), int(args[0]))
+            except (ValueError, TypeError):
+                print('Error: Expected numeric ID1 and ID2 for gkey')
+                return
+            if args[1] == 'none':
+                self.settings.data['keys'].pop(name, None)
+            elif is_valid_key(args[1]):
+                self.settings.data['keys'][name] = args[1]
+            else:
+                print('Error: Expected 64 character hexadecimal string for key')
+                return
+            self.settings.changed('keys')
+            print('OK')
+
+        elif tag == 'gdup':
+            try:
+                param = int(number)
+                if param < 0:
+                    raise ValueError
+                self.settings.data['dup_ms'] = param
+                self.settings.changed('dup_ms')
+                print('OK')
+            except (ValueError, TypeError):
+                print('Error: Expected duplicate window in ms, 0 to disable')
+
+        elif tag == 'greplay':
+            if number not in ('oldest', 'newest'):
+                print('Error: Expected oldest or newest')
+                return
+            self.settings.data['replay'] = number
+            self.settings.changed('replay')
+            print('OK')
+
+        elif tag == 'grx_sleep':
+            if number not in ('0', '1'):
+                print('Error: Expected 1 to sleep between tracker beacons or 0 to listen all the time')
+                return
+            self.settings.data['rx_sleep'] = number == '1'
+            self.settings.changed('rx_sleep')
+            print('OK')
+
+        elif tag == 'gfast_boot':
+            if number not in ('0', '1'):
+                print('Error: Expected 1 for fast boot or 0 for the LED self-test')
+                return
+            self.settings.data['fast_boot'] = number == '1'
+            self.settings.changed('fast_boot')
             print('OK')
         else:
             print('Error: Unknown parameter')
@@ -202,6 +1695,13 @@ class COMMAND_RECEIVER():
         print(f'  Device ID (id2): {self.settings.data["id2"]}')
         print(f'  Frequency: {self.settings.data["freq"]} Hz')
         print(f'  P2P Key: {self.settings.data["p2p_key"]}')
+        for name in self.settings.data['keys']:
+            print(f'  Key {name}: {self.settings.data["keys"][name]}')
+        print(f'  Duplicate window: {self.settings.data["dup_ms"]} ms')
+        print(f'  Replay after reconnect: {self.settings.data["replay"]} first')
+        print(f'  Sleep between beacons: {self.settings.data["rx_sleep"]}')
+        print(f'  Geofences: {len(self.settings.data["fences"])}')
+        print(f'  Fast boot: {self.settings.data["fast_boot"]}')
         print('OK')
 
     def print_help(self, *args):
@@ -210,27 +1710,104 @@ class COMMAND_RECEIVER():
             print('{} - {}'.format(cmd, self.commands[cmd]['info']))
         print('OK')
 
-    def show_log(self, num_entries=None):
-        logs = self.log_manager.get_all_logs()
-        if not logs:
+    def show_log(self, *args):
+        # 'log NUMBER' or any of 'id1=' 'id2=' 'from=' 'to=' 'limit='
+        if not self.log_manager.count:
             print('Log is empty')
             print('OK')
             return
 
-        if num_entries is not None:
-            try:
-                num = int(num_entries)
-                logs = logs[-num:] if num < len(logs) else logs
-            except ValueError:
-                print('Error: Expected numeric argument for number of entries')
-                return
+        filters = {'id1': None, 'id2': None, 'from': 0, 'to': 0xFFFFFFFF, 'limit': 100}
+        try:
+            for arg in args:
+                name, sep, value = arg.partition('=')
+                if not sep:
+                    filters['limit'] = int(name)
+                elif name in ('from', 'to'):
+                    filters[name] = parse_time(value)
+                elif name in filters:
+                    filters[name] = int(value)
+                else:
+                    print('Error: Unknown log filter {}'.format(name))
+                    return
+        except ValueError:
+            print('Error: Expected numbers, or YYYY-MM-DDThh:mm:ss for from/to')
+            return
 
+        entries = self.log_manager.query(filters['id1'], filters['id2'], filters['from'],
+                                         filters['to'], filters['limit'])
         print('--- Log Entries ---')
-        for i, entry in enumerate(logs):
-            print(f'[{entry["timestamp"]}] {entry["data"]}')
+        for entry in entries:
+            print(self.log_manager.format_entry(entry))
         print('------------------')
         print('OK')
 
+    def show_trackers(self, *args):
+        # Latest state of every tracker heard since boot, newest first
+        entries = sorted(self.trackers.entries.values(), key=lambda e: e.seen, reverse=True)
+        now = utime.ticks_ms()
+        print('--- Trackers ---')
+        for entry in entries:
+            print(self.trackers.format_entry(entry, now))
+        print('----------------')
+        print('OK')
+
+    def show_track(self, *args):
+        # 'track' lists the stored tracks, 'track ID1 ID2' and 'from=' 'to='
+        # 'limit=' show one tracker's history from TRACK_STORE
+        tracks = self.log_manager.tracks
+        if not args:
+            for (id1, id2), (fixes, used) in tracks.usage().items():
+                print('ID1={}, ID2={}: {} fixes, {} bytes, {:.1f} B/fix'.format(
+                    id1, id2, fixes, used, used / fixes))
+            print('OK')
+            return
+        filters = {'from': 0, 'to': 0xFFFFFFFF, 'limit': 100}
+        try:
+            if len(args) < 2:
+                raise ValueError
+            id1, id2 = int(args[0]), int(args[1])
+            for arg in args[2:]:
+                name, _, value = arg.partition('=')
+                if name not in filters:
+                    print('Error: Unknown track filter {}'.format(name))
+                    return
+                filters[name] = parse_time(value) if name != 'limit' else int(value)
+        except ValueError:
+            print('Error: Expected \'track ID1 ID2 [from=..] [to=..] [limit=..]\'')
+            return
+        fixes = []
+        for fix in tracks.fixes(id1, id2, filters['from'], filters['to']):
+            fixes.append(fix)
+            if len(fixes) > filters['limit']:
+                fixes.pop(0)
+        for ts, lat, lon, alt, vbat, mps in fixes:
+            t = utime.localtime(ts)
+            text = "[{:04d}-{:02d}-{:02d} {:02d}:{:02d}:{:02d}] LAT={}, LON={}, VBAT={}".format(
+                t[0], t[1], t[2], t[3], t[4], t[5], e6_to_str(lat), e6_to_str(lon), vbat)
+            if alt is not None:
+                text += ", ALT={}, MPS={}".format(alt, mps)
+            print(text)
+        print('OK')
+
+    def subscribe(self, *args):
+        print(self.subscriptions.handle('sub', *args))
+
+    def unsubscribe(self, *args):
+        print(self.subscriptions.handle('unsub', *args))
+
+    def show_subscriptions(self, *args):
+        print(self.subscriptions.handle('subs'))
+
+    def add_fence(self, *args):
+        print(self.geofences.handle('fence', *args))
+
+    def remove_fence(self, *args):
+        print(self.geofences.handle('unfence', *args))
+
+    def show_fences(self, *args):
+        print(self.geofences.handle('fences'))
+
     def clear_log(self, *args):
         self.log_manager.clear_logs()
         print('Log cleared')
@@ -250,12 +1827,68 @@ class COMMAND_RECEIVER():
         print(f'  Percent used: {alloc_mem / total_mem * 100:.1f}%')
         print('OK')
 
+    def export_log(self, *args):
+        # 'export [Q]' prints every stored record from log seq Q on
+        try:
+            q = int(args[0]) if args else 0
+        except ValueError:
+            print('Error: Expected \'export [FIRST_SEQ]\'')
+            return
+        asyncio.create_task(self._export_log(q))
+
+    async def _export_log(self, q):
+        lines = 0
+        for q, line in self.log_manager.export_logs(q):
+            print('#{} {}'.format(q, line))
+            lines += 1
+            q += 1
+            if lines % 16 == 0:
+                await asyncio.sleep_ms(0)  # one chunk at a time, packets go first
+        print('Exported {} records, resume with \'export {}\''.format(lines, q))
+        print('OK')
+
+    def at_command(self, *args):
+        # 'at AT+VER' passes one command to the LoRa module and shows the reply
+        if not args:
+            print('Error: Expected \'at COMMAND\'')
+            return
+        asyncio.create_task(self._at_command(' '.join(args)))
+
+    async def _at_command(self, cmd):
+        result = await self.lora_at.command(cmd, retries=0)
+        print(result)
+        print('OK' if result.ok else 'Error: LoRa module did not acknowledge')
+
+    def show_boot(self, *args):
+        for line in self.boot.report():
+            print(line)
+        print('OK')
+
+    def show_stats(self, *args):
+        # 'stats' shows the counters since boot or the last 'stats reset'
+        if args and args[0] == 'reset':
+            self.stats.reset()
+        else:
+            for line in self.stats.report():
+                print(line)
+        print('OK')
+
+    def set_log_level(self, *args):
+        # 'loglevel' shows the level, 'loglevel NAME' changes and saves it
+        if args:
+            if args[0] not in LOG_LEVELS:
+                print('Error: level is one of', ', '.join(LOG_LEVELS))
+                return
+            self.settings.data['log_level'] = args[0]
+            self.settings.changed('log_level')
+        print('Log level:', LOG_LEVELS[log_level])
+        print('OK')
+
     def save_log(self, *args):
         # Force saving of logs to file
         try:
-            # Write all logs to file in overwrite mode
-            with open(self.log_manager.filename, "w") as f:
-                f.write(self.log_manager.export_logs())
+            # Write the records still batched in RAM
+            self.log_manager.flush()
             print(f"Logs saved to {self.log_manager.filename}")
             print('OK')
         except Exception as e:
@@ -263,57 +1896,151 @@ class COMMAND_RECEIVER():
             print('Error: Failed to save logs')
 
     def exit_app(self, *args):
-        # Save logs before exiting
-        self.save_log()
+        # Save logs and pending settings before exiting
+        save_state(self.settings, self.log_manager, self.forward_store)
+        print(f"Logs saved to {self.log_manager.filename}")
         print('OK')
         self.exit_request = True
         sys.exit(1)
 
     commands = {
-        'set': {'handler': set_handler, 'info': '\'set gid2 VALUE\' or \'set gfreq VALUE\' or \'set gp2p_key VALUE\''},
+        'set': {'handler': set_handler, 'info': '\'set gid2 VALUE\' or \'set gfreq VALUE\' or \'set gp2p_key VALUE\' or \'set gkey ID1 ID2 VALUE|none\' or \'set gdup MS\' or \'set greplay oldest|newest\' or \'set grx_sleep 0|1\' or \'set gfast_boot 0|1\''},
         'info': {'handler': get_info, 'info': 'print current settings'},
         'help': {'handler': print_help, 'info': 'show this text'},
-        'log': {'handler': show_log, 'info': 'show log entries, optional: \'log NUMBER\' to show last N entries'},
+        'log': {'handler': show_log, 'info': 'show the last 100 log entries, optional: \'log NUMBER\' to show last N entries or \'log id1=.. id2=.. from=.. to=.. limit=..\' to filter'},
+        'trackers': {'handler': show_trackers, 'info': 'show the latest position, battery and signal of every tracker heard'},
+        'track': {'handler': show_track, 'info': '\'track\' list the stored tracks, \'track ID1 ID2\' show one tracker\'s history, optional from=.. to=.. limit=..'},
+        'sub': {'handler': subscribe, 'info': '\'sub ID2 [MS]\' forward fixes of trackers with this id2 to BLE, at most one per MS per tracker'},
+        'unsub': {'handler': unsubscribe, 'info': '\'unsub ID2\' stop forwarding this id2'},
+        'subs': {'handler': show_subscriptions, 'info': 'list the forwarded id2 values'},
+        'fence': {'handler': add_fence, 'info': '\'fence N circle LAT,LON METERS [ID1:ID2 ..]\' or \'fence N poly LAT,LON LAT,LON LAT,LON .. [ID1:ID2 ..]\' add or replace geofence N, for the listed trackers or all'},
+        'unfence': {'handler': remove_fence, 'info': '\'unfence N\' remove geofence N'},
+        'fences': {'handler': show_fences, 'info': 'list the geofences and the trackers inside them'},
         'clearlog': {'handler': clear_log, 'info': 'clear all log entries'},
         'savelog': {'handler': save_log, 'info': 'force save log entries to flash'},
         'mem': {'handler': show_mem, 'info': 'show memory usage statistics'},
+        'export': {'handler': export_log, 'info': '\'export [SEQ]\' print all stored log records, or those from log seq SEQ on'},
+        'at': {'handler': at_command, 'info': '\'at COMMAND\' send an AT command to the LoRa module, e.g. \'at AT+VER\''},
+        'boot': {'handler': show_boot, 'info': 'show how long each startup phase took and when the first packet arrived'},
+        'stats': {'handler': show_stats, 'info': 'show receive path timing and counters, \'stats reset\' to start over'},
+        'loglevel': {'handler': set_log_level, 'info': '\'loglevel error|info|debug|trace\' set how much is printed, debug and trace print every packet'},
         'exit': {'handler': exit_app, 'info': 'exit application'},
     }
 
-    def receiver_thread(self):
+    async def receiver_task(self):
+        # Console on the USB serial port, read without blocking the other tasks
+        reader = asyncio.StreamReader(sys.stdin)
+        chars = []
+        print('> ', end='')
         while True:
-            try:
-                rx_line = input("> ")
-            except KeyboardInterrupt:
-                print('Ctrl+C pressed')
-                self.exit_app()
-
-            if not rx_line:
-                continue
-
-            cmd_parts = rx_line.split()
-            if not cmd_parts:
-                continue
+            ch = await reader.read(1)
+            if ch in ('\r', '\n'):
+                print()
+                self.handle_line(''.join(chars))
+                chars = []
+                print('> ', end='')
+            elif ch in ('\x08', '\x7f'):
+                if chars:
+                    chars.pop()
+                    print('\x08 \x08', end='')
+            elif ch:
+                chars.append(ch)
+                print(ch, end='')
+
+    def handle_line(self, rx_line):
+        cmd_parts = rx_line.split()
+        if not cmd_parts:
+            return
 
-            cmd = cmd_parts[0]
-            params = cmd_parts[1:] if len(cmd_parts) > 1 else []
+        cmd = cmd_parts[0]
+        params = cmd_parts[1:] if len(cmd_parts) > 1 else []
 
-            try:
-                handler = self.commands[cmd]['handler']
-            except KeyError:
-                print('Error: Unknown command')
-            else:
-                handler(self, *params)
+        try:
+            handler = self.commands[cmd]['handler']
+        except KeyError:
+            print('Error: Unknown command')
+            return
+        # A failing command must not take the console task down with it
+        try:
+            handler(self, *params)
+        except Exception as e:
+            print('Error:', e)
 
 
 class LOKO_BLE():
-    def __init__(self, name):
-        # Create internal objects for the onboard LED_BLUE
+    # Outgoing messages go through a bounded queue drained by tx_task() at
+    # the rate the BLE stack accepts them: split to the negotiated MTU,
+    # retried with backoff when the stack is out of buffers, superseded
+    # battery updates merged. send() never blocks the caller.
+    #
+    # A central that writes 'fmt bin' gets compact binary frames instead of
+    # CSV lines until it writes 'fmt csv' or disconnects. Every frame starts
+    # with a type byte and a per connection sequence number:
+    #   0x00 ack      '<BHB'        version
+    #   0x01 position '<BHIIiihBHBIH' id1, id2, lat, lon (1e-6 deg), alt (m),
+    #                               speed (m/s), vbat (mV), flags (1: alt/speed
+    #                               valid, 2: replayed), store seq, age (s)
+    #   0x02 battery  '<BHHh'       vbat (mV), charge (0.01 %)
+    #   0x03 text     '<BHB'        length, followed by UTF-8 text
+    #   0x04 log      '<BHIB'       first log seq, count, followed by count
+    #                               LOG_MANAGER records of 32 bytes each
+    #   0x05 log end  '<BHI'        log seq to resume an export from
+    #   0x06 fence    '<BHBHIIiiH'  event (1: enter, 2: exit), fence number,
+    #                               id1, id2, lat, lon (1e-6 deg), age (s)
+    # Frames have a fixed size per type, so a frame split over several
+    # notifications can be put back together by the central.
+    #
+    # Geofence events go ahead of everything else queued. In CSV they are
+    # 'F,enter|exit,fence,id1,id2,lat,lon,age' lines, sent only after the
+    # central writes 'events on' (until 'events off' or a disconnect) so
+    # CSV centrals that only know position lines never see them; binary
+    # centrals always get them.
+    #
+    # Positions carry their FORWARD_STORE seq. Replayed ones, sent after a
+    # reconnect, may repeat positions the central already has. In CSV the
+    # position line is followed by ',#seq' live and ',#seq,age' replayed,
+    # so CSV centrals can drop repeats by seq too.
+    #
+    # Writes to the RX characteristic are only queued by the IRQ handler and
+    # handled by rx_task(). Besides 'fmt', 'commands' maps command names to
+    # handler(cmd, *args), which returns the reply text.
+
+    FRAME_ACK = 0x00
+    FRAME_POSITION = 0x01
+    FRAME_BATTERY = 0x02
+    FRAME_TEXT = 0x03
+    FRAME_LOG = 0x04
+    FRAME_LOG_END = 0x05
+    FRAME_FENCE = 0x06
+    FRAME_VERSION = 3
+    POSITION_ALT = 0x01
+    POSITION_REPLAYED = 0x02
+
+    DEFAULT_MTU = 23
+    PREFERRED_MTU = 247
+    MAX_RETRIES = 8
+
+    def __init__(self, name, stats=None):
+        # The onboard LED_BLUE is driven by led_task():
         # blinking when no BLE device is connected
         # stable ON when connected
         self.led = LED_BLUE
-        self.timer1 = Timer(0)
         self.name = name
+        self.conn_handle = 0
+        self.mtu = self.DEFAULT_MTU
+        self.tx_queue = QUEUE(32)
+        self.tx_failed = 0
+        self.binary = False
+        self.csv_events = False  # 'events on', geofence events as CSV lines
+        self.frame_seq = 0
+        self.rx_messages = []
+        self.rx_flag = asyncio.ThreadSafeFlag()
+        self.link_flag = asyncio.ThreadSafeFlag()  # set on connect and disconnect
+        self.connections = 0
+        self.is_connected = False
+        self.lost_at = None  # utime.time() of the last disconnect, None before the first
+        self.commands = {}
+        self.stats = stats
         self.ble = ubluetooth.BLE()
         self.ble.active(True)
         self.disconnected()
@@ -321,32 +2048,74 @@ class LOKO_BLE():
         self.register()
         self.advertiser()
         self.ble.config(gap_name="Loko")
+        try:
+            # Let the central negotiate a larger MTU than the default 23
+            self.ble.config(mtu=self.PREFERRED_MTU)
+        except Exception as inst:
+            log(LOG_ERROR, 'BLE MTU config error: {}', inst)
         self.is_connected = False
 
-    def connected(self):
+    def connected(self, conn_handle):
+        self.conn_handle = conn_handle
+        self.mtu = self.DEFAULT_MTU
+        self.binary = False  # every connection starts with CSV
+        self.csv_events = False
+        self.frame_seq = 0
         self.is_connected = True
-        self.led.value(0)
-        self.timer1.deinit()
-        print('Connected')
+        self.connections += 1
+        self.link_flag.set()
+        log(LOG_INFO, 'Connected')
 
     def disconnected(self):
+        if self.is_connected:
+            self.lost_at = utime.time()  # not at boot, no link was lost then
         self.is_connected = False
-        self.timer1.init(period=300, mode=Timer.PERIODIC,
-                         callback=lambda t: self.led.value(not self.led.value()))
-        print('Disconnected')
+        self.tx_queue.clear()
+        self.link_flag.set()
+        log(LOG_INFO, 'Disconnected')
 
     def ble_irq(self, event, data):
         if event == 1:  # _IRQ_CENTRAL_CONNECT:
             # A central has connected to this peripheral
-            self.connected()
+            self.connected(data[0])
         elif event == 2:  # _IRQ_CENTRAL_DISCONNECT:
             # A central has disconnected from this peripheral.
             self.advertiser()
             self.disconnected()
+        elif event == 21:  # _IRQ_MTU_EXCHANGED:
+            self.mtu = data[1]
         elif event == 3:  # _IRQ_GATTS_WRITE:
             # A client has written to this characteristic or descriptor.
-            ble_msg = self.ble.gatts_read(self.rx).decode('UTF-8').strip()
-            print('BLE Rx:', ble_msg)  # TODO: This message do not used
+            if len(self.rx_messages) < 8:
+                self.rx_messages.append(self.ble.gatts_read(self.rx))
+                self.rx_flag.set()
+
+    async def rx_task(self):
+        while True:
+            await self.rx_flag.wait()
+            while self.rx_messages:
+                try:
+                    self.handle_rx(self.rx_messages.pop(0).decode('UTF-8').strip())
+                except Exception as e:
+                    log(LOG_ERROR, 'BLE Rx error: {}', e)
+
+    def handle_rx(self, ble_msg):
+        if ble_msg == 'fmt bin':
+            self.binary = True
+            self.send(self._frame('<BHB', self.FRAME_ACK, self.FRAME_VERSION))
+        elif ble_msg == 'fmt csv':
+            self.binary = False
+            self.send('fmt csv')
+        elif ble_msg in ('events on', 'events off'):
+            self.csv_events = ble_msg == 'events on'
+            self.send_text(ble_msg)
+        else:
+            log(LOG_DEBUG, 'BLE Rx: {}', ble_msg)
+            parts = ble_msg.split()
+            if parts and parts[0] in self.commands:
+                self.send_text(self.commands[parts[0]](*parts))
+            else:
+                self.send_text('Error: Unknown command')
 
     def register(self):
         # Nordic UART Service (NUS)
@@ -360,227 +2129,554 @@ class LOKO_BLE():
         SERVICES = (BLE_UART, )
         ((self.tx, self.rx,), ) = self.ble.gatts_register_services(SERVICES)
 
-    def send(self, data):
-        try:
-            #self.ble.gatts_write(self.tx, data + '\n', True)
-            self.ble.gatts_notify(0,self.tx, data + '\n')
-            # self.ble.gatts_notify(0, self.tx, data + '\n') #doesn't work on ESP32S3, got OSError: -128, Remove it after tests on real hardware
-        except Exception as inst:
-            print('BLE Send error:', inst)
-
-    def advertiser(self):
-        name = bytes(self.name, 'UTF-8')
-        adv_data = bytearray(b'\x02\x01\x02') + \
-            bytearray((len(name) + 1, 0x09)) + name
-        self.ble.gap_advertise(100, adv_data)
-        print('ADV:', adv_data)
-
+    def send(self, data, key=None, urgent=False):
+        # Queue a line for the central, a pending message with the same key
+        # is replaced. Dropped when nobody is connected.
+        if self.is_connected:
+            self.tx_queue.put(data, key, urgent)
 
-def battery_level():
-    VBAT_IN.atten(ADC.ATTN_11DB)  # Adjust this based on your actual setup
-    VBAT_IN.width(ADC.WIDTH_12BIT)  # Ensure this matches your earlier setting
-    adc_reading = VBAT_IN.read()  # Get the ADC value
-   # print(adc_reading)
-    max_adc_value = 2455  # Max value for a 12-bit ADC
-    max_battery_voltage = 2.1  # Adjust based on your battery's characteristics
-    adc_battery_voltage = 2*(adc_reading * max_battery_voltage / max_adc_value)
-    return adc_battery_voltage
+    def _frame(self, fmt, frame_type, *fields):
+        self.frame_seq = (self.frame_seq + 1) & 0xFFFF
+        return struct.pack(fmt, frame_type, self.frame_seq, *fields)
 
+    def send_text(self, text):
+        if not self.binary:
+            self.send(text)
+            return
+        data = text.encode()[:255]
+        self.send(self._frame('<BHB', self.FRAME_TEXT, len(data)) + data)
 
-def lora_set(freq_hz):
-    # Convert Hz to MHz for LoRa module
-    freq_mhz = freq_hz // 1000000
+    def send_position(self, packet, text, seq):
+        # text is the CSV line for centrals that did not ask for binary frames
+        if not self.binary:
+            self.send('{},#{}'.format(text, seq))
+            return
+        flags = 0
+        alt = mps = 0
+        if packet.alt is not None and packet.mps is not None:
+            flags = self.POSITION_ALT
+            alt, mps = packet.alt, packet.mps
+        self.send(self._frame('<BHIIiihBHBIH', self.FRAME_POSITION, packet.id1, packet.id2,
+                              coord_to_e6(packet.lat), coord_to_e6(packet.lon),
+                              alt, mps, vbat_to_mv(packet.vbat), flags, seq, 0))
+
+    def send_stored(self, seq, record, age):
+        # record as read from FORWARD_STORE, age in seconds
+        ts, id1, id2, lat, lon, alt, vbat, mps, flags = record
+        if not self.binary:
+            text = '{},{},{},{},{}'.format(id1, id2, e6_to_str(lat), e6_to_str(lon), vbat)
+            if flags & FORWARD_STORE.FLAG_ALT:
+                text += ',{},{}'.format(alt, mps)
+            self.send('{},#{},{}'.format(text, seq, age))
+            return
+        self.send(self._frame('<BHIIiihBHBIH', self.FRAME_POSITION, id1, id2, lat, lon, alt, mps,
+                              vbat, flags | self.POSITION_REPLAYED, seq, min(age, 0xFFFF)))
+
+    def takes_events(self):
+        # Whether the connected central wants geofence events, see above
+        return self.is_connected and (self.binary or self.csv_events)
+
+    def send_fence(self, record, age):
+        # record as held by GEOFENCES, age in seconds; check takes_events() first
+        ts, event, fence, id1, id2, lat, lon = record
+        if not self.binary:
+            self.send('F,{},{},{},{},{},{},{}'.format(GEOFENCES.EVENTS[event], fence, id1, id2,
+                                                      e6_to_str(lat), e6_to_str(lon), age), urgent=True)
+            return
+        self.send(self._frame('<BHBHIIiiH', self.FRAME_FENCE, event, fence, id1, id2, lat, lon,
+                              min(age, 0xFFFF)), urgent=True)
+
+    def send_log(self, first, num, data):
+        # num raw LOG_MANAGER records, or 'L,q,ts,id1,id2,lat,lon,vbat,alt,mps,rssi,snr'
+        # lines with empty alt and mps when they are not known, followed by
+        # ',enter|exit,fence' for geofence event records
+        if self.binary:
+            self.send(self._frame('<BHIB', self.FRAME_LOG, first, num) + data)
+            return
+        lines = []
+        for i in range(num):
+            ts, id1, id2, lat, lon, alt, vbat, mps, rssi, snr, flags, fence = struct.unpack_from(
+                LOG_MANAGER.RECORD_FORMAT, data, i * LOG_MANAGER.RECORD_SIZE)
+            if not flags & LOG_MANAGER.FLAG_ALT:
+                alt = mps = ''
+            line = 'L,{},{},{},{},{},{},{},{},{},{},{}'.format(
+                first + i, ts, id1, id2, e6_to_str(lat), e6_to_str(lon), vbat, alt, mps, rssi, snr)
+            if flags & LOG_MANAGER.FLAG_ENTER:
+                line += ',enter,{}'.format(fence)
+            elif flags & LOG_MANAGER.FLAG_EXIT:
+                line += ',exit,{}'.format(fence)
+            lines.append(line)
+        self.send('\n'.join(lines))
+
+    def send_log_end(self, next_q):
+        if self.binary:
+            self.send(self._frame('<BHI', self.FRAME_LOG_END, next_q))
+        else:
+            self.send('L,end,{}'.format(next_q))
 
-    LORA_UART.write("AT+MODE=TEST")
-    sleep_ms(1000)
-    print('Lora Resp:', LORA_UART.read())
-    LORA_UART.write(
-        "AT+TEST=RFCFG,{},SF12,125,12,15,14,ON,OFF,OFF".format(freq_mhz))
-    sleep_ms(1000)
-    print('Lora Resp:', LORA_UART.read())
+    def send_battery(self, vbat, percent):
+        if not self.binary:
+            self.send(str(round(percent, 2)), 'battery')
+            return
+        self.send(self._frame('<BHHh', self.FRAME_BATTERY, vbat_to_mv(vbat),
+                              int(percent * 100)), 'battery')
 
+    async def tx_task(self):
+        while True:
+            data = await self.tx_queue.get()
+            if isinstance(data, str):
+                data = (data + '\n').encode()
+            payload = memoryview(data)
+            pos = 0
+            retries = 0
+            while pos < len(payload) and self.is_connected:
+                # Notifications longer than MTU - 3 would be truncated
+                chunk = self.mtu - 3
+                start = utime.ticks_us()
+                try:
+                    self.ble.gatts_notify(self.conn_handle, self.tx, payload[pos:pos + chunk])
+                    if self.stats is not None:
+                        self.stats.time('notify', start)
+                except OSError as inst:
+                    # Usually the stack is out of buffers, give it time to drain
+                    retries += 1
+                    if retries > self.MAX_RETRIES:
+                        self.tx_failed += 1
+                        log(LOG_ERROR, 'BLE Send error: {}', inst)
+                        break
+                    await asyncio.sleep_ms(min(10 << retries, 500))
+                    continue
+                pos += chunk
+                retries = 0
 
-def lora_data_receive():
-    LORA_UART.write('AT+TEST=RXLRPKT')
-    sleep_ms(500)
-    print('Lora RX:', LORA_UART.read())
+    def advertiser(self):
+        name = bytes(self.name, 'UTF-8')
+        adv_data = bytearray(b'\x02\x01\x02') + \
+            bytearray((len(name) + 1, 0x09)) + name
+        self.ble.gap_advertise(100, adv_data)
+        log(LOG_DEBUG, 'ADV: {}', adv_data)
 
-def is_hex_ascii_convertible(hex_string):
-    if not all(c in '0123456789abcdefABCDEF' for c in hex_string):
-        return False
 
-    if len(hex_string) % 2 != 0:
-        return False
+class LOG_EXPORT():
+    # 'export [SEQ]' written by the phone streams the stored log from log
+    # seq SEQ on (all of it by default) as FRAME_LOG frames or 'L,' lines,
+    # as fast as the BLE queue drains, then FRAME_LOG_END or 'L,end,SEQ'
+    # with the seq to resume from. A dropped connection ends the export,
+    # the phone asks for 'export SEQ' of the first record it is missing.
+    # 'export stop' ends it early, a new export replaces a running one.
+    # The log is read one chunk at a time, so RAM use does not depend on
+    # the log size.
 
-    try:
-        decoded_bytes = bytes(int(hex_string[i:i+2], 16) for i in range(0, len(hex_string), 2))
-    except ValueError:
-        return False
+    QUEUED = 4  # BLE messages waiting before the next chunk is read
+    CSV_CHUNK = 16
 
-    return all(32 <= byte <= 126 for byte in decoded_bytes)
-
-def parse_lora_module_message(message):
-    # expected packet like: '+TEST: LEN:31, RSSI:-35, SNR:12\r\n+TEST: RX \"30302C3030302C35302E3531313732352C33302E3739313934352C33393936\"\r\n'
-    line = str(message).split(" ")
-    if len(line) > 2 and line[-2] == 'RX':
-        received_data = line[-1][1:]
-        end_hex_data_pos = received_data.find('\"')
-        if end_hex_data_pos != -1:
-            received_data = received_data[0:end_hex_data_pos]
-            return received_data
-    return None
-
-
-def parse_loko_string_packet(string, key):
-    values = string.split(',')
-    print(values)
-    if len(values) == 5:
-        # message : '123,321,40.376123,49.850848,3420'
-        id1 = int(values[0])
-        id2 = int(values[1])
-
-        # do not use float() result will round to five digit, ex: 50.511725 >>>> 50.51172 and 30.791945 >>>> 30.79195
-        lat = (values[2])
-        lon = (values[3])
-
-        vbat = int(values[4])
-        return {'id1': id1, 'id2': id2, 'lat': lat, 'lon': lon, 'vbat': vbat}
-    if len(values) == 7:
-        # message : '00,000,54.685349,25.282091,117,0,6432'
-        id1 = int(values[0])
-        id2 = int(values[1])
-
-        # do not use float() result will round to five digit, ex: 50.511725 >>>> 50.51172 and 30.791945 >>>> 30.79195
-        lat = (values[2])
-        lon = (values[3])
-        alt_meters = int(values[4])
-        meters_per_second = int(values[5])
-
-        vbat = int(values[6])
-        return {'id1': id1, 'id2': id2, 'lat': lat, 'lon': lon, 'vbat': vbat, 'alt': alt_meters, 'mps': meters_per_second}
-    if len(values) == 3:
-        # message :'00,000,KsC72EMf5cAYJU8eATDTMg=='
-        id1 = int(values[0])
-        id2 = int(values[1])
-        base64 = values[2]
-        encrypted_bytes = ubinascii.a2b_base64(base64)
-
-        # Initialize the AES cipher in ECB mode
-        cipher = aes(key, 1)  # 1 for ECB mode
-        decrypted_bytes = cipher.decrypt(encrypted_bytes)
-        checksum = sum(decrypted_bytes[:-1]) % 256
-        lat, lon, vbat_mv, alt_meters, speed_mps, reserved1, integrity= struct.unpack('<ffHHHBB', decrypted_bytes)
-        if checksum == integrity:
-            return {'id1': id1, 'id2': id2, 'lat': lat, 'lon': lon, 'vbat': vbat_mv, 'alt': alt_meters, 'mps': speed_mps}
-        else:
-            print('Can\'t decrypt, possible wrong key')
-
-    return None
-
-def bin_unpack_vbat(vbat):
-    return (vbat + 27) * 0.1
-
-def bin_unpack_lat_lon_24(packed_data):
-    # Extract and convert 3 bytes for latitude to a signed 24-bit integer
-    lat_lon_scaled = (packed_data[0] << 16) | (packed_data[1] << 8) | packed_data[2]
-    if lat_lon_scaled & 0x800000:  # Check if the sign bit is set for a negative value
-        lat_lon_scaled -= 0x1000000  # Convert to signed 24-bit integer
-
-    scaling_factor = 10000.0
-    lat_lon = lat_lon_scaled / scaling_factor
-
-    return lat_lon
-
-def bin_unpack_lat_lon_32(packed_data):
-    # Extract and convert 4 bytes for latitude to a signed 32-bit integer
-    lat_lon_scaled = (packed_data[0] << 24) | (packed_data[1] << 16) | (packed_data[2] << 8) | packed_data[3]
-    if lat_lon_scaled & 0x80000000:  # Check if the sign bit is set for a negative value
-        lat_lon_scaled -= 0x100000000  # Convert to signed 32-bit integer
-
-    scaling_factor = 1000000.0
-    lat_lon = lat_lon_scaled / scaling_factor
-
-    return lat_lon
-
-def parse_loko_bin_packet(bin_data, key):
-    id1 = 0
-    id2 = 0
-    vbat_mv = 0
-    packet_version = 0
-    lat = 0.0
-    lon = 0.0
-    alt_meters = 0
-    speed_mps = 0
-    data = bytes(int(bin_data[i:i+2], 16) for i in range(0, len(bin_data), 2))
-    if len(data) == 15:
-        id1, id2, vb_version, lat_24bit, lon_24bit= struct.unpack("<IIB3s3s", data)
-        packet_version = (vb_version >> 4) & 0x0F
-        vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-        lat = bin_unpack_lat_lon_24(lat_24bit)
-        lon = bin_unpack_lat_lon_24(lon_24bit)
-    if len(data) == 17:
-        id1, id2, vb_version, lat_32bit, lon_32bit= struct.unpack("<IIB4s4s", data)
-        packet_version = (vb_version >> 4) & 0x0F
-        vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-        lat = bin_unpack_lat_lon_32(lat_32bit)
-        lon = bin_unpack_lat_lon_32(lon_32bit)
-    elif len(data) == 18:
-        id1, id2, vb_version, lat_24bit, lon_24bit, speed_mps, alt_meters= struct.unpack("<IIB3s3sBh", data)
-        packet_version = (vb_version >> 4) & 0x0F
-        vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-        lat = bin_unpack_lat_lon_24(lat_24bit)
-        lon = bin_unpack_lat_lon_24(lon_24bit)
-    elif len(data) == 20:
-        id1, id2, vb_version, lat_32bit, lon_32bit, speed_mps, alt_meters= struct.unpack("<IIB4s4sBh", data)
-        packet_version = (vb_version >> 4) & 0x0F
-        vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-        lat = bin_unpack_lat_lon_32(lat_32bit)
-        lon = bin_unpack_lat_lon_32(lon_32bit)
-    elif len(data) == 25:
-        id1, id2, vb_version, aes_payload= struct.unpack(">IIB16s", data)
-        packet_version = (vb_version >> 4) & 0x0F
-        encrypted_bytes = bytes(aes_payload)
-
-        # Initialize the AES cipher in ECB mode
-        cipher = aes(key, 1)  # 1 for ECB mode
-        # cipher = AES.new(key, AES.MODE_ECB)
-        decrypted_bytes = cipher.decrypt(encrypted_bytes)
-        checksum = sum(decrypted_bytes[:-1]) % 256
-        if vb_version == 2:
-            (vb_version, lat_24bit, lon_24bit, speed_mps, alt_meters, reserved1,  integrity) = struct.unpack('<B3s3sBH5sB', decrypted_bytes)
-            if checksum != integrity:
-                print('Can\'t decrypt, possible wrong key')
-            else:
-                vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-                lat = bin_unpack_lat_lon_24(lat_24bit)
-                lon = bin_unpack_lat_lon_24(lon_24bit)
-        elif vb_version == 5:
-            (vb_version, lat_32bit, lon_32bit, speed_mps, alt_meters, reserved1,  integrity) = struct.unpack('<B4s4sBH3sB', decrypted_bytes)
-            if checksum != integrity:
-                print('Can\'t decrypt, possible wrong key')
+    def __init__(self, log_manager, ble):
+        self.log_manager = log_manager
+        self.ble = ble
+        self.start = None
+        self.event = asyncio.Event()
+        self.requests = 0  # a running export stops when this changes
+        self.exported = 0  # records sent
+
+    def handle(self, cmd, *args):
+        self.requests += 1
+        self.start = None
+        if args and args[0] == 'stop':
+            return 'OK'
+        try:
+            q = int(args[0]) if args else 0
+        except ValueError:
+            return 'Error: Expected \'export [SEQ]\' or \'export stop\''
+        log_manager = self.log_manager
+        self.start = q
+        self.event.set()
+        return 'Export of {} records'.format(max(0, log_manager.seq - max(q, log_manager.seq - log_manager.count)))
+
+    async def task(self):
+        while True:
+            await self.event.wait()
+            self.event.clear()
+            if self.start is None:
+                continue
+            q, self.start = self.start, None
+            request = self.requests
+            connections = self.ble.connections
+            size = self.CSV_CHUNK
+            if self.ble.binary:
+                # One frame per notification
+                size = max(1, (self.ble.mtu - 3 - 8) // LOG_MANAGER.RECORD_SIZE)
+            for first, num, data in self.log_manager.chunks(q, size):
+                while len(self.ble.tx_queue) >= self.QUEUED and self.requests == request and \
+                        self.ble.connections == connections:
+                    await asyncio.sleep_ms(5)
+                if self.requests != request or not self.ble.is_connected or \
+                        self.ble.connections != connections:
+                    break
+                self.ble.send_log(first, num, data)
+                self.exported += num
+                q = first + num
+                await asyncio.sleep_ms(0)
             else:
-                vbat_mv = bin_unpack_vbat(vb_version & 0x0F)
-                lat = bin_unpack_lat_lon_32(lat_32bit)
-                lon = bin_unpack_lat_lon_32(lon_32bit)
-
-    return {'id1': id1, 'id2': id2, 'lat': lat, 'lon': lon, 'vbat': vbat_mv, 'alt': alt_meters, 'mps': speed_mps}
-
-def button_timer(pin):
-    print('Power value:', POWER_CTRL.value())
-    if BUTTON.value() == 0:
-        print("counting till 3")
-        sleep_ms(2000)
-        if BUTTON.value() == 0:
-            LED_RED.value(not LED_GREEN.value())
-            POWER_CTRL.value(not POWER_CTRL.value())
-            print('Power value:', POWER_CTRL.value())
+                self.ble.send_log_end(q)
+
+
+class BATTERY():
+    # Battery voltage from the VBAT divider. The ADC is configured once,
+    # battery_task() calls sample() on its own schedule, and everybody else
+    # reads the cached, filtered voltage and percent. Each sample averages
+    # OVERSAMPLE reads without the min and max, and the result is smoothed
+    # so one noisy reading cannot trigger the low battery shutdown.
+
+    OVERSAMPLE = 16
+    FILTER = 0.25  # weight of a new sample
+    LOW_VOLTAGE = 3.3
+    FULL_VOLTAGE = 4.2
+    LOW_SAMPLES = 5  # consecutive low samples before the shutdown
+
+    def __init__(self, adc):
+        self.adc = adc
+        self.adc.atten(ADC.ATTN_11DB)  # Adjust this based on your actual setup
+        self.adc.width(ADC.WIDTH_12BIT)  # Ensure this matches your earlier setting
+        self.voltage = self._read()
+        self.low_samples = 0
+
+    def _read(self):
+        total = 0
+        low = 4095
+        high = 0
+        for _ in range(self.OVERSAMPLE):
+            adc_reading = self.adc.read()  # Get the ADC value
+            total += adc_reading
+            low = min(low, adc_reading)
+            high = max(high, adc_reading)
+        adc_reading = (total - low - high) / (self.OVERSAMPLE - 2)
+        max_adc_value = 2455  # Max value for a 12-bit ADC
+        max_battery_voltage = 2.1  # Adjust based on your battery's characteristics
+        return 2*(adc_reading * max_battery_voltage / max_adc_value)
+
+    def sample(self):
+        self.voltage += (self._read() - self.voltage) * self.FILTER
+        if self.voltage < self.LOW_VOLTAGE:
+            self.low_samples += 1
         else:
-            print('Button released')
-
-
-def main():
-    print (battery_level())
+            self.low_samples = 0
+        return self.voltage
+
+    def is_low(self):
+        return self.low_samples >= self.LOW_SAMPLES
+
+    def percent(self):
+        return (self.voltage - self.LOW_VOLTAGE) * 100 / (self.FULL_VOLTAGE - self.LOW_VOLTAGE)
+
+
+def lora_airtime_ms(length, sf=12, bw_khz=125, preamble=12):
+    # Time on air of a packet with explicit header, CRC and coding rate 4/5,
+    # the RF_CONFIG settings; low data rate optimization above 16 ms symbols
+    symbol_ms = (1 << sf) / bw_khz
+    ldro = 2 if symbol_ms > 16 else 0
+    bits = 8 * length - 4 * sf + 28 + 16
+    symbols = 8 + max(0, -(-bits // (4 * (sf - ldro)))) * 5
+    return int((preamble + 4.25 + symbols) * symbol_ms)
+
+
+class AT_RESULT():
+    # Outcome of one LORA_AT.command()
+    __slots__ = ('command', 'ok', 'reply', 'attempts', 'ms')
+
+    def __init__(self, command, ok, reply, attempts, ms):
+        self.command = command
+        self.ok = ok  # acknowledged without ERROR
+        self.reply = reply  # reply line as str, None on timeout
+        self.attempts = attempts
+        self.ms = ms  # from the first write to the reply or the last timeout
+
+    def __str__(self):
+        if self.reply is None:
+            return '{}: no reply after {} attempts, {} ms'.format(self.command, self.attempts, self.ms)
+        return '{}: {} ({} ms)'.format(self.command, self.reply, self.ms)
+
+
+class LORA_AT():
+    # AT commands for the LoRa-E5. command() writes one command and waits
+    # for the module's '+NAME:' reply (+MODE for AT+MODE, +TEST for AT+TEST
+    # ...) or any ERROR line, retrying on timeout. The UART is read only by
+    # lora_ingest_task(), which hands every line that is not a received
+    # packet to feed(). One command at a time, callers queue on the lock.
+
+    TIMEOUT_MS = 1000
+    RETRIES = 2
+    RF_CONFIG = 'AT+TEST=RFCFG,{},SF12,125,12,15,14,ON,OFF,OFF'
+
+    def __init__(self, uart):
+        self.uart = uart
+        self.lock = asyncio.Lock()
+        self.event = asyncio.Event()
+        self.expect = None  # reply prefix of the pending command
+        self.reply = None
+        self.timeouts = 0
+        self.errors = 0
+
+    def feed(self, line):
+        # True when the line was the reply to the pending command
+        if self.expect is None or self.reply is not None:
+            return False
+        if line.startswith(self.expect) or b'ERROR' in line:
+            self.reply = line
+            self.event.set()
+            return True
+        return False
 
+    async def command(self, cmd, timeout_ms=TIMEOUT_MS, retries=RETRIES):
+        name = cmd[2:].split('=')[0].split('?')[0] or '+AT'
+        async with self.lock:
+            start = utime.ticks_ms()
+            attempts = 0
+            while attempts <= retries:
+                attempts += 1
+                self.reply = None
+                self.event.clear()
+                self.expect = name.encode() + b':'
+                self.uart.write(cmd + '\r\n')
+                try:
+                    await asyncio.wait_for_ms(self.event.wait(), timeout_ms)
+                except asyncio.TimeoutError:
+                    self.timeouts += 1
+                    continue
+                finally:
+                    self.expect = None
+                reply = self.reply.decode()
+                ok = 'ERROR' not in reply
+                if not ok:
+                    self.errors += 1
+                return AT_RESULT(cmd, ok, reply, attempts, utime.ticks_diff(utime.ticks_ms(), start))
+            return AT_RESULT(cmd, False, None, attempts, utime.ticks_diff(utime.ticks_ms(), start))
+
+    async def configure(self, freq_hz):
+        # TEST mode, RF settings and continuous receive. Also used to change
+        # the frequency at runtime, True when every step was acknowledged.
+        start = utime.ticks_ms()
+        for cmd in ('AT+MODE=TEST', self.RF_CONFIG.format(freq_hz // 1000000), 'AT+TEST=RXLRPKT'):
+            result = await self.command(cmd)
+            log(LOG_DEBUG, 'Lora: {}', result)
+            if not result.ok:
+                log(LOG_ERROR, 'Lora: configuration failed, {}', result)
+                return False
+        log(LOG_INFO, 'Lora: receiving on {} Hz, configured in {} ms',
+            freq_hz, utime.ticks_diff(utime.ticks_ms(), start))
+        return True
+
+    async def sleep(self):
+        # Module in low power mode until the next byte on the UART
+        result = await self.command('AT+LOWPOWER')
+        log(LOG_DEBUG, 'Lora: {}', result)
+        return result.ok
+
+    async def wake(self):
+        # Any byte wakes the module, it stays in TEST mode with the RF
+        # settings, only the receiver has to be started again
+        self.uart.write(b'\xff\xff\xff\xff')
+        await asyncio.sleep_ms(5)
+        result = await self.command('AT+TEST=RXLRPKT')
+        log(LOG_DEBUG, 'Lora: {}', result)
+        return result.ok
+
+
+class LORA_RX():
+    # Line framer for the LoRa-E5 module output. Bytes go straight from the
+    # UART into a preallocated buffer and every complete '\r\n' terminated
+    # line is handed out on its own, so a burst of '+TEST: RX' lines landing
+    # in one read, or one line split across two reads, is never lost or merged.
+
+    def __init__(self, uart, size=1024):
+        self.uart = uart
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.start = 0  # first byte of the line being assembled
+        self.scan = 0  # first byte not yet checked for '\n'
+        self.end = 0  # one past the last received byte
+        self.overflows = 0
+        self.stream = asyncio.StreamReader(uart)
+
+    async def fill(self):
+        if self.start == self.end:
+            self.start = self.scan = self.end = 0
+        elif self.end == len(self.buf):
+            if self.start == 0:
+                # A line longer than the whole buffer, nothing sane to keep
+                log(LOG_ERROR, 'LoraRx: line too long, dropped')
+                self.overflows += 1
+                self.start = self.scan = self.end = 0
+            else:
+                # Move the partial line to the front to make room
+                pending = self.end - self.start
+                self.buf[0:pending] = bytes(self.mv[self.start:self.end])
+                self.scan -= self.start
+                self.start = 0
+                self.end = pending
+
+        # Sleep until the first byte arrives, then take whatever else is
+        # already buffered. Never ask for more than that so readinto does
+        # not wait for the UART timeout.
+        count = await self.stream.readinto(self.mv[self.end:self.end + 1])
+        if not count:
+            return 0
+        self.end += count
+        more = min(self.uart.any(), len(self.buf) - self.end)
+        if more > 0:
+            more = self.uart.readinto(self.mv[self.end:self.end + more]) or 0
+            self.end += more
+        return count + more
+
+    def lines(self):
+        buf = self.buf
+        while self.scan < self.end:
+            pos = self.scan
+            self.scan += 1
+            if buf[pos] != 10:  # '\n'
+                continue
+            line_end = pos
+            if line_end > self.start and buf[line_end - 1] == 13:  # '\r'
+                line_end -= 1
+            line = bytes(self.mv[self.start:line_end])
+            self.start = self.scan
+            if line:
+                yield line
+
+
+class RX_SCHEDULE():
+    # Decides when the radio has to listen, from the transmit periods
+    # TRACKERS has learned. A tracker whose period matched LEARN_HITS times
+    # in a row gets a window from the start of its next expected packet
+    # (the end of the last one plus the period, minus its air time) minus
+    # a guard, to the expected end plus the guard. Outside all windows the
+    # radio may sleep. Listening is continuous while
+    # - a tracker heard within DISCOVERY_MS has no learned period yet,
+    # - a learned tracker missed its window, until it is heard again,
+    # - DISCOVERY_LISTEN_MS of every DISCOVERY_MS, to pick up new trackers.
+    # A learned tracker silent for STALE_PERIODS periods no longer counts.
+
+    LEARN_HITS = 3
+    GUARD_MS = 500  # plus 2 % of the period
+    STALE_PERIODS = 10
+    DISCOVERY_MS = 600000
+    DISCOVERY_LISTEN_MS = 60000
+
+    def __init__(self, trackers):
+        self.trackers = trackers
+        self.discovery_ms = utime.ticks_ms()
+        self.misses = 0
+        self.radio_sleeps = 0
+        self.slept_ms = 0  # ESP32 light sleep
+
+    def plan(self, now_ms):
+        # ms until the radio has to listen, 0 when it has to listen now
+        since = utime.ticks_diff(now_ms, self.discovery_ms)
+        if since >= self.DISCOVERY_MS:
+            self.discovery_ms = now_ms
+            since = 0
+        if since < self.DISCOVERY_LISTEN_MS:
+            return 0
+        wait = self.DISCOVERY_MS - since
+        learned = False
+        for entry in self.trackers.entries.values():
+            age = utime.ticks_diff(now_ms, entry.payload_ms)
+            period = entry.period_ms
+            if entry.period_hits < self.LEARN_HITS:
+                if age < self.DISCOVERY_MS:
+                    return 0  # still learning
+                continue
+            if age > self.STALE_PERIODS * period:
+                continue
+            learned = True
+            guard = self.GUARD_MS + period // 50
+            if entry.missed:
+                return 0
+            if age > period + guard:
+                entry.missed = True
+                self.misses += 1
+                log(LOG_INFO, 'Beacon of ID1={} missed, listening until it is heard', entry.id1)
+                return 0
+            wait = min(wait, period - entry.airtime_ms - guard - age)
+        if not learned:
+            return 0
+        return max(0, wait)
+
+
+class PUSH_BUTTON():
+    # The IRQ only sets a flag on either edge. task() wakes up, checks the
+    # level after DEBOUNCE_MS and then polls every POLL_MS while the button
+    # is held: 'long' is reported as soon as it has been held LONG_MS,
+    # 'short' when it is released (and up for DEBOUNCE_MS) before that.
+    # Nothing runs between presses. Gestures go to handler(gesture).
+
+    DEBOUNCE_MS = 30
+    POLL_MS = 20
+    LONG_MS = 2000
+
+    def __init__(self, pin, handler):
+        self.pin = pin  # active low
+        self.handler = handler
+        self.flag = asyncio.ThreadSafeFlag()
+        self.pin.irq(trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, handler=self.irq)
+
+    def irq(self, pin):
+        self.flag.set()
+
+    async def task(self):
+        while True:
+            await self.flag.wait()
+            await asyncio.sleep_ms(self.DEBOUNCE_MS)
+            if self.pin.value() != 0:
+                continue  # bounce or a release
+            pressed = utime.ticks_add(utime.ticks_ms(), -self.DEBOUNCE_MS)
+            gesture = 'short'
+            up_ms = 0
+            while up_ms < self.DEBOUNCE_MS:
+                await asyncio.sleep_ms(self.POLL_MS)
+                if self.pin.value():
+                    up_ms += self.POLL_MS
+                    continue
+                up_ms = 0
+                if gesture == 'short' and utime.ticks_diff(utime.ticks_ms(), pressed) >= self.LONG_MS:
+                    gesture = 'long'
+                    self.handler(gesture)
+            if gesture == 'short':
+                self.handler(gesture)
+            self.flag.clear()  # the edges of this press were polled already
+
+
+def save_state(settings, log_manager=None, forward_store=None):
+    # Everything still batched in RAM to flash: log records (and tracks),
+    # positions for the phone and debounced settings. Before any exit.
+    if log_manager is not None:
+        log_manager.flush()
+    if forward_store is not None:
+        forward_store.flush()
+    settings.flush()
+
+
+def button_action(gesture, log_manager, forward_store):
+    if gesture == 'long':
+        # Toggle the power latch, the device switches off when it is released
+        LED_RED.value(not LED_GREEN.value())
+        POWER_CTRL.value(not POWER_CTRL.value())
+        log(LOG_INFO, 'Power value: {}', POWER_CTRL.value())
+    else:
+        # Write everything batched in RAM, e.g. before pulling the battery
+        log_manager.flush()
+        forward_store.flush()
+        asyncio.create_task(led_blink(LED_GREEN))
+        log(LOG_INFO, 'Button: log saved')
+
+
+async def led_blink(led, ms=200):
+    led.value(0)
+    await asyncio.sleep_ms(ms)
+    led.value(1)
+
+
+def led_self_test():
+    # Every LED on in turn, 2 s, only without fast boot
     LED_BLUE.value(0)
     sleep_ms(500)
 
@@ -593,94 +2689,382 @@ def main():
     sleep_ms(500)
 
     LED_GREEN.value(1)
-    POWER_CTRL.value(1)
     LED_GREEN.value(0)
     sleep_ms(500)
 
     LED_GREEN.value(1)
 
-    # Initialize the log manager with file storage
-    log_manager = LOG_MANAGER(max_entries=100, filename="lora_log.txt")
-    print("Log manager initialized")
 
+async def led_flash():
+    # Short power-on sign for fast boot, LED_BLUE belongs to led_task()
+    LED_RED.value(0)
+    await asyncio.sleep_ms(150)
+    LED_RED.value(1)
+    LED_GREEN.value(0)
+    await asyncio.sleep_ms(150)
+    LED_GREEN.value(1)
+
+
+def main():
+    boot = BOOT()
+    POWER_CTRL.value(1)  # hold the power latch before anything slow
     settings = SETTINGS()
+    set_log_level(LOG_LEVELS.index(settings.data['log_level']))
+    settings.subscribe(('log_level',), lambda name: set_log_level(LOG_LEVELS.index(settings.data['log_level'])))
+    boot.mark('settings')
+    if not settings.data['fast_boot']:
+        led_self_test()
+        boot.mark('led_test')
+
+    battery = BATTERY(VBAT_IN)
+    log(LOG_INFO, 'Battery: {} V', battery.voltage)
+    stats = STATS()
+    keyring = KEYRING(settings)
+    settings.subscribe(('p2p_key', 'keys'), lambda name: keyring.reload())
+    trackers = TRACKERS(settings)
+    subscriptions = SUBSCRIPTIONS(settings)
+    geofences = GEOFENCES(settings, trackers)
+    lora_at = LORA_AT(LORA_UART)
+    boot.mark('init')
+    stores = []  # log manager and forward store, once run_tasks() made them
+    try:
+        asyncio.run(run_tasks(boot, settings, battery, stats, keyring, trackers, subscriptions,
+                              geofences, lora_at, stores))
+    except KeyboardInterrupt:
+        # Ctrl+C on the console ends asyncio.run() from whatever task runs
+        save_state(settings, *stores)
+        raise
+
+
+async def radio_task(lora_at, settings, boot):
+    if await lora_at.configure(settings.data['freq']):
+        boot.mark('radio')
+
+
+async def run_tasks(boot, settings, battery, stats, keyring, trackers, subscriptions, geofences,
+                    lora_at, stores):
+    rx_queue = QUEUE(16)
+    lora_rx = LORA_RX(LORA_UART)
+
+    # The LoRa module takes tens of ms per AT command, BLE and the log are
+    # set up while it works on them
+    asyncio.create_task(lora_ingest_task(lora_rx, rx_queue, lora_at, stats))
+    asyncio.create_task(radio_task(lora_at, settings, boot))
+    # A new frequency is tuned in the background, the result is printed when done
+    settings.subscribe(('freq',), lambda name: asyncio.create_task(
+        lora_at.configure(settings.data['freq'])))
+    if settings.data['fast_boot']:
+        asyncio.create_task(led_flash())
+    await asyncio.sleep_ms(0)  # let the first AT command go out
+
+    ble = LOKO_BLE("LOKO", stats)
+    ble.commands = {'sub': subscriptions.handle, 'unsub': subscriptions.handle,
+                    'subs': subscriptions.handle, 'fence': geofences.handle,
+                    'unfence': geofences.handle, 'fences': geofences.handle}
+    boot.mark('ble')
+    await asyncio.sleep_ms(0)
+
+    # Initialize the log manager with file storage
+    log_manager = LOG_MANAGER(capacity=2048, filename="lora_log.bin")
+    log(LOG_INFO, "Log manager initialized")
+    forward_store = FORWARD_STORE(capacity=256, filename="forward.bin")
+    stores[:] = [log_manager, forward_store]
+    rx_schedule = RX_SCHEDULE(trackers)
+    boot.mark('log')
+
+    log_export = LOG_EXPORT(log_manager, ble)
+    ble.commands['export'] = log_export.handle
+
     command_parser = None
     if use_command_line_parser == True:
-        command_parser = COMMAND_RECEIVER(settings, log_manager)
-
-    key = bytes(int(settings.data['p2p_key'][i:i+2], 16) for i in range(0, len(settings.data['p2p_key']), 2))
+        command_parser = COMMAND_RECEIVER(settings, log_manager, keyring, trackers, subscriptions,
+                                          stats)
+        command_parser.lora_at = lora_at
+        command_parser.boot = boot
+        command_parser.forward_store = forward_store
+        command_parser.geofences = geofences
+
+    stats.watch('rx_dropped', rx_queue, 'dropped')
+    stats.watch('rx_overflows', lora_rx, 'overflows')
+    stats.watch('ble_dropped', ble.tx_queue, 'dropped')
+    stats.watch('ble_merged', ble.tx_queue, 'merged')
+    stats.watch('ble_failed', ble, 'tx_failed')
+    stats.watch('at_timeouts', lora_at, 'timeouts')
+    stats.watch('at_errors', lora_at, 'errors')
+    stats.watch('replayed', forward_store, 'replayed')
+    stats.watch('store_overwritten', forward_store, 'overwritten')
+    stats.watch('radio_sleeps', rx_schedule, 'radio_sleeps')
+    stats.watch('beacon_misses', rx_schedule, 'misses')
+    stats.watch('fence_dropped', geofences, 'dropped')
+    stats.reset()
+
+    asyncio.create_task(ble.tx_task())
+    asyncio.create_task(ble.rx_task())
+    asyncio.create_task(battery_task(battery, ble))
+    asyncio.create_task(led_task(ble))
+    asyncio.create_task(log_flush_task(log_manager, forward_store, stats))
+    asyncio.create_task(replay_task(forward_store, ble, settings, geofences))
+    asyncio.create_task(log_export.task())
+    button = PUSH_BUTTON(BUTTON, lambda gesture: button_action(gesture, log_manager, forward_store))
+    asyncio.create_task(button.task())
+    asyncio.create_task(stats_task(stats, rx_schedule))
+    asyncio.create_task(rx_sleep_task(rx_schedule, lora_at, ble, settings))
+    asyncio.create_task(settings.save_task())
+    if use_command_line_parser == True and command_parser is not None:
+        asyncio.create_task(command_parser.receiver_task())
+    boot.mark('tasks')
+
+    await packet_task(rx_queue, command_parser, ble, keyring, trackers, subscriptions, geofences,
+                      forward_store, stats, boot)
+
+
+async def lora_ingest_task(lora_rx, rx_queue, lora_at, stats):
+    # Received packet lines are queued as soon as they are complete, every
+    # other line is the reply to an AT command or unsolicited module output
+    while True:
+        await lora_rx.fill()
+        start = utime.ticks_us()
+        for lora_line in lora_rx.lines():
+            if lora_line.startswith(b'+TEST: RX "') or lora_line.startswith(b'+TEST: LEN:'):
+                rx_queue.put(lora_line)
+                stats.count('lines')
+            elif not lora_at.feed(lora_line):
+                # '+LOWPOWER: WAKEUP' after every rx_sleep_task() wake
+                log(LOG_DEBUG if lora_line.startswith(b'+LOWPOWER') else LOG_INFO, 'Lora: {}', lora_line)
+        stats.time('uart', start)
+
+
+async def battery_task(battery, ble):
+    while True:
+        battery.sample()
+        if battery.is_low():
+            log(LOG_ERROR, "Battery level too low. Device entering deep sleep to protect from overcharge.")
+            # Enter deep sleep mode indefinitely
+            await asyncio.sleep_ms(100)
+            POWER_CTRL.value(0)
 
-    BUTTON.irq(trigger=Pin.IRQ_FALLING, handler=button_timer)
-    ble = LOKO_BLE("LOKO")
-    lora_set(settings.data['freq'])
-    lora_data_receive()
-    btCounter = 0
+        if ble.is_connected:
+            ble.send_battery(battery.voltage, battery.percent())
+        await asyncio.sleep_ms(1000)
 
-    # battery_level()
 
+async def log_flush_task(log_manager, forward_store, stats):
+    # Batched log and forward store records reach flash at least every 5 seconds
     while True:
+        await asyncio.sleep_ms(5000)
+        if log_manager.pending:
+            start = utime.ticks_us()
+            log_manager.flush()
+            stats.time('flush', start)
+        forward_store.flush()
 
-        sleep_ms(100)
 
-        if battery_level() < 3.3:
-            print("Battery level too low. Device entering deep sleep to protect from overcharge.")
-            # Enter deep sleep mode indefinitely
-            sleep_ms(100)
-            POWER_CTRL.value(0)
+REPLAY_DELAY_MS = 1000  # after connecting, time for the central to subscribe and pick a format
+REPLAY_GAP_MS = 40  # between replayed positions
+REPLAY_QUEUE = 4  # replay waits while more messages than this are queued for BLE
+
 
+async def replay_task(forward_store, ble, settings, geofences):
+    # Rewinds the store when the phone goes away and sends what it missed
+    # once it is back, held geofence events first, paced so live positions
+    # are not held up
+    connections = ble.connections
+    while True:
+        await ble.link_flag.wait()
+        if ble.lost_at is not None and (not ble.is_connected or ble.connections != connections):
+            forward_store.rewind(ble.lost_at)
+        if not ble.is_connected or ble.connections == connections:
+            continue
+        connections = ble.connections
+        end = forward_store.seq  # later positions go out live
+        await asyncio.sleep_ms(REPLAY_DELAY_MS)
+        if not ble.is_connected or ble.connections != connections:
+            continue
+        now = utime.time()
+        if ble.takes_events():
+            for record in geofences.take():
+                ble.send_fence(record, max(0, now - record[0]))
+        if settings.data['replay'] == 'newest':
+            order = range(end - 1, forward_store.delivered - 1, -1)
+        else:
+            order = range(forward_store.delivered, end)
+        if len(order):
+            log(LOG_INFO, 'Replaying {} positions', len(order))
+        for seq in order:
+            while len(ble.tx_queue) > REPLAY_QUEUE and ble.connections == connections:
+                await asyncio.sleep_ms(REPLAY_GAP_MS)
+            if not ble.is_connected or ble.connections != connections:
+                break
+            if seq < forward_store.oldest():
+                continue  # overwritten meanwhile
+            record = forward_store.read(seq)
+            ble.send_stored(seq, record, max(0, utime.time() - record[0]))
+            forward_store.replayed += 1
+            if seq == forward_store.delivered:
+                forward_store.delivered = seq + 1
+                forward_store.dirty = True
+            await asyncio.sleep_ms(REPLAY_GAP_MS)
+        else:
+            if ble.is_connected and ble.connections == connections:
+                # Everything since end went out live
+                forward_store.delivered = forward_store.seq
+                forward_store.dirty = True
 
-        if use_command_line_parser == True and command_parser is not None:
-            if command_parser.exit_request == True:
-               sys.exit(1)
 
-        if (btCounter < 301):
-            if ble.is_connected:
-                btr = (battery_level() - 3.3) * 100/0.9
-                batterStr = str(round(btr,2))
-                ble.send(batterStr)
-        btCounter = btCounter + 1
-        if(btCounter > 300):
-            btCounter = 0
+RX_CHECK_MS = 250
+RX_WAKE_MS = 300  # waking the module and restarting RX, before a window
+RX_MIN_SLEEP_MS = 2000  # shorter gaps are not worth the AT round trips
+MAX_LIGHTSLEEP_MS = 30000  # the battery and log tasks still run in between
 
-        lora_data = LORA_UART.read()
-        if lora_data == None:
-            continue
-        print('LoraRx: ', lora_data)
 
-        loko_payload = parse_lora_module_message(lora_data)
-        if loko_payload == None:
-            continue
-        loko_data = None
-        loko_string = ""
-        if is_hex_ascii_convertible(loko_payload):
-            converted_data = ubinascii.unhexlify(loko_payload)
-            loko_string = converted_data.decode("utf-8")
-            print('LokoMessage: ', loko_string)
-
-            loko_data = parse_loko_string_packet(loko_string, key)
+async def rx_sleep_task(schedule, lora_at, ble, settings):
+    # With 'rx_sleep' on, the LoRa module sleeps between the windows
+    # RX_SCHEDULE plans and, while no phone is connected, the ESP32 too.
+    # Light sleep stops BLE advertising and the console, a phone connects
+    # and typed commands arrive while the station is awake for a window.
+    asleep = False
+    while True:
+        await asyncio.sleep_ms(RX_CHECK_MS)
+        wait = schedule.plan(utime.ticks_ms()) - RX_WAKE_MS if settings.data['rx_sleep'] else 0
+        if asleep:
+            if wait <= 0:
+                asleep = not await lora_at.wake()
+        elif wait >= RX_MIN_SLEEP_MS:
+            asleep = await lora_at.sleep()
+            if asleep:
+                schedule.radio_sleeps += 1
+        if asleep and not ble.is_connected and wait > 2 * RX_CHECK_MS:
+            ms = min(wait - RX_CHECK_MS, MAX_LIGHTSLEEP_MS)
+            machine.lightsleep(ms)
+            schedule.slept_ms += ms
+
+
+async def stats_task(stats, schedule):
+    # Measures how late a sleep wakes up every second and collects garbage
+    # every 5 s at a known point, so automatic collections in the middle of
+    # a packet stay rare. Time in light sleep does not count as lag.
+    ticks = 0
+    while True:
+        start = utime.ticks_us()
+        slept_ms = schedule.slept_ms
+        await asyncio.sleep_ms(1000)
+        late = utime.ticks_diff(utime.ticks_us(), start) - 1000000
+        stats.stages['lag'].add(max(0, late - (schedule.slept_ms - slept_ms) * 1000))
+        ticks += 1
+        if ticks % 5 == 0:
+            start = utime.ticks_us()
+            gc.collect()
+            stats.time('gc', start)
+
+
+async def led_task(ble):
+    # LED_BLUE is active low: blink while advertising, stable ON when connected
+    while True:
+        if ble.is_connected:
+            ble.led.value(0)
         else:
-            loko_data = parse_loko_bin_packet(loko_payload, key)
-            loko_string =  f'{loko_data["id1"]},{loko_data["id2"]},{loko_data["lat"]},{loko_data["lon"]},{loko_data["vbat"]},{loko_data["alt"]},{loko_data["mps"]}'
-            sleep_ms(100)
-            print('LokoMessage: ', loko_string)
-        if loko_data != None:
+            ble.led.value(not ble.led.value())
+        await asyncio.sleep_ms(300)
+
+
+async def packet_task(rx_queue, command_parser, ble, keyring, trackers, subscriptions, geofences,
+                      forward_store, stats, boot):
+    rssi = snr = 0  # from the LEN line the module prints before each RX line
+    while True:
+        lora_line = await rx_queue.get()
+        try:
+            start = utime.ticks_us()
+            if log_level >= LOG_TRACE:
+                log(LOG_TRACE, 'LoraRx: {}', lora_line)
+
+            signal = parse_lora_signal(lora_line)
+            if signal is not None:
+                rssi, snr = signal
+                stats.time('parse', start)
+                continue
+            loko_payload = parse_lora_module_message(lora_line)
+            t = stats.time('parse', start)
+            if loko_payload == None:
+                continue
+            now = utime.ticks_ms()
+            if trackers.is_duplicate(loko_payload, now):
+                if log_level >= LOG_DEBUG:
+                    log(LOG_DEBUG, 'Duplicate dropped: {}', loko_payload)
+                stats.count('duplicates')
+                rssi = snr = 0
+                continue
+            loko_data = decode_loko_payload(loko_payload, keyring)
+            if loko_data is None:
+                stats.time('decode', t)
+                stats.count('decode_failed')
+                rssi = snr = 0
+                continue
+            t = stats.time('decode_aes' if loko_data.fmt in loko_packet.ENCRYPTED else 'decode', t)
+            stats.count('packets')
+            stats.count_format(loko_data.fmt)
+            if boot.first_packet is None:
+                boot.first_packet = utime.ticks_ms()
+                boot.mark('first_packet')
+            loko_data.rssi, loko_data.snr = rssi, snr
+            rssi = snr = 0
+            tracker = trackers.update(loko_data, loko_payload, now)
+            if loko_data.text is not None:
+                loko_string = loko_data.text
+            else:
+                loko_string =  f'{loko_data.id1},{loko_data.id2},{e6_to_str(loko_data.lat)},{e6_to_str(loko_data.lon)},{loko_data.vbat},{loko_data.alt},{loko_data.mps}'
+            if log_level >= LOG_DEBUG:
+                log(LOG_DEBUG, 'LokoMessage: {}', loko_string)
+
             # Add to log regardless of ID match
             if use_command_line_parser == True and command_parser is not None:
-                # Create a formatted log entry
-                log_entry = f"ID1={loko_data['id1']}, ID2={loko_data['id2']}, LAT={loko_data['lat']}, LON={loko_data['lon']}, VBAT={loko_data['vbat']}"
-                # Add alt and mps if available
-                if 'alt' in loko_data and 'mps' in loko_data:
-                    log_entry += f", ALT={loko_data['alt']}, MPS={loko_data['mps']}"
-                command_parser.log_manager.add_entry(log_entry)
-
-            if loko_data['id2'] == settings.data['id2']:
+                command_parser.log_manager.add_entry(loko_data)
+                t = stats.time('log', t)
+
+            if geofences.fences:
+                events = geofences.check(tracker)
+                t = stats.time('fence', t)
+                if events:
+                    for event, num in events:
+                        log(LOG_INFO, 'ID1={}, ID2={} {} fence {}', loko_data.id1, loko_data.id2,
+                            GEOFENCES.EVENTS[event], num)
+                        if use_command_line_parser == True and command_parser is not None:
+                            command_parser.log_manager.add_entry(
+                                loko_data, LOG_MANAGER.FLAG_ENTER if event == GEOFENCES.ENTER
+                                else LOG_MANAGER.FLAG_EXIT, num)
+                        record = (utime.time(), event, num, tracker.id1, tracker.id2, tracker.lat,
+                                  tracker.lon)
+                        if ble.takes_events():
+                            ble.send_fence(record, 0)
+                        else:
+                            geofences.hold(record)
+                    stats.count('fence_events', len(events))
+                    t = stats.time('event', t)
+
+            if subscriptions.allow(tracker, now):
+                seq = forward_store.add(loko_data)
                 if ble.is_connected:
-                    ble.send(loko_string)
+                    ble.send_position(loko_data, loko_string, seq)
+                    forward_store.sent(seq)
+                    stats.time('ble_send', t)
                 else:
-                    print('BLE not connected')
+                    if log_level >= LOG_DEBUG:
+                        log(LOG_DEBUG, 'BLE not connected, stored')
+                    stats.count('ble_not_connected')
+            elif loko_data.id2 in subscriptions.rates:
+                if log_level >= LOG_DEBUG:
+                    log(LOG_DEBUG, 'Rate limited ID1={}, ID2={}', loko_data.id1, loko_data.id2)
+                stats.count('rate_limited')
             else:
-                print('DEBUG:Received unexpected ID2={}, Expected={}'.format(
-                    loko_data['id2'], settings.data['id2']))
+                if log_level >= LOG_DEBUG:
+                    log(LOG_DEBUG, 'Received unsubscribed ID2={}', loko_data.id2)
+                stats.count('unsubscribed')
+            stats.time('packet', start)
+        except Exception as e:
+            # A packet the decoders let through but the rest chokes on must
+            # not end reception
+            log(LOG_ERROR, 'Packet dropped, {}: {}', repr(e), lora_line)
+            stats.count('packet_errors')
+            rssi = snr = 0
 
 if __name__ == '__main__':
     try: